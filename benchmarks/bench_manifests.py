@@ -0,0 +1,53 @@
+""" Compare building job objects from cached manifest templates with parsing manifests for every job
+
+$ python benchmarks/bench_manifests.py --number 200
+"""
+import argparse
+import importlib.resources
+import json
+import timeit
+
+from ruamel.yaml import YAML
+
+from jobsubmitter.job.job import plan_job
+from jobsubmitter.templates import MANIFESTS, load_template
+
+MESSAGE = {"pipeline_param": {"id": "INTP00000001",
+                              "nxf_work": "/workspace/work",
+                              "nxf_params_file": {"pgs_id": "PGS001229", "target_build": "GRCh37"},
+                              "target_genomes": [{"sampleset": "test", "chrom": None,
+                                                  "pgen": "test.pgen", "pvar": "test.pvar", "psam": "test.psam"}]},
+           "globus_details": {"dir_path_on_guest_collection": "test/",
+                              "guest_collection_id": "11111111-2222-3333-4444-555555555555"}}
+
+
+def parse_manifests() -> list:
+    """ The old path: read and parse every manifest """
+    return [cls.from_yaml(YAML().load(importlib.resources.files(package).joinpath(filename).read_text()))
+            for package, filename, cls in MANIFESTS]
+
+
+def clone_manifests() -> list:
+    return [load_template(package, filename, cls) for package, filename, cls in MANIFESTS]
+
+
+def build_job() -> None:
+    plan_job(json.loads(json.dumps(MESSAGE)), 'bench')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", help="Iterations per benchmark", type=int, default=100)
+    args = parser.parse_args()
+
+    clone_manifests()  # parse templates once, like preload_templates() at startup
+
+    for name, fn in [('parse manifests', parse_manifests),
+                     ('clone templates', clone_manifests),
+                     ('plan_job (templates)', build_job)]:
+        per_call = timeit.timeit(fn, number=args.number) / args.number
+        print(f"{name:<24} {per_call * 1000:8.3f} ms per job")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+""" Benchmark the whole job submitter pipeline against a local fake API server and an in-memory Kafka broker
+
+Launch messages are consumed, validated and submitted (create_consumer -> submit_job), and the job watcher publishes
+status changes (job_watcher), exactly like submit_job.main does. Reports submission latency percentiles, API calls per
+job, watcher detection lag (job completion -> COMPLETED status published) and, with --trace_memory, memory held by
+jobsubmitter per 1k jobs (tracing allocations slows submissions down several times, so it's off by default).
+
+$ python benchmarks/bench_pipeline.py --jobs 200 --api_latency_ms 20 --workers 4
+$ python benchmarks/bench_pipeline.py --messages messages.jsonl
+$ python benchmarks/bench_pipeline.py --jobs 500 --workers 8 --api_qps 50
+"""
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+import tracemalloc
+
+import kubernetes
+
+from jobsubmitter import apiclient, config, consume, status
+from jobsubmitter import submit_job as pipeline
+from jobsubmitter.admission import AdmissionController
+from jobsubmitter.dedupe import SubmissionIndex
+from jobsubmitter.executor import SubmissionExecutor
+from jobsubmitter.transfer.pool import PVCPool
+from jobsubmitter.job.config import reconcile_shared_cm
+from jobsubmitter.templates import preload_templates
+from jobsubmitter.watch import job_watcher
+
+from fakes import FakeApiServer, InMemoryKafka
+from bench_validation import make_message
+
+NAMESPACE = 'bench'
+
+
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", help="Number of synthetic launch messages", type=int, default=100)
+    parser.add_argument("--messages", help="Replay launch messages from a JSONL file instead (one message per line)")
+    parser.add_argument("--rate", help="Messages produced per second (0: all at once)", type=float, default=0)
+    parser.add_argument("--api_latency_ms", help="Latency added to every API request", type=float, default=0)
+    parser.add_argument("--job_run_s", help="Seconds a job runs before it completes", type=float, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max_in_flight", type=int, default=10)
+    parser.add_argument("--max_active_jobs", help="Admission limit on unfinished jobs", type=int)
+    parser.add_argument("--pvc_pool_size", help="Warm PVC pool size (0 disables)", type=int, default=0)
+    parser.add_argument("--api_qps", help="Client side API rate limit (0 is unlimited)", type=float, default=0)
+    parser.add_argument("--api_burst", type=int, default=40)
+    parser.add_argument("--watch_mode", choices=['poll', 'stream'], default='stream')
+    parser.add_argument("--validation_engine", choices=['jsonschema', 'fast'], default='jsonschema')
+    parser.add_argument("--trace_memory", help="Measure memory held by jobsubmitter (slows submission down)",
+                        action='store_true')
+    parser.add_argument("--timeout", help="Give up after this many seconds", type=float, default=600)
+    parser.add_argument("--verbose", action='store_true')
+    return parser.parse_args(args)
+
+
+def load_messages(args) -> list[bytes]:
+    if args.messages:
+        with open(args.messages) as f:
+            return [line.strip().encode('utf-8') for line in f if line.strip()]
+
+    messages = []
+    for i in range(args.jobs):
+        message = json.loads(make_message(1))
+        message['pipeline_param']['id'] = f"INTP{i:08d}"
+        messages.append(json.dumps(message).encode('utf-8'))
+    return messages
+
+
+def percentile(values: list[float], p: float) -> float:
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1] if len(values) > 1 else values[0]
+
+
+def main(args=None):
+    args = parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    server = FakeApiServer(latency_ms=args.api_latency_ms, job_run_s=args.job_run_s)
+    server.start()
+    kubernetes.client.Configuration.set_default(kubernetes.client.Configuration(host=server.url))
+    apiclient.configure(qps=args.api_qps, burst=args.api_burst, pool_size=args.workers + 8)
+
+    kafka = InMemoryKafka()
+    consume.KafkaConsumer = kafka.consumer
+    status.KafkaProducer = kafka.producer
+
+    config.NAMESPACE = NAMESPACE
+    messages = load_messages(args)
+    if args.trace_memory:
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+
+    preload_templates()
+    reconcile_shared_cm()
+    index = SubmissionIndex()
+    index.seed()
+    pool = None
+    if args.pvc_pool_size:
+        pool = PVCPool(size=args.pvc_pool_size, refill_rate=args.pvc_pool_size * 6, period=1)
+        while pool.available < args.pvc_pool_size:  # start with a full pool
+            pool.refill()
+            time.sleep(0.1)
+        pool.start()
+    startup_requests = sum(server.requests.values())
+
+    latencies: list[float] = []
+    produced: dict[str, float] = {}
+
+    def timed_submit_job(params, client_id):
+        pipeline._submit_job(index, admission, params, client_id, pool)
+        latencies.append(time.monotonic() - produced[params['pipeline_param']['id']])
+
+    executor = SubmissionExecutor(timed_submit_job, workers=args.workers, max_in_flight=args.max_in_flight)
+    admission = AdmissionController(executor, limits={'jobs': args.max_active_jobs})
+    admission.start()
+
+    watch_kwargs = {'bootstrap_servers': [], 'mode': args.watch_mode, 'index': index, 'admission': admission,
+                    'publisher_config': {'coalesce_ms': 100}}
+    watch_thread = threading.Thread(target=job_watcher, kwargs=watch_kwargs, daemon=True)
+    watch_thread.start()
+
+    consumer = consume.create_consumer('bench', [], validation_engine=args.validation_engine)
+    threading.Thread(target=pipeline._consume, args=(consumer, executor, admission, index, 'bench', watch_thread),
+                     daemon=True).start()
+
+    start = time.monotonic()
+    for message in messages:
+        produced[json.loads(message).get('pipeline_param', {}).get('id')] = time.monotonic()
+        kafka.produce('pipeline-launch', message)
+        if args.rate:
+            time.sleep(1 / args.rate)
+
+    published: dict[str, float] = {}  # job name: time COMPLETED was published
+    n_jobs = len(messages)
+    while time.monotonic() - start < args.timeout:
+        for t, value in kafka.topics['pipeline-status'][len(published):]:
+            message = json.loads(value)
+            if message['status'] == 'COMPLETED':
+                published[message['pipeline_id']] = t
+        if len(published) >= n_jobs and len(latencies) >= n_jobs:
+            break
+        time.sleep(0.1)
+    elapsed = time.monotonic() - start
+
+    if args.trace_memory:
+        memory = sum(x.size_diff for x in tracemalloc.take_snapshot().compare_to(baseline, 'filename')
+                     if '/jobsubmitter/' in x.traceback[0].filename)
+        tracemalloc.stop()
+
+    jobs = server.objects('jobs', NAMESPACE)
+    lags = [published[job['metadata']['labels']['run-id']] - server.completed[name]
+            for name, job in jobs.items()
+            if name in server.completed and job['metadata']['labels']['run-id'] in published]
+    submission_requests = sum(n for (method, resource, verb), n in server.requests.items()
+                              if resource != 'jobs' or method != 'GET' or verb == 'object')
+    submission_requests -= startup_requests
+
+    print(f"jobs submitted          {len(latencies)} / {n_jobs} in {elapsed:.1f} s "
+          f"({len(latencies) / elapsed:.1f} jobs/s)")
+    if latencies:
+        print(f"submission latency      p50 {percentile(latencies, 50) * 1000:.1f} ms, "
+              f"p95 {percentile(latencies, 95) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms")
+        print(f"API calls per job       {submission_requests / len(latencies):.1f}")
+    if lags:
+        print(f"watcher detection lag   p50 {percentile(lags, 50) * 1000:.1f} ms, "
+              f"p95 {percentile(lags, 95) * 1000:.1f} ms, max {max(lags) * 1000:.1f} ms")
+    if args.trace_memory:
+        print(f"memory per 1k jobs      {memory / max(n_jobs, 1) * 1000 / 1024:.1f} KiB (held by jobsubmitter)")
+    print("API requests            " + ", ".join(f"{method} {resource} ({verb}): {n}"
+                                               for (method, resource, verb), n in sorted(server.requests.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+""" Benchmark the transfer engine (transfer/globus/transfer.py) against a local stand-in for a Globus collection
+
+Target genomes are random bytes served by FakeGlobusCollection, throttled per response to simulate a remote
+collection. Each configuration downloads every file to a new directory, and the files are checked byte for byte.
+With --fail_rate some responses are cut off part way, so downloads only finish by retrying and resuming. With
+--cache two runs of the same message download into a shared input cache: the second run shouldn't download anything.
+
+$ python benchmarks/bench_transfer.py --genomes 4 --pgen_mb 64 --bandwidth_mb 20
+$ python benchmarks/bench_transfer.py --fail_rate 0.2 --parallelism 8
+$ python benchmarks/bench_transfer.py --cache
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from fakes import FakeGlobusCollection
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'jobsubmitter', 'transfer', 'globus'))
+import transfer  # noqa: E402
+
+MB = 2 ** 20
+
+
+def make_files(genomes: int, pgen_mb: float) -> dict[str, bytes]:
+    files = {}
+    for i in range(genomes):
+        files[f"test/chr{i}.pgen"] = os.urandom(int(pgen_mb * MB))
+        files[f"test/chr{i}.pvar"] = os.urandom(int(pgen_mb * MB / 4))
+        files[f"test/chr{i}.psam"] = os.urandom(4096)
+    return files
+
+
+def make_message(genomes: int) -> dict:
+    target_genomes = [{"sampleset": "test", "chrom": str(i % 22 + 1),
+                       "pgen": f"chr{i}.pgen", "pvar": f"chr{i}.pvar", "psam": f"chr{i}.psam"}
+                      for i in range(genomes)]
+    return {"pipeline_param": {"id": "INTP00000001", "target_genomes": target_genomes},
+            "globus_details": {"dir_path_on_guest_collection": "test/",
+                               "guest_collection_id": "11111111-2222-3333-4444-555555555555"}}
+
+
+def run(collection: FakeGlobusCollection, message: dict, parallelism: int, chunk_mb: float, retries: int,
+        cache: transfer.Cache = None, run_id: str = '') -> float:
+    """ Download every file in message, check them, and return the elapsed seconds """
+    token = transfer.grab_access_token(f"{collection.url}/token", 'secret', 'collection')
+    with tempfile.TemporaryDirectory() as dest:
+        engine = transfer.Transfer(collection.url, token, dest, parallelism=parallelism,
+                                   chunk_size=int(chunk_mb * MB), retries=retries, backoff=0.05, cache=cache,
+                                   collection_id=message['globus_details']['guest_collection_id'], run_id=run_id)
+        start = time.monotonic()
+        engine.run(transfer.file_paths(message), message['globus_details']['dir_path_on_guest_collection'])
+        elapsed = time.monotonic() - start
+
+        files = os.path.join(cache.root, 'runs', run_id) if cache is not None else dest
+        for path, content in collection.files.items():
+            with open(os.path.join(files, os.path.basename(path)), 'rb') as f:
+                assert f.read() == content, f"{path} is corrupt"
+        with open(os.path.join(dest, transfer.LOG_PATH)) as f:
+            log = json.load(f)
+        assert log['status'] == 'complete'
+        assert all(x['status'] in ('complete', 'cached') for x in log['files'].values())
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--genomes", help="Number of target genomes (pgen, pvar and psam files)", type=int, default=4)
+    parser.add_argument("--pgen_mb", help="Size of each pgen file (pvar files are a quarter)", type=float, default=32)
+    parser.add_argument("--bandwidth_mb", help="MB/s per response (0 is unlimited)", type=float, default=20)
+    parser.add_argument("--latency_ms", help="Latency added to every request", type=float, default=20)
+    parser.add_argument("--fail_rate", help="Fraction of responses cut off part way", type=float, default=0)
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--chunk_mb", help="Range request size", type=float, default=8)
+    parser.add_argument("--retries", type=int, default=10)
+    parser.add_argument("--cache", help="Also run twice with a shared input cache", action='store_true')
+    args = parser.parse_args()
+
+    collection = FakeGlobusCollection(make_files(args.genomes, args.pgen_mb), bandwidth=args.bandwidth_mb * MB,
+                                      latency_ms=args.latency_ms, fail_rate=args.fail_rate)
+    collection.start()
+    message = make_message(args.genomes)
+    total = sum(len(x) for x in collection.files.values())
+
+    # serial whole-file downloads are what the old transfer.sh script did
+    configurations = {'serial': (1, float('inf')),
+                      'parallel files': (args.parallelism, float('inf')),
+                      'parallel chunks': (args.parallelism, args.chunk_mb)}
+    print(f"{total / MB:.0f} MB in {len(collection.files)} files")
+    print(f"{'configuration':>16} {'seconds':>8} {'MB/s':>8} {'requests':>9} {'served MB':>10}")
+    for name, (parallelism, chunk_mb) in configurations.items():
+        collection.requests.clear()
+        collection.served = 0
+        elapsed = run(collection, message, parallelism, min(chunk_mb, total / MB + 1), args.retries)
+        print(f"{name:>16} {elapsed:>8.2f} {total / MB / elapsed:>8.1f} {sum(collection.requests.values()):>9} "
+              f"{collection.served / MB:>10.1f}")
+
+    if args.cache:
+        with tempfile.TemporaryDirectory() as root:
+            cache = transfer.Cache(root)
+            for run_id in ('cold cache', 'warm cache'):
+                collection.requests.clear()
+                collection.served = 0
+                elapsed = run(collection, message, args.parallelism, args.chunk_mb, args.retries, cache, run_id)
+                print(f"{run_id:>16} {elapsed:>8.2f} {total / MB / elapsed:>8.1f} "
+                      f"{sum(collection.requests.values()):>9} {collection.served / MB:>10.1f}")
+    collection.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+""" Compare message decoding and validation with the jsonschema and fast (compiled) validation engines
+
+Synthetic messages have a growing number of target genomes in their samplesheet.
+
+$ python benchmarks/bench_validation.py --number 100 --sizes 1 10 100 1000
+"""
+import argparse
+import json
+import timeit
+
+from jobsubmitter.consume import _read_message
+from jobsubmitter.validate.schema import create_validator
+
+
+def make_message(n_genomes: int) -> bytes:
+    target_genomes = [{"sampleset": "test", "chrom": str(i % 22 + 1),
+                       "pgen": f"chr{i}.pgen", "pvar": f"chr{i}.pvar", "psam": f"chr{i}.psam"}
+                      for i in range(n_genomes)]
+    message = {"pipeline_param": {"id": "INTP00000001",
+                                  "nxf_work": "/workspace/work",
+                                  "nxf_params_file": {"pgs_id": "PGS001229", "target_build": "GRCh37"},
+                                  "target_genomes": target_genomes},
+               "globus_details": {"dir_path_on_guest_collection": "test/",
+                                  "guest_collection_id": "11111111-2222-3333-4444-555555555555"}}
+    return json.dumps(message).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", help="Iterations per benchmark", type=int, default=100)
+    parser.add_argument("--sizes", help="Number of target genomes per message", type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    validators = {engine: create_validator(engine) for engine in ['jsonschema', 'fast']}
+
+    print(f"{'target genomes':>14} {'jsonschema':>14} {'fast':>14} {'speedup':>8}")
+    for size in args.sizes:
+        message = make_message(size)
+        timings = {}
+        for engine, validator in validators.items():
+            assert _read_message(message, validator) != {}, f"{engine} rejected a valid message"
+            timings[engine] = timeit.timeit(lambda: _read_message(message, validator),
+                                            number=args.number) / args.number
+        print(f"{size:>14} {timings['jsonschema'] * 1000:>11.3f} ms {timings['fast'] * 1000:>11.3f} ms "
+              f"{timings['jsonschema'] / timings['fast']:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,598 @@
+""" Local stand-ins for a Kubernetes API server and a Kafka broker, for benchmarks
+
+FakeApiServer is a real HTTP server on localhost, so requests go through the kubernetes client, urllib3 connection
+pools and JSON (de)serialisation like they would against a cluster. It implements enough of the API for jobsubmitter:
+create / read / replace / patch (merge and JSON patches) / delete, label selector lists with pagination, collection
+deletes, and watches. Jobs start and complete on their own after a configurable delay. Every request can be delayed
+to simulate a remote API server.
+
+FakeGlobusCollection serves files over HTTP like a Globus guest collection's HTTPS server (bearer tokens, single
+byte ranges), and issues access tokens like auth.globus.org. Streams can be throttled, and a fraction of responses
+cut off part way through, to exercise the transfer engine's parallelism, retries and resume.
+
+InMemoryKafka provides consumer and producer classes with the parts of the kafka-python API that jobsubmitter uses.
+"""
+import collections
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from kafka import TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+_PATH = re.compile(r"^/(?:api/v1|apis/[^/]+/[^/]+)/namespaces/(?P<namespace>[^/]+)/(?P<resource>[^/]+)"
+                   r"(?:/(?P<name>[^/]+))?(?:/status)?$")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+_SELECTOR_TERMS = re.compile(r",(?![^()]*\))")  # commas outside the parentheses of set based terms
+_SET_TERM = re.compile(r"^(?P<key>\S+) (?P<op>in|notin) \((?P<values>[^)]*)\)$")
+
+
+def _matches(labels: dict, selector: str) -> bool:
+    """ Equality (a=b), inequality (a!=b), set based (a in (b,c), a notin (b,c)) and existence (a, !a) label
+    selectors """
+    for term in filter(None, _SELECTOR_TERMS.split(selector or '')):
+        term = term.strip()
+        set_term = _SET_TERM.match(term)
+        if set_term is not None:
+            values = {x.strip() for x in set_term['values'].split(',')}
+            if (labels.get(set_term['key']) in values) != (set_term['op'] == 'in'):
+                return False
+        elif '!=' in term:
+            k, v = term.split('!=')
+            if labels.get(k) == v:
+                return False
+        elif '=' in term:
+            k, v = term.split('=', 1)
+            if labels.get(k.rstrip('=')) != v:
+                return False
+        elif term.startswith('!'):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+def _merge(target: dict, patch: dict) -> dict:
+    """ JSON merge patch (strategic merge patches are treated the same) """
+    for k, v in patch.items():
+        if v is None:
+            target.pop(k, None)
+        elif isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = v
+    return target
+
+
+def _json_patch(target: dict, ops: list) -> dict:
+    """ JSON patch (RFC 6902) add, replace and remove operations """
+    for op in ops:
+        *parents, key = [x.replace('~1', '/').replace('~0', '~') for x in op['path'].lstrip('/').split('/')]
+        node = target
+        for parent in parents:
+            node = node[int(parent)] if isinstance(node, list) else node.setdefault(parent, {})
+        if op['op'] in ('add', 'replace'):
+            node[key] = op['value']
+        elif op['op'] == 'remove':
+            del node[key]
+        else:
+            raise ValueError(f"Unsupported JSON patch operation {op['op']}")
+    return target
+
+
+class FakeApiServer:
+    """ An in-memory Kubernetes API server """
+
+    def __init__(self, latency_ms: float = 0, job_start_s: float = 0.5, job_run_s: float = 2):
+        self.latency_ms = latency_ms
+        self.job_start_s = job_start_s
+        self.job_run_s = job_run_s
+        self._lock = threading.RLock()
+        self._objects: dict[tuple[str, str], dict[str, dict]] = collections.defaultdict(dict)
+        self._rv = itertools.count(1)
+        self._history: collections.deque = collections.deque(maxlen=100000)  # (rv, resource, namespace, event)
+        self._watchers: list[tuple[str, str, str, queue.Queue]] = []
+        self.requests: collections.Counter = collections.Counter()  # (method, resource, verb): count
+        self.completed: dict[str, float] = {}  # job name: time.monotonic() when the job completed
+        self.patches: list[tuple[str, str, str, object]] = []  # (resource, name, Content-Type, body) of PATCHes
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, name="fake-apiserver", daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def objects(self, resource: str, namespace: str) -> dict[str, dict]:
+        with self._lock:
+            return dict(self._objects[(resource, namespace)])
+
+    # --- storage -----------------------------------------------------------------------------------------------
+
+    def create(self, resource: str, namespace: str, obj: dict) -> tuple[int, dict]:
+        with self._lock:
+            meta = obj.setdefault('metadata', {})
+            if not meta.get('name'):
+                meta['name'] = meta['generateName'] + uuid.uuid4().hex[:5]
+            store = self._objects[(resource, namespace)]
+            if meta['name'] in store:
+                return 409, self._status(409, 'AlreadyExists', f"{resource} {meta['name']} already exists")
+            meta.update(namespace=namespace, uid=str(uuid.uuid4()), creationTimestamp=_now())
+            if resource in ('jobs', 'pods'):
+                obj.setdefault('status', {})
+            self._store(resource, namespace, obj, 'ADDED')
+
+        if resource == 'jobs':
+            threading.Thread(target=self._run_job, args=(namespace, meta['name']), daemon=True).start()
+        elif resource == 'pods':
+            threading.Thread(target=self._run_pod, args=(namespace, meta['name']), daemon=True).start()
+        return 201, obj
+
+    def replace(self, resource: str, namespace: str, name: str, obj: dict) -> tuple[int, dict]:
+        with self._lock:
+            old = self._objects[(resource, namespace)].get(name)
+            if old is None:
+                return 404, self._status(404, 'NotFound', f"{resource} {name} not found")
+            rv = obj.get('metadata', {}).get('resourceVersion')
+            if rv is not None and rv != old['metadata']['resourceVersion']:
+                return 409, self._status(409, 'Conflict', f"{resource} {name} has been modified")
+            for k in ('uid', 'creationTimestamp'):
+                obj['metadata'][k] = old['metadata'][k]
+            obj['metadata']['namespace'] = namespace
+            return 200, self._store(resource, namespace, obj, 'MODIFIED')
+
+    def patch(self, resource: str, namespace: str, name: str, patch: dict) -> tuple[int, dict]:
+        with self._lock:
+            old = self._objects[(resource, namespace)].get(name)
+            if old is None:
+                return 404, self._status(404, 'NotFound', f"{resource} {name} not found")
+            rv = patch.get('metadata', {}).get('resourceVersion')
+            if rv is not None and rv != old['metadata']['resourceVersion']:
+                return 409, self._status(409, 'Conflict', f"{resource} {name} has been modified")
+            return 200, self._store(resource, namespace, _merge(json.loads(json.dumps(old)), patch), 'MODIFIED')
+
+    def json_patch(self, resource: str, namespace: str, name: str, ops: list) -> tuple[int, dict]:
+        with self._lock:
+            old = self._objects[(resource, namespace)].get(name)
+            if old is None:
+                return 404, self._status(404, 'NotFound', f"{resource} {name} not found")
+            return 200, self._store(resource, namespace, _json_patch(json.loads(json.dumps(old)), ops), 'MODIFIED')
+
+    def delete(self, resource: str, namespace: str, name: str) -> tuple[int, dict]:
+        with self._lock:
+            obj = self._objects[(resource, namespace)].pop(name, None)
+            if obj is None:
+                return 404, self._status(404, 'NotFound', f"{resource} {name} not found")
+            self._event(resource, namespace, 'DELETED', obj)
+            # garbage collect owned objects, like the K8S garbage collector
+            uid = obj['metadata']['uid']
+            for (r, ns), store in list(self._objects.items()):
+                for n, o in list(store.items()):
+                    if any(x.get('uid') == uid for x in o['metadata'].get('ownerReferences') or []):
+                        self.delete(r, ns, n)
+            return 200, obj
+
+    def list(self, resource: str, namespace: str, selector: str, limit: int = None,
+             _continue: str = None) -> dict:
+        with self._lock:
+            items = [o for o in self._objects[(resource, namespace)].values()
+                     if _matches(o['metadata'].get('labels') or {}, selector)]
+            start = int(_continue) if _continue else 0
+            end = start + limit if limit else len(items)
+            meta = {'resourceVersion': str(next(self._rv))}
+            if end < len(items):
+                meta['continue'] = str(end)
+            return {'kind': 'List', 'apiVersion': 'v1', 'metadata': meta, 'items': items[start:end]}
+
+    def _store(self, resource: str, namespace: str, obj: dict, event: str) -> dict:
+        obj['metadata']['resourceVersion'] = str(next(self._rv))
+        self._objects[(resource, namespace)][obj['metadata']['name']] = obj
+        self._event(resource, namespace, event, obj)
+        return obj
+
+    def _event(self, resource: str, namespace: str, event: str, obj: dict) -> None:
+        line = json.dumps({'type': event, 'object': obj}) + '\n'
+        rv = int(obj['metadata']['resourceVersion']) if event != 'DELETED' else next(self._rv)
+        self._history.append((rv, resource, namespace, obj['metadata'].get('labels') or {}, line))
+        for r, ns, selector, q in list(self._watchers):
+            if r == resource and ns == namespace and _matches(obj['metadata'].get('labels') or {}, selector):
+                q.put(line)
+
+    @staticmethod
+    def _status(code: int, reason: str, message: str) -> dict:
+        return {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'code': code, 'reason': reason,
+                'message': message}
+
+    def _run_job(self, namespace: str, name: str) -> None:
+        time.sleep(self.job_start_s)
+        self.patch('jobs', namespace, name, {'status': {'startTime': _now(), 'active': 1}})
+        time.sleep(self.job_run_s)
+        status, _ = self.patch('jobs', namespace, name, {'status': {'succeeded': 1, 'active': None,
+                                                                    'completionTime': _now()}})
+        if status == 200:
+            self.completed[name] = time.monotonic()
+
+    def _run_pod(self, namespace: str, name: str) -> None:
+        self.patch('pods', namespace, name, {'status': {'phase': 'Pending'}})
+        time.sleep(self.job_start_s)
+        self.patch('pods', namespace, name, {'status': {'phase': 'Succeeded'}})
+
+    # --- HTTP --------------------------------------------------------------------------------------------------
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately: with Nagle's algorithm every request after the first on a
+            # keep-alive connection waits for a delayed ACK (about 40 ms)
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length)) if length else {}
+
+            def _reply(self, status: int, body: dict) -> None:
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self, method: str) -> None:
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                match = _PATH.match(url.path)
+                if match is None:
+                    return self._reply(404, server._status(404, 'NotFound', url.path))
+                namespace, resource, name = match.group('namespace', 'resource', 'name')
+
+                watch = query.get('watch', '').lower() == 'true'
+                verb = 'watch' if watch else ('collection' if name is None else 'object')
+                with server._lock:
+                    server.requests[(method, resource, verb)] += 1
+                if server.latency_ms and verb != 'watch':
+                    time.sleep(server.latency_ms / 1000)
+
+                if method == 'GET' and verb == 'watch':
+                    return self._watch(resource, namespace, query)
+                elif method == 'GET' and name is None:
+                    limit = int(query['limit']) if 'limit' in query else None
+                    return self._reply(200, server.list(resource, namespace, query.get('labelSelector'), limit,
+                                                        query.get('continue')))
+                elif method == 'GET':
+                    obj = server.objects(resource, namespace).get(name)
+                    if obj is None:
+                        return self._reply(404, server._status(404, 'NotFound', f"{resource} {name} not found"))
+                    return self._reply(200, obj)
+                elif method == 'POST':
+                    return self._reply(*server.create(resource, namespace, self._body()))
+                elif method == 'PUT':
+                    return self._reply(*server.replace(resource, namespace, name, self._body()))
+                elif method == 'PATCH':
+                    content_type = self.headers.get('Content-Type', '')
+                    body = self._body()
+                    with server._lock:
+                        server.patches.append((resource, name, content_type, body))
+                    if content_type == 'application/json-patch+json':
+                        if not isinstance(body, list):
+                            return self._reply(400, server._status(400, 'BadRequest', "a JSON patch is a list"))
+                        return self._reply(*server.json_patch(resource, namespace, name, body))
+                    return self._reply(*server.patch(resource, namespace, name, body))
+                elif method == 'DELETE' and name is None:
+                    self._body()
+                    for obj in server.list(resource, namespace, query.get('labelSelector'))['items']:
+                        server.delete(resource, namespace, obj['metadata']['name'])
+                    return self._reply(200, server._status(200, 'Success', 'deleted') | {'status': 'Success'})
+                elif method == 'DELETE':
+                    self._body()
+                    return self._reply(*server.delete(resource, namespace, name))
+
+            def _watch(self, resource: str, namespace: str, query: dict) -> None:
+                q: queue.Queue = queue.Queue()
+                selector = query.get('labelSelector')
+                since = int(query.get('resourceVersion') or 0)
+                watcher = (resource, namespace, selector, q)
+                with server._lock:
+                    for rv, r, ns, labels, line in server._history:
+                        if rv > since and r == resource and ns == namespace and _matches(labels, selector):
+                            q.put(line)
+                    server._watchers.append(watcher)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                deadline = time.monotonic() + int(query.get('timeoutSeconds') or 60)
+                try:
+                    while time.monotonic() < deadline:
+                        try:
+                            line = q.get(timeout=0.1).encode('utf-8')
+                        except queue.Empty:
+                            continue
+                        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with server._lock:
+                        server._watchers.remove(watcher)
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_POST(self):
+                self._route('POST')
+
+            def do_PUT(self):
+                self._route('PUT')
+
+            def do_PATCH(self):
+                self._route('PATCH')
+
+            def do_DELETE(self):
+                self._route('DELETE')
+
+        return Handler
+
+
+class FakeGlobusCollection:
+    """ Files served over HTTP with a bearer token, and a token endpoint (POST /token) """
+
+    TOKEN = 'fake-access-token'
+
+    def __init__(self, files: dict[str, bytes], bandwidth: float = 0, latency_ms: float = 0, fail_rate: float = 0,
+                 ranges: bool = True):
+        self.files = files  # path (without a leading /): content
+        self.bandwidth = bandwidth  # bytes per second per response, 0 is unlimited
+        self.latency_ms = latency_ms
+        self.fail_rate = fail_rate  # fraction of responses cut off half way
+        self.ranges = ranges
+        self.requests: collections.Counter = collections.Counter()  # path: count
+        self.served = 0  # body bytes sent
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, name="fake-globus", daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately: with Nagle's algorithm every request after the first on a
+            # keep-alive connection waits for a delayed ACK (about 40 ms)
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes = b'', headers: dict = None) -> None:
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                authorization = self.headers.get('Authorization', '')
+                if urlparse(self.path).path != '/token' or not authorization.startswith('Basic '):
+                    return self._reply(401)
+                self._reply(200, json.dumps({'access_token': server.TOKEN}).encode('utf-8'),
+                            {'Content-Type': 'application/json'})
+
+            def do_GET(self):
+                path = urlparse(self.path).path.lstrip('/')
+                with server._lock:
+                    server.requests[path] += 1
+                if server.latency_ms:
+                    time.sleep(server.latency_ms / 1000)
+                if self.headers.get('Authorization') != f"Bearer {server.TOKEN}":
+                    return self._reply(401)
+                content = server.files.get(path)
+                if content is None:
+                    return self._reply(404)
+
+                start, end, status = 0, len(content), 200
+                headers = {'Accept-Ranges': 'bytes'} if server.ranges else {}
+                match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get('Range', ''))
+                if server.ranges and match:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or len(content) - 1) + 1, len(content))
+                    if start >= len(content):
+                        return self._reply(416, headers={'Content-Range': f"bytes */{len(content)}"})
+                    status = 206
+                    headers['Content-Range'] = f"bytes {start}-{end - 1}/{len(content)}"
+                self._send(status, headers, content[start:end])
+
+            def _send(self, status: int, headers: dict, body: bytes) -> None:
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                # cut off half way through (the client sees a short read), or throttle to bandwidth
+                length = len(body) // 2 if body and random.random() < server.fail_rate else len(body)
+                block = max(int(server.bandwidth / 100), 1) if server.bandwidth else len(body) or 1
+                try:
+                    for i in range(0, length, block):
+                        self.wfile.write(body[i:min(i + block, length)])
+                        with server._lock:
+                            server.served += min(block, length - i)
+                        if server.bandwidth:
+                            time.sleep(block / server.bandwidth)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                if length < len(body):
+                    self.close_connection = True
+
+        return Handler
+
+
+class _Future:
+    """ A kafka-python FutureRecordMetadata that has already succeeded """
+
+    def add_callback(self, fn, *args, **kwargs):
+        fn(*args, None, **kwargs)
+        return self
+
+    def add_errback(self, fn, *args, **kwargs):
+        return self
+
+
+class InMemoryKafka:
+    """ Topics held in memory, with a single partition each """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self.topics: dict[str, list] = collections.defaultdict(list)  # topic: [(time.monotonic(), value)]
+        self.keys: dict[str, list] = collections.defaultdict(list)  # topic: [key], in the same order as topics
+        self.committed: dict[TopicPartition, int] = {}
+
+    def produce(self, topic: str, value, key: bytes = None) -> None:
+        with self._lock:
+            self.topics[topic].append((time.monotonic(), value))
+            self.keys[topic].append(key)
+            self._lock.notify_all()
+
+    def consumer(self, *topics, value_deserializer=None, consumer_timeout_ms: float = float('inf'), **kwargs):
+        consumer = _Consumer(self, value_deserializer, consumer_timeout_ms)
+        if topics:
+            consumer.subscribe(topics)
+        return consumer
+
+    def producer(self, value_serializer=None, **kwargs):
+        return _Producer(self, value_serializer)
+
+
+class _Consumer:
+    def __init__(self, kafka: InMemoryKafka, deserializer, timeout_ms: float):
+        self._kafka = kafka
+        self._tp = None
+        self._listener = None
+        self._deserialize = deserializer or (lambda v: v)
+        self._timeout = timeout_ms / 1000
+        self._position = 0
+        self._paused: set = set()
+
+    def subscribe(self, topics, listener=None) -> None:
+        self._tp = TopicPartition(topics[0], 0)
+        self._listener = listener
+        self.rebalance()
+
+    def rebalance(self) -> None:
+        """ Revoke the partition and assign it again, like a consumer group rebalance """
+        if self._listener is not None:
+            self._listener.on_partitions_revoked({self._tp})
+        self._position = self._kafka.committed.get(self._tp, 0)
+        if self._listener is not None:
+            self._listener.on_partitions_assigned({self._tp})
+
+    def topics(self) -> set[str]:
+        return set(self._kafka.topics) | {self._tp.topic}
+
+    def assignment(self) -> set[TopicPartition]:
+        return {self._tp}
+
+    def paused(self) -> set[TopicPartition]:
+        return set(self._paused)
+
+    def pause(self, *partitions) -> None:
+        self._paused |= set(partitions)
+
+    def resume(self, *partitions) -> None:
+        self._paused -= set(partitions)
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return len(self._kafka.topics[tp.topic])
+
+    def position(self, tp: TopicPartition) -> int:
+        return self._position
+
+    def committed(self, tp: TopicPartition) -> int:
+        return self._kafka.committed.get(tp)
+
+    def seek(self, tp: TopicPartition, offset: int) -> None:
+        with self._kafka._lock:
+            self._position = offset
+
+    def commit(self, offsets: dict[TopicPartition, OffsetAndMetadata] = None) -> None:
+        for tp, offset in (offsets or {}).items():
+            self._kafka.committed[tp] = offset.offset
+
+    def _take(self, max_records: int, timeout: float) -> list:
+        with self._kafka._lock:
+            records = self._kafka.topics[self._tp.topic]
+            if self._paused or self._position >= len(records):
+                self._kafka._lock.wait(timeout)
+            if self._paused:
+                return []
+            batch = records[self._position:self._position + max_records]
+            start, self._position = self._position, self._position + len(batch)
+        return [SimpleNamespace(topic=self._tp.topic, partition=0, offset=start + i, timestamp=t, headers=[],
+                                value=self._deserialize(v)) for i, (t, v) in enumerate(batch)]
+
+    def poll(self, timeout_ms: float = 0, max_records: int = 500) -> dict:
+        records = self._take(max_records, timeout_ms / 1000)
+        return {self._tp: records} if records else {}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        records = self._take(1, self._timeout)
+        if not records:
+            raise StopIteration
+        return records[0]
+
+
+class _Producer:
+    def __init__(self, kafka: InMemoryKafka, serializer):
+        self._kafka = kafka
+        self._serialize = serializer or (lambda v: v)
+
+    def bootstrap_connected(self) -> bool:
+        return True
+
+    def send(self, topic: str, value, key: bytes = None) -> _Future:
+        self._kafka.produce(topic, self._serialize(value), key)
+        return _Future()
+
+    def flush(self) -> None:
+        pass
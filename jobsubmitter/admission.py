@@ -0,0 +1,252 @@
+""" Admit launch requests only while the namespace has capacity for another job
+
+Every job requests the CPU and memory requests of its pod (see job/manifests/pgsc-job.yaml), and the storage request of
+its PVC, which is sized per run from its launch message (see transfer/sizing.py). Usage is counted from the job
+watcher's state (jobs that haven't finished), plus jobs that have been admitted but not seen by the watcher yet. Jobs
+this replica didn't admit (e.g. submitted before a restart) are counted with the default storage request. Limits are
+set explicitly, or read from the namespace ResourceQuotas, or both (the lowest limit wins).
+
+A request whose storage alone is over the storage limit could never be admitted, and would block every request queued
+behind it. It's rejected instead: its message is skipped and a FAILED status is published.
+
+Requests that don't fit are held in a priority queue (highest priority first, then first in first out). Once
+max_queued requests are held the consumer pauses its partitions, so excess work waits in Kafka rather than as half
+created Kubernetes objects.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from decimal import Decimal
+
+from kafka import TopicPartition
+from kubernetes.utils import parse_quantity
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import core_api
+from jobsubmitter.executor import SubmissionExecutor
+from jobsubmitter.job.base_manifests import base_job
+from jobsubmitter.metrics import ACTIVE_JOBS, ADMISSION_QUEUE
+from jobsubmitter.status import StatusPublisher
+from jobsubmitter.transfer.init_container import build_init_containers
+from jobsubmitter.transfer.sizing import pvc_size
+
+logger = logging.getLogger(__name__)
+
+RESOURCES = ('jobs', 'cpu', 'memory', 'storage')
+
+# ResourceQuota keys that limit jobs: each job has one Job object and one PVC
+_QUOTA_KEYS = {'count/jobs.batch': 'jobs',
+               'persistentvolumeclaims': 'jobs',
+               'cpu': 'cpu',
+               'requests.cpu': 'cpu',
+               'memory': 'memory',
+               'requests.memory': 'memory',
+               'requests.storage': 'storage'}
+
+
+def job_requests() -> dict[str, Decimal]:
+    """ The resources requested by one job, from the manifest templates """
+    pvc, _, init_containers = build_init_containers('', '')
+    containers = base_job().spec.template.spec.containers
+
+    requests = {'jobs': Decimal(1), 'storage': parse_quantity(pvc.spec.resources.requests['storage'])}
+    for resource in ('cpu', 'memory'):
+        # a pod's effective request: init containers run one at a time, before the containers
+        requests[resource] = max(sum(_container_request(x, resource) for x in containers),
+                                 max((_container_request(x, resource) for x in init_containers), default=0))
+    return requests
+
+
+def storage_request(params: dict) -> Decimal:
+    """ The storage requested by the transfer PVC of a launch message """
+    size, _ = pvc_size(params)
+    return parse_quantity(size)
+
+
+def _container_request(container, resource: str) -> Decimal:
+    if container.resources is None or not container.resources.requests:
+        return Decimal(0)
+    return parse_quantity(container.resources.requests.get(resource, 0))
+
+
+class AdmissionController:
+    """ Hold launch requests in a priority queue until there's capacity, then pass them to the executor """
+
+    def __init__(self, executor: SubmissionExecutor, limits: dict[str, Decimal] = None, quota: bool = False,
+                 quota_resync_period: int = 60, max_queued: int = 10, publisher: StatusPublisher = None):
+        self._executor = executor
+        self._publisher = publisher  # publishes the FAILED status of rejected requests, if it's set
+        self.limits: dict[str, Decimal] = {k: v for k, v in (limits or {}).items() if v is not None}
+        self.quota = quota
+        self.quota_resync_period = quota_resync_period
+        self.max_queued = max_queued
+        self.requests: dict[str, Decimal] = job_requests()
+        self._quota_limits: dict[str, Decimal] = {}
+        self._lock = threading.Condition()
+        self._queue: list[tuple] = []  # heap of (-priority, sequence, key, tp, offset, storage, args)
+        self._sequence = itertools.count()
+        # run id: (time submitted (time.monotonic()), None while submitting, and storage requested)
+        self._reserved: dict[str, tuple[float, Decimal]] = {}
+        self._observed: set[str] = set()  # run ids of unfinished jobs seen by the job watcher
+        self._synced = threading.Event()
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    @property
+    def saturated(self) -> bool:
+        """ True if the consumer should stop fetching messages """
+        return self.queued >= self.max_queued
+
+    @property
+    def active(self) -> int:
+        """ Number of unfinished jobs, including jobs being submitted """
+        with self._lock:
+            return len(self._reserved.keys() | self._observed)
+
+    def start(self) -> None:
+        if self.quota:
+            self.refresh_quota()
+            threading.Thread(target=self._quota_loop, name="admission-quota", daemon=True).start()
+        threading.Thread(target=self._dispatch_loop, name="admission", daemon=True).start()
+        logger.info(f"Admission controller started (job requests {self.requests}, limits {self._effective_limits()})")
+
+    def submit(self, key: str, tp: TopicPartition, offset: int, priority: int, *args, storage: Decimal = None) -> bool:
+        """ Queue a message until there's capacity for its job. Never blocks
+
+        storage is the job's storage request (see storage_request()), the default request if it isn't set. Returns
+        False if the request was rejected, because its storage is over the storage limit """
+        self._executor.hold(tp, offset)
+        if storage is None:
+            storage = self.requests['storage']
+        with self._lock:
+            if self._too_large(storage):
+                self._reject(key, tp, offset, storage)
+                return False
+            heapq.heappush(self._queue, (-priority, next(self._sequence), key, tp, offset, storage, args))
+            ADMISSION_QUEUE.set(len(self._queue))
+            self._lock.notify_all()
+        return True
+
+    def submitted(self, run_id: str) -> None:
+        """ The job's objects were created. It's counted until the job watcher sees it finish """
+        with self._lock:
+            if run_id in self._reserved:
+                self._reserved[run_id] = (time.monotonic(), self._reserved[run_id][1])
+
+    def release(self, run_id: str) -> None:
+        """ Stop counting a job, e.g. when it finished, was deleted or failed to submit """
+        with self._lock:
+            self._reserved.pop(run_id, None)
+            self._observed.discard(run_id)
+            self._changed()
+
+    def observe(self, run_id: str, status: str) -> None:
+        """ Update a job seen by the job watcher """
+        if status in ('completed', 'failed'):
+            self.release(run_id)
+        else:
+            with self._lock:
+                self._observed.add(run_id)
+                self._changed()
+
+    def sync(self, active: set[str], listed_at: float) -> None:
+        """ Replace the unfinished jobs seen by the job watcher with a full job list, started at listed_at
+
+        Submitted jobs that aren't in the list (missed finish or delete events) stop being counted """
+        with self._lock:
+            self._observed = set(active)
+            for run_id, (submitted_at, _) in list(self._reserved.items()):
+                if submitted_at is not None and submitted_at < listed_at and run_id not in active:
+                    del self._reserved[run_id]
+            self._changed()
+        self._synced.set()
+
+    def refresh_quota(self) -> None:
+        """ Read limits from the namespace ResourceQuotas, minus usage by anything other than watched jobs """
+        quotas = core_api().list_namespaced_resource_quota(config.NAMESPACE)
+        limits: dict[str, Decimal] = {}
+        with self._lock:
+            observed = self._usage(self._observed)
+            for quota in quotas.items:
+                for key, hard in (quota.status.hard or {}).items():
+                    resource = _QUOTA_KEYS.get(key)
+                    if resource is None:
+                        continue
+                    used = parse_quantity((quota.status.used or {}).get(key, 0))
+                    other = max(used - observed[resource], Decimal(0))
+                    limit = parse_quantity(hard) - other
+                    limits[resource] = min(limits.get(resource, limit), limit)
+            self._quota_limits = limits
+            self._lock.notify_all()
+        logger.debug(f"Quota limits: {limits}")
+
+    def _effective_limits(self) -> dict[str, Decimal]:
+        limits = dict(self.limits)
+        for resource, limit in self._quota_limits.items():
+            limits[resource] = min(limits.get(resource, limit), limit)
+        return limits
+
+    def _usage(self, run_ids: set[str]) -> dict[str, Decimal]:
+        """ Resources requested by jobs. Call with the lock held """
+        usage = {resource: len(run_ids) * request for resource, request in self.requests.items()}
+        usage['storage'] = sum((self._reserved[x][1] if x in self._reserved else self.requests['storage']
+                                for x in run_ids), Decimal(0))
+        return usage
+
+    def _fits(self, storage: Decimal) -> bool:
+        """ True if one more job, requesting storage, fits in the limits. Call with the lock held """
+        usage = self._usage(self._reserved.keys() | self._observed)
+        requests = self.requests | {'storage': storage}
+        return all(usage[resource] + requests[resource] <= limit
+                   for resource, limit in self._effective_limits().items())
+
+    def _too_large(self, storage: Decimal) -> bool:
+        """ True if a job requesting storage wouldn't fit even with no other jobs. Call with the lock held """
+        limit = self._effective_limits().get('storage')
+        return limit is not None and storage > limit
+
+    def _reject(self, key: str, tp: TopicPartition, offset: int, storage: Decimal) -> None:
+        """ Skip a request that can never be admitted, and publish that it failed. Call with the lock held """
+        logger.error(f"Rejecting {key}: its PVC requests {storage} bytes, over the storage limit "
+                     f"{self._effective_limits()['storage']}")
+        self._executor.skip(tp, offset)
+        if self._publisher is not None:
+            self._publisher.send(key, {'status': 'FAILED', 'pipeline_id': key, 'outdir': ""})
+
+    def _changed(self) -> None:
+        """ Call with the lock held """
+        ACTIVE_JOBS.set(len(self._reserved.keys() | self._observed))
+        self._lock.notify_all()
+
+    def _dispatch_loop(self) -> None:
+        self._synced.wait()  # count jobs that already exist before admitting anything
+        logger.info("Admitting launch requests")
+        while True:
+            with self._lock:
+                while not self._queue or not self._fits(self._queue[0][5]):
+                    # the storage limit can shrink while a request is queued (e.g. a ResourceQuota changed)
+                    while self._queue and self._too_large(self._queue[0][5]):
+                        _, _, key, tp, offset, storage, _ = heapq.heappop(self._queue)
+                        self._reject(key, tp, offset, storage)
+                        ADMISSION_QUEUE.set(len(self._queue))
+                    if not self._queue or not self._fits(self._queue[0][5]):
+                        self._lock.wait()
+                _, _, key, tp, offset, storage, args = heapq.heappop(self._queue)
+                self._reserved[key] = (None, storage)
+                self._changed()
+                ADMISSION_QUEUE.set(len(self._queue))
+            logger.debug(f"Admitted {key}")
+            self._executor.submit(key, tp, offset, *args)
+
+    def _quota_loop(self) -> None:
+        while True:
+            time.sleep(self.quota_resync_period)
+            try:
+                self.refresh_quota()
+            except Exception:
+                logger.error("Reading ResourceQuotas failed, retrying next period", exc_info=True)
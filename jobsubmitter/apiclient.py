@@ -0,0 +1,126 @@
+""" One Kubernetes API client shared by the submit and watch paths
+
+Every API call (kubernetes client APIs and hikaru CRUD methods, which take client=api_client()) goes through one
+ApiClient, so they share a urllib3 connection pool sized for the workers and background threads, and one client side
+rate limit:
+
+- requests take a token from a bucket holding up to burst tokens, refilled at qps tokens per second (like client-go)
+- 429 responses are retried, and 5xx responses to GET and HEAD requests (other requests might have been applied).
+  Retries wait for the Retry-After header if the API server sent one (API priority and fairness does), otherwise an
+  exponential backoff with full jitter, and take a token like any other request
+
+Connection errors (urllib3 MaxRetryError, ProtocolError) and timeouts aren't retried here. Background loops catch every
+exception, log it and try again next period, so a transient outage can't stop them.
+"""
+import logging
+import random
+import threading
+import time
+
+from kubernetes import client
+
+from jobsubmitter.metrics import API_RETRIES, API_THROTTLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_RETRY_SERVER_ERRORS = (500, 502, 503, 504)
+_IDEMPOTENT = ('GET', 'HEAD')
+_MAX_BACKOFF = 10
+
+_settings = {'qps': 20.0, 'burst': 40, 'pool_size': 16, 'retries': 3}
+_client: client.ApiClient = None
+_lock = threading.Lock()
+
+
+class TokenBucket:
+    """ Allow burst requests at once, then qps requests per second """
+
+    def __init__(self, qps: float, burst: int):
+        self.qps = qps
+        self.burst = burst
+        self._tokens: float = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """ Take a token, waiting until one is available. Returns the seconds waited """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.qps)
+            self._last = now
+            self._tokens -= 1  # negative tokens are reserved by waiting requests, so they're served in order
+            wait = -self._tokens / self.qps if self._tokens < 0 else 0
+        if wait:
+            API_THROTTLE_SECONDS.inc(wait)
+            time.sleep(wait)
+        return wait
+
+
+class RateLimitedApiClient(client.ApiClient):
+    """ An ApiClient that rate limits requests and retries throttled or failed requests """
+
+    def __init__(self, configuration: client.Configuration = None, qps: float = 20.0, burst: int = 40,
+                 retries: int = 3, backoff: float = 0.2):
+        super().__init__(configuration)
+        self.bucket = TokenBucket(qps, burst) if qps else None
+        self.retries = retries
+        self.backoff = backoff
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return super().request(method, url, *args, **kwargs)
+            except client.exceptions.ApiException as e:
+                if attempt >= self.retries or not (e.status == 429 or (e.status in _RETRY_SERVER_ERRORS and
+                                                                      method in _IDEMPOTENT)):
+                    raise
+                delay = self._delay(e, attempt)
+                attempt += 1
+                API_RETRIES.labels(str(e.status)).inc()
+                logger.debug(f"{method} {url} returned {e.status}, retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+    def _delay(self, e: client.exceptions.ApiException, attempt: int) -> float:
+        """ Seconds to wait before retrying: Retry-After if the API server sent it, otherwise jittered backoff """
+        retry_after = (e.headers or {}).get('Retry-After')
+        try:
+            return float(retry_after) + random.uniform(0, self.backoff)
+        except (TypeError, ValueError):  # missing, or an HTTP date (which the API server doesn't send)
+            return random.uniform(0, min(_MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+
+def configure(qps: float = 20.0, burst: int = 40, pool_size: int = 16, retries: int = 3) -> None:
+    """ Set up the shared client. Call after loading a kube config (kubernetes.config.load_*_config) """
+    global _client
+    with _lock:
+        _settings.update(qps=qps, burst=burst, pool_size=pool_size, retries=retries)
+        _client = None
+
+
+def api_client() -> client.ApiClient:
+    """ The shared client, created from the default kubernetes Configuration on first use """
+    global _client
+    with _lock:
+        if _client is None:
+            configuration = client.Configuration.get_default_copy()
+            configuration.connection_pool_maxsize = _settings['pool_size']
+            _client = RateLimitedApiClient(configuration, qps=_settings['qps'], burst=_settings['burst'],
+                                           retries=_settings['retries'])
+            logger.info(f"Kubernetes API client: {_settings['qps']} qps, burst {_settings['burst']}, "
+                        f"{_settings['pool_size']} connections")
+        return _client
+
+
+def batch_api() -> client.BatchV1Api:
+    return client.BatchV1Api(api_client())
+
+
+def core_api() -> client.CoreV1Api:
+    return client.CoreV1Api(api_client())
+
+
+def coordination_api() -> client.CoordinationV1Api:
+    return client.CoordinationV1Api(api_client())
@@ -0,0 +1,125 @@
+""" A checkpoint of the last status sent for each job, so a restarted watcher only publishes real transitions
+
+The checkpoint is a labelled ConfigMap (job name: status). Writes are batched: the watcher records changes with update()
+(only the jobs that changed are copied) or save() (after a full list), and a background thread writes the latest state
+at most once per interval, only if it changed. With leader election only the leader writes.
+
+Only statuses the status publisher confirmed delivering are written. A job with a message that's queued, in flight or
+failed keeps the status written before (if any), so a watcher restarted from the checkpoint sends it again rather
+than losing it. The watcher forgets jobs with failed messages while holding lock (see watch._forget_unsent), so a
+failed status is never mistaken for a delivered one.
+"""
+import logging
+import threading
+import time
+
+from kubernetes import client
+from hikaru.model.rel_1_21 import *
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import api_client
+
+logger = logging.getLogger(__name__)
+
+
+class WatchCheckpoint:
+    """ Store known jobs in a ConfigMap """
+
+    def __init__(self, name: str = 'jobsubmitter-watch-checkpoint', interval: int = 10, leader=None):
+        self.name = name
+        self.interval = interval
+        self.leader = leader  # a leader.LeaderElector, if replicas elect a leader
+        self.publisher = None  # a status.StatusPublisher, see start()
+        self.lock = threading.RLock()
+        self._state: dict[str, str] = {}  # the watcher's known jobs
+        self._changed = False
+        self._saved: dict[str, str] = None
+
+    def restore(self) -> dict[str, str]:
+        """ Read the last checkpoint, if one exists """
+        try:
+            cm: ConfigMap = ConfigMap().read(name=self.name, namespace=config.NAMESPACE, client=api_client())
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            logger.info("No watch checkpoint found")
+            return {}
+
+        known_jobs: dict[str, str] = dict(cm.data or {})
+        with self.lock:
+            self._state, self._changed = dict(known_jobs), False
+        self._saved = known_jobs
+        logger.info(f"Restored watch checkpoint ({len(known_jobs)} known jobs)")
+        return dict(known_jobs)
+
+    def save(self, known_jobs: dict[str, str]) -> None:
+        """ Replace the known jobs to be written with the next batch """
+        with self.lock:
+            self._state, self._changed = dict(known_jobs), True
+
+    def update(self, known_jobs: dict[str, str], names) -> None:
+        """ Copy the status of names from known jobs (or remove them, if they aren't known) to be written with the next
+        batch """
+        with self.lock:
+            for name in names:
+                if name in known_jobs:
+                    self._state[name] = known_jobs[name]
+                else:
+                    self._state.pop(name, None)
+            self._changed = True
+
+    def start(self, publisher=None) -> None:
+        """ Write checkpoints in the background. If publisher (a status.StatusPublisher) is set, only statuses it
+        confirmed delivering are written """
+        self.publisher = publisher
+        threading.Thread(target=self._flush_loop, name="checkpoint", daemon=True).start()
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self._changed:
+                return
+            known_jobs, self._changed = dict(self._state), False
+            unconfirmed = self.publisher.unconfirmed() & self._state.keys() if self.publisher is not None else set()
+
+        if unconfirmed:
+            # keep the status written before, until the latest one is delivered (and written with the next batch)
+            saved = self._saved or {}
+            known_jobs = {k: saved[k] if k in unconfirmed else v for k, v in known_jobs.items()
+                          if k not in unconfirmed or k in saved}
+            with self.lock:
+                self._changed = True
+        if known_jobs == self._saved:
+            return
+        if self.leader is not None and not self.leader.is_leader:
+            logger.debug("Not the leader, discarding watch checkpoint")
+            return
+
+        try:
+            self._write(known_jobs)
+        except Exception:
+            with self.lock:  # try again with the next batch
+                self._changed = True
+            raise
+        self._saved = known_jobs
+        logger.debug(f"Saved watch checkpoint ({len(known_jobs)} known jobs)")
+
+    def _write(self, known_jobs: dict[str, str]) -> None:
+        cm = ConfigMap(metadata=ObjectMeta(name=self.name,
+                                           namespace=config.NAMESPACE,
+                                           labels={'app': 'jobsubmitter', 'cm_type': 'checkpoint'}),
+                       data=known_jobs)
+        try:
+            # replaced, not patched: a patch merges data, so jobs removed from the checkpoint would never be deleted
+            cm.replaceNamespacedConfigMap(self.name, config.NAMESPACE, client=api_client())
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            cm.create(client=api_client())
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Saving watch checkpoint failed, retrying next interval", exc_info=True)
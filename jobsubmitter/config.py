@@ -1,2 +1,13 @@
 NAMESPACE = "intervene-dev"
-OUTPUT_BUCKET = "s3://intervene-dev"
\ No newline at end of file
+OUTPUT_BUCKET = "s3://intervene-dev"
+MANIFEST_DIR = None  # optional directory of manifests that override packaged manifests
+RELOAD_MANIFESTS = False
+# transfer PVC sizing, see transfer/sizing.py
+PVC_HEADROOM = 2.0  # space for the nextflow work directory, as a multiple of the input size
+PVC_BASE_SIZE = "10Gi"  # reference files, scoring files and logs
+PVC_MIN_SIZE = "10Gi"
+PVC_MAX_SIZE = None
+STORAGE_TIERS = "example-nfs-ssd"  # e.g. 100Gi=example-nfs-ssd,example-nfs-hdd
+# shared input cache, see transfer/cache.py
+INPUT_CACHE_PVC = None  # name of an existing ReadWriteMany PVC, None disables the cache
+INPUT_CACHE_BUDGET = None  # bytes of cached files kept, None is unlimited
@@ -1,8 +1,8 @@
 import json
 import logging
 
-import jsonschema
-from kafka import KafkaConsumer
+from kafka import ConsumerRebalanceListener, KafkaConsumer
+from jobsubmitter.metrics import VALIDATION_FAILURES, stage
 from jobsubmitter.validate.message import validate_message
 from jobsubmitter.validate.schema import create_validator
 
@@ -12,24 +12,56 @@ logger = logging.getLogger(__name__)
 
 def create_consumer(client_id: str, bs_servers: list[str],
                     topic: str = 'pipeline-launch',
-                    group: str = 'jobsubmitter') -> KafkaConsumer:
-    """Create a Kafka consumer that reads and validates JSON job requests """
-    validator = create_validator()
+                    group: str = 'jobsubmitter',
+                    consumer_timeout_ms: int = 1000,
+                    validation_engine: str = 'jsonschema',
+                    batch: bool = False,
+                    listener: ConsumerRebalanceListener = None,
+                    **fetch_config) -> KafkaConsumer:
+    """Create a Kafka consumer that reads and validates JSON job requests
 
-    return KafkaConsumer(topic,
-                         client_id=client_id,
-                         group_id=group,
-                         bootstrap_servers=bs_servers,
-                         value_deserializer=lambda m: _read_message(m, validator),
-                         enable_auto_commit=True)
+    Offsets are committed manually once jobs are submitted. Iteration stops after consumer_timeout_ms without
+    messages, so the caller can commit while idle.
 
+    In batch mode message values are raw bytes, to be validated together with read_batch(). listener (e.g. an
+    executor.RebalanceListener) is called when partitions are revoked or assigned. fetch_config is passed to KafkaConsumer
+    (e.g. fetch_max_bytes) """
+    if batch:
+        deserializer = None
+    else:
+        validator = create_validator(validation_engine)
+        deserializer = lambda m: _read_message(m, validator)
 
-def _read_message(m: bytes, validator: jsonschema.Draft202012Validator) -> dict:
+    consumer = KafkaConsumer(client_id=client_id,
+                             group_id=group,
+                             bootstrap_servers=bs_servers,
+                             value_deserializer=deserializer,
+                             enable_auto_commit=False,
+                             consumer_timeout_ms=consumer_timeout_ms,
+                             **fetch_config)
+    consumer.subscribe([topic], listener=listener)
+    return consumer
+
+
+def read_batch(values: list[bytes], validator) -> list[dict]:
+    """ Decode and validate the JSON content of a batch of messages, one by one and in order """
+    messages = [_read_message(m, validator) for m in values]
+    logger.debug(f"Validated batch of {len(messages)} messages ({messages.count({})} invalid)")
+    return messages
+
+
+def _read_message(m: bytes, validator) -> dict:
     """ Decode and validate the JSON content of a message """
-    try:
-        message = json.loads(m.decode('utf-8'))
-        logger.debug("Valid JSON decoded")
-        return validate_message(message, validator)
-    except (json.decoder.JSONDecodeError, UnicodeDecodeError):
-        logger.error("Invalid JSON", exc_info=True)
-        return json.loads('{}')
+    with stage('decode_validate'):
+        try:
+            message = json.loads(m.decode('utf-8'))
+            logger.debug("Valid JSON decoded")
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            logger.error("Invalid JSON", exc_info=True)
+            VALIDATION_FAILURES.labels('invalid_json').inc()
+            return json.loads('{}')
+
+        message = validate_message(message, validator)
+        if message == {}:
+            VALIDATION_FAILURES.labels('invalid_schema').inc()
+        return message
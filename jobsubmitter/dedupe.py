@@ -0,0 +1,94 @@
+""" An index of pipeline run ids that already have a Job, to drop redelivered or duplicated launch messages
+
+The index is seeded at startup from a label selector list of Jobs, kept current by the job watcher, and checked
+before anything is submitted. Checks are O(1) and don't call the K8S API.
+
+A run id discarded after a failed submission is tombstoned for TOMBSTONE_TTL seconds: the rolled back Job's watch
+events (or a list taken before it was deleted) can arrive after the discard, and mustn't add the run id back, or the
+redelivered message would be dropped as a duplicate with no Job submitted. Claiming the run id again clears it.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from jobsubmitter.apiclient import batch_api
+from jobsubmitter.watch import job_selector, list_jobs
+
+logger = logging.getLogger(__name__)
+
+TOMBSTONE_TTL = 600  # seconds, longer than a rolled back Job's events take to arrive
+
+
+class SubmissionIndex:
+    """ A set of run ids, optionally bounded (least recently used are evicted first) with entries that expire """
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, float] = OrderedDict()  # run id: time added
+        self._tombstones: OrderedDict[str, float] = OrderedDict()  # run id: time discarded
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, run_id: str) -> bool:
+        with self._lock:
+            return self._get(run_id)
+
+    def add(self, run_id: str) -> None:
+        """ Add the run id of a Job that exists, unless its submission failed and was discarded """
+        with self._lock:
+            if self._tombstoned(run_id):
+                logger.debug(f"Not adding {run_id} to submission index, its submission was rolled back")
+                return
+            self._add(run_id)
+
+    def claim(self, run_id: str) -> bool:
+        """ Add a run id, unless it's already in the index. Returns True if the caller should submit the run """
+        with self._lock:
+            if self._get(run_id):
+                return False
+            self._tombstones.pop(run_id, None)
+            self._add(run_id)
+            return True
+
+    def discard(self, run_id: str) -> None:
+        """ Remove a run id, e.g. after a failed submission, so it can be submitted again """
+        with self._lock:
+            self._entries.pop(run_id, None)
+            self._tombstones[run_id] = time.monotonic()
+            self._tombstones.move_to_end(run_id)
+
+    def seed(self, page_size: int = 100) -> None:
+        """ Add the run id of every Job in the namespace """
+        api_client = batch_api()
+        for page in list_jobs(api_client, job_selector(), page_size):
+            for job in page.items:
+                self.add(job.metadata.labels['run-id'])
+        logger.info(f"Submission index seeded with {len(self)} run ids")
+
+    def _get(self, run_id: str) -> bool:
+        added = self._entries.get(run_id)
+        if added is None:
+            return False
+        if self.ttl is not None and time.monotonic() - added > self.ttl:
+            del self._entries[run_id]
+            return False
+        self._entries.move_to_end(run_id)
+        return True
+
+    def _tombstoned(self, run_id: str) -> bool:
+        expired = time.monotonic() - TOMBSTONE_TTL
+        while self._tombstones and next(iter(self._tombstones.values())) < expired:
+            self._tombstones.popitem(last=False)
+        return run_id in self._tombstones
+
+    def _add(self, run_id: str) -> None:
+        self._entries[run_id] = time.monotonic()
+        self._entries.move_to_end(run_id)
+        if self.max_size is not None and len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            logger.debug(f"Evicted {evicted} from submission index")
@@ -0,0 +1,222 @@
+""" Submit jobs concurrently from a bounded pool of worker threads
+
+Messages that share a key (the pipeline run id) are always handled by the same worker, so they're submitted in the
+order they were consumed. Kafka offsets are tracked per partition and only offsets where every earlier message has
+finished are committable.
+
+A message whose submission fails is never committed: its partition stops committing at its offset, and the consumer
+seeks back to it (see rewinds()) after a backoff, so it's delivered and submitted again. Later messages of the
+partition are delivered again too, and dropped by the submission index. After retries failed attempts the message is
+given up on and committed, so one bad message can't block its partition forever. When partitions are revoked their
+tracking is reset (see RebalanceListener).
+"""
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from kafka import ConsumerRebalanceListener, TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetTracker:
+    """ Track in-flight messages for each partition to find offsets that are safe to commit
+
+    Offsets can arrive in any order: a message is delivered again after a seek or a rebalance, possibly while the
+    first delivery is still being handled. Each offset counts the deliveries that haven't finished """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[TopicPartition, dict[int, int]] = {}  # offset: unfinished deliveries
+        self._redeliver: set[tuple[TopicPartition, int]] = set()  # failed offsets held until they're delivered again
+
+    def add(self, tp: TopicPartition, offset: int) -> None:
+        with self._lock:
+            if (tp, offset) in self._redeliver:  # takes over the failed delivery's count
+                self._redeliver.discard((tp, offset))
+                return
+            pending = self._pending.setdefault(tp, {})
+            pending[offset] = pending.get(offset, 0) + 1
+
+    def done(self, tp: TopicPartition, offset: int) -> None:
+        with self._lock:
+            pending = self._pending.get(tp, {})
+            if pending.get(offset):
+                pending[offset] -= 1
+
+    def failed(self, tp: TopicPartition, offset: int) -> None:
+        """ Keep a failed offset (and every later offset) uncommittable until the message is delivered again """
+        with self._lock:
+            self._redeliver.add((tp, offset))
+
+    def reset(self, partitions) -> None:
+        """ Forget everything tracked for partitions that were revoked. Deliveries still in flight finish as no-ops """
+        with self._lock:
+            for tp in partitions:
+                self._pending.pop(tp, None)
+            self._redeliver = {(tp, offset) for tp, offset in self._redeliver if tp not in partitions}
+
+    def committable(self) -> dict[TopicPartition, OffsetAndMetadata]:
+        """ Get the next offset to commit for partitions where a completed prefix of messages has grown """
+        offsets: dict[TopicPartition, OffsetAndMetadata] = {}
+        with self._lock:
+            for tp, pending in self._pending.items():
+                next_offset = None
+                for offset in sorted(pending):
+                    if pending[offset]:
+                        break
+                    del pending[offset]
+                    next_offset = offset + 1
+                if next_offset is not None:
+                    offsets[tp] = OffsetAndMetadata(next_offset, None)
+        return offsets
+
+
+class SubmissionExecutor:
+    """ Run a submission function on a pool of workers, with a bounded number of messages in flight
+
+    submit() blocks when max_in_flight messages are queued or running, which stops the consumer fetching more """
+
+    def __init__(self, fn, workers: int = 1, max_in_flight: int = 10, retries: int = 5, retry_backoff: float = 2):
+        self._fn = fn
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.retry_backoff = retry_backoff  # seconds before the first retry, doubled for each retry (up to a minute)
+        self._attempts: dict[tuple[TopicPartition, int], int] = {}  # failed attempts of messages being retried
+        self._rewinds: dict[TopicPartition, tuple[int, float]] = {}  # offset to seek back to, and when
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lanes: list[queue.Queue] = [queue.Queue() for _ in range(workers)]
+        self._offsets = OffsetTracker()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        for i, lane in enumerate(self._lanes):
+            threading.Thread(target=self._work, args=(lane,), name=f"submitter-{i}", daemon=True).start()
+
+        logger.info(f"Submission executor started ({workers} workers, {max_in_flight} messages in flight)")
+
+    @property
+    def queue_depth(self) -> int:
+        """ Number of messages queued or running """
+        with self._lock:
+            return self._in_flight
+
+    @property
+    def saturated(self) -> bool:
+        """ True if submit() would block """
+        return self.queue_depth >= self.max_in_flight
+
+    def submit(self, key: str, tp: TopicPartition, offset: int, *args) -> None:
+        """ Queue a message held with hold() for submission. Messages with the same key are submitted in order """
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+        lane: queue.Queue = self._lanes[zlib.crc32(key.encode('utf-8')) % len(self._lanes)]
+        lane.put((tp, offset, args))
+
+    def hold(self, tp: TopicPartition, offset: int) -> None:
+        """ Track a message that will be submitted later, so offsets after it aren't committable until it's done """
+        self._offsets.add(tp, offset)
+
+    def skip(self, tp: TopicPartition, offset: int) -> None:
+        """ Mark a message that won't be submitted (e.g. failed validation) as complete """
+        with self._lock:
+            self._attempts.pop((tp, offset), None)
+        self._offsets.add(tp, offset)
+        self._offsets.done(tp, offset)
+
+    def committable(self) -> dict[TopicPartition, OffsetAndMetadata]:
+        return self._offsets.committable()
+
+    def rewinds(self) -> dict[TopicPartition, int]:
+        """ Get the offsets the consumer should seek back to, so failed messages are delivered again """
+        now = time.monotonic()
+        with self._lock:
+            due = {tp: offset for tp, (offset, at) in self._rewinds.items() if at <= now}
+            for tp in due:
+                del self._rewinds[tp]
+        return due
+
+    def revoke(self, partitions) -> None:
+        """ Forget offsets, retries and rewinds of partitions that were revoked: their new owner consumes them from
+        the last committed offset """
+        partitions = set(partitions)
+        with self._lock:
+            for tp in partitions:
+                self._rewinds.pop(tp, None)
+            self._attempts = {k: v for k, v in self._attempts.items() if k[0] not in partitions}
+        self._offsets.reset(partitions)
+
+    def join(self) -> None:
+        """ Block until every queued message has been processed """
+        for lane in self._lanes:
+            lane.join()
+
+    def _work(self, lane: queue.Queue) -> None:
+        while True:
+            tp, offset, args = lane.get()
+            try:
+                self._fn(*args)
+            except Exception:
+                logger.error(f"Submission failed ({tp.topic}-{tp.partition} offset {offset})", exc_info=True)
+                self._retry(tp, offset)
+            else:
+                with self._lock:
+                    self._attempts.pop((tp, offset), None)
+                self._offsets.done(tp, offset)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                self._slots.release()
+                lane.task_done()
+
+    def _retry(self, tp: TopicPartition, offset: int) -> None:
+        """ Seek back to a failed message after a backoff, or give up on it after too many attempts """
+        with self._lock:
+            attempts = self._attempts.get((tp, offset), 0) + 1
+            if attempts > self.retries:
+                self._attempts.pop((tp, offset), None)
+            else:
+                self._attempts[(tp, offset)] = attempts
+                at = time.monotonic() + min(60.0, self.retry_backoff * 2 ** (attempts - 1))
+                earliest, _ = self._rewinds.get(tp, (offset, at))
+                self._rewinds[tp] = (min(earliest, offset), at)
+        if attempts > self.retries:
+            logger.error(f"Giving up on {tp.topic}-{tp.partition} offset {offset} after {attempts} failed attempts")
+            self._offsets.done(tp, offset)
+        else:
+            self._offsets.failed(tp, offset)
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+    """ Reset submission tracking for revoked partitions, and consume assigned partitions from their committed offset
+
+    Without this, offsets, retries and rewinds of a partition that moved to another consumer stay tracked: a failed
+    offset would block commits if the partition came back, and a rewind would seek it to a stale offset.
+
+    The consumer connects while the executor is created, so the listener is bound to both with bind(). Callbacks only
+    run inside poll, after that """
+
+    def __init__(self):
+        self._consumer = None
+        self._executor = None
+
+    def bind(self, consumer, executor: SubmissionExecutor) -> None:
+        self._consumer = consumer
+        self._executor = executor
+
+    def on_partitions_revoked(self, revoked) -> None:
+        if revoked:
+            logger.info(f"Partitions revoked: {sorted(revoked)}")
+            self._executor.revoke(revoked)
+
+    def on_partitions_assigned(self, assigned) -> None:
+        for tp in assigned:
+            offset = self._consumer.committed(tp)
+            if offset is not None:
+                logger.info(f"Partition {tp.topic}-{tp.partition} assigned, consuming from offset {offset}")
+                self._consumer.seek(tp, offset)
+
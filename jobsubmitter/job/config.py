@@ -1,13 +1,18 @@
+import hashlib
 import json
 import logging
 import os
+import time
 
 from kubernetes import client
 from hikaru.model.rel_1_21 import *
 
 from jobsubmitter import config
+from jobsubmitter.apiclient import api_client
 from jobsubmitter.job.base_manifests import base_executor, base_configmap
 from jobsubmitter.job.nextflowconfigfile import NextflowConfigFile
+from jobsubmitter.transfer import cache
+from jobsubmitter.transfer.sizing import GENOME_FILES
 
 logging.getLogger('kubernetes').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
@@ -15,46 +20,71 @@ logger = logging.getLogger(__name__)
 
 def make_cm_vol(params: dict[str, dict],
                 client_id: str,
-                pvc_vol: Volume) -> tuple[ConfigMap, Volume]:
-    """ Create a volume from parameter and executor ConfigMaps """
-    cm = _make_parameter_cm(params, client_id)
-    result: Response = cm.createNamespacedConfigMap(namespace=config.NAMESPACE)
-    cm.metadata.name = result.obj.metadata.name  # update name metadata with generated name
+                pvc_vol: Volume,
+                name: str) -> tuple[ConfigMap, Volume]:
+    """ Make a volume from merged parameter and executor ConfigMaps. The ConfigMap isn't created in the cluster. """
+    cm = _make_parameter_cm(params, client_id, name)
 
-    logger.debug("Merging k8s execution configuration and updating")
+    logger.debug("Merging k8s execution configuration")
     cm.merge(_make_executor_cm(pvc_vol))
     cm.immutable = True
-    cm.update()
 
-    return cm, Volume(name='config', configMap=ConfigMapVolumeSource(name=result.obj.metadata.name))
+    return cm, Volume(name='config', configMap=ConfigMapVolumeSource(name=name))
 
 
 def adopt_object(job: Job, object) -> None:
-    """ Set the parent of the object to the job instance that requires it.
+    """ Set the parent of the object to the job instance that requires it, before the object is created.
 
      This simplifies k8s garbage collection once the job instance deletes itself."""
-    logger.debug(f"Patching {object.metadata.name} (adopted by Job {job.metadata.name})")
+    logger.debug(f"{object.metadata.name} adopted by Job {job.metadata.name}")
     ow: OwnerReference = OwnerReference(apiVersion=job.apiVersion,
                                         kind="Job",
                                         name=job.metadata.name,
                                         uid=job.metadata.uid)
     object.metadata.ownerReferences = [ow]  # must be a list!
-    object.update()
 
 
-def make_shared_cm() -> None:
-    """ Ensure the shared ConfigMap is provisioned in the namespace
+def reconcile_shared_cm() -> None:
+    """ Ensure the shared ConfigMap is provisioned in the namespace and matches the packaged manifest
+
+    The ConfigMap describes environment variables shared across all job instances. The live object is only written
+    if it's missing or its content has drifted. Updates are conditional on the resourceVersion that was read, so a
+    concurrent update fails (409) and is retried on the next resync instead of being overwritten """
+    cm: ConfigMap = base_configmap()
+    desired: str = _content_hash(cm)
 
-    The ConfigMap describes environment variables shared across all job instances """
     try:
-        cm: ConfigMap = base_configmap()
-        cm.update(namespace=config.NAMESPACE)  # always synchronise shared configmap
-    except client.exceptions.ApiException:
+        live: ConfigMap = ConfigMap().read(name=cm.metadata.name, namespace=config.NAMESPACE, client=api_client())
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
         logger.debug("Creating base configmaps")
-        cm.create(namespace=config.NAMESPACE)
+        cm.create(namespace=config.NAMESPACE, client=api_client())
+        return
+
+    if _content_hash(live) == desired:
+        logger.debug(f"Shared ConfigMap {cm.metadata.name} is up to date")
+    else:
+        logger.info(f"Shared ConfigMap {cm.metadata.name} has drifted, updating")
+        cm.metadata.resourceVersion = live.metadata.resourceVersion
+        cm.update(namespace=config.NAMESPACE, client=api_client())
+
+
+def shared_cm_reconciler(resync_period: int = 300) -> None:
+    """ Reconcile the shared ConfigMap every resync_period seconds (one read while nothing has drifted) """
+    while True:
+        time.sleep(resync_period)
+        try:
+            reconcile_shared_cm()
+        except Exception:
+            logger.error("Shared ConfigMap reconciliation failed, retrying next resync", exc_info=True)
+
+
+def _content_hash(cm: ConfigMap) -> str:
+    return hashlib.sha256(json.dumps(cm.data, sort_keys=True).encode('utf-8')).hexdigest()
 
 
-def _make_cm_meta(client_id: str, params: dict[str, str]) -> ObjectMeta:
+def _make_cm_meta(client_id: str, params: dict[str, str], name: str) -> ObjectMeta:
     """ Create a metadata object for the ConfigMap """
     labels: dict = {'app': 'nextflow',
                     'submitter': client_id,
@@ -63,10 +93,10 @@ def _make_cm_meta(client_id: str, params: dict[str, str]) -> ObjectMeta:
 
     return ObjectMeta(labels=labels,
                       namespace=config.NAMESPACE,
-                      generateName='nxf-vol-')
+                      name=name)
 
 
-def _make_parameter_cm(params, client_id) -> ConfigMap:
+def _make_parameter_cm(params, client_id, name: str) -> ConfigMap:
     """ Create a parameter ConfigMap, unique to each pipeline run instance.
 
      The created ConfigMap desribes _what_ the nextflow pipeline will execute.
@@ -76,13 +106,15 @@ def _make_parameter_cm(params, client_id) -> ConfigMap:
         - What input data to use
         - Pipeline settings such as LiftOver
      """
-    # prepend the PVC mount path to the paths in the message
+    # prepend the PVC mount path to the paths in the message, or point at the run's files in the input cache
     # TODO: dynamically set PVC mount path (/workspace)
     target_genomes = []
     for file in params['target_genomes']:
         d = {}
         for k, v in file.items():
-            if 'path' in k:
+            if cache.enabled() and k in GENOME_FILES and v:
+                v = cache.run_path(params['id'], v)
+            elif 'path' in k:
                 v = os.path.join('/workspace', v)
             d.update({k: v})
         target_genomes.append(d)
@@ -92,7 +124,7 @@ def _make_parameter_cm(params, client_id) -> ConfigMap:
 
     file_dict: dict[str, str] = {'input.json': json.dumps(target_genomes),
                                  'params.json': json.dumps(nxf_params)}
-    meta = _make_cm_meta(client_id, params)
+    meta = _make_cm_meta(client_id, params, name)
     return ConfigMap(data=file_dict, metadata=meta, immutable=False)
 
 
@@ -107,6 +139,8 @@ def _make_executor_cm(pvc_vol: Volume) -> ConfigMap:
      """
     execution_params = {'k8s.storageClaimName': f"'{pvc_vol.persistentVolumeClaim.claimName}'",
                         'k8s.namespace': f"'{config.NAMESPACE}'" }
+    if cache.enabled():  # worker pods read target genomes from the input cache
+        execution_params['process.pod'] = cache.pod_directive()
     cm: ConfigMap = base_executor()
     configfile: NextflowConfigFile = NextflowConfigFile(cm.data['k8s.config'])
     cm.data['k8s.config'] = configfile.update(execution_params).data
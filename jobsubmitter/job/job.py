@@ -5,70 +5,101 @@ from hikaru.model.rel_1_21 import *
 
 from jobsubmitter import config
 from jobsubmitter.job.base_manifests import base_job
-from jobsubmitter.job.config import make_cm_vol, adopt_object
+from jobsubmitter.job.config import make_cm_vol
+from jobsubmitter.job.plan import SubmissionPlan, name_suffix
+from jobsubmitter.metrics import SUBMISSION_SECONDS, stage
 
+from jobsubmitter.transfer import cache
 from jobsubmitter.transfer.init_container import build_init_containers
+from jobsubmitter.transfer.sizing import pvc_size
 
 logging.getLogger('kubernetes').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
-def submit_job(params, client_id) -> None:
-    """ Create the Job object and set the ConfigMap parent """
+def submit_job(params, client_id, pool=None) -> None:
+    """ Create the Job object and its auxiliary objects, owned by the Job """
+    with SUBMISSION_SECONDS.time():
+        plan: SubmissionPlan = plan_job(params, client_id, pool)
+        plan.execute()
+
+
+def plan_job(params, client_id, pool=None) -> SubmissionPlan:
+    """ Build the Job and every object it needs locally, without calling the K8S API
+
+    The exception is claiming a PVC from pool (a transfer.pool.PVCPool), if it's set """
     cm: ConfigMap
     job: Job
+    suffix: str = name_suffix()
 
-    # create configmap for transfer initContainer
-    transfer_cm = _make_transfer_cm(params)
+    # configmap for transfer initContainer
+    with stage('transfer_cm'):
+        transfer_cm = _make_transfer_cm(params, f"transfer-{suffix}")
 
-    # get a list of initcontainers, and assign the new configmap
-    volume, init_containers = build_init_containers(transfer_cm.metadata.name)
+    # get a PVC sized for the target genomes and list of initcontainers, and assign the new configmap
+    with stage('init_containers'):
+        size, storage_class = pvc_size(params)
+        pvc, volume, init_containers = build_init_containers(transfer_cm.metadata.name, f"transfer-{suffix}", pool,
+                                                             f"pgsc-calc-{suffix}", size, storage_class)
 
-    # create configmap for main job, and add the transfer volume
-    cm, job = _populate_job_instance(params['pipeline_param'], client_id, volume)
+    # configmap for main job, and add the transfer volume
+    cm, job = _populate_job_instance(params['pipeline_param'], client_id, volume, suffix)
     job.spec.template.spec.initContainers = init_containers
 
+    # a claimed pooled PVC already exists, and isn't owned by the job
+    owned = [cm, transfer_cm] + ([pvc] if pvc is not None else [])
+    # so the orphan sweeper can find objects of a failed submission (see sweeper.py)
+    for obj in owned:
+        obj.metadata.labels = obj.metadata.labels | {'run-id': params['pipeline_param']['id'],
+                                                     'job-name': job.metadata.name}
+    return SubmissionPlan(job, owned)
 
-    job.create(namespace=config.NAMESPACE)
-    logger.debug(f"Submitted job {job.metadata.name} to K8S")
 
-    # set job as owner of auxiliary objects (configmap / pvc)
-    # when job dies, these objects must die too
-    pvc = PersistentVolumeClaim().read(name=volume.persistentVolumeClaim.claimName, namespace=config.NAMESPACE)
-    [adopt_object(job, x) for x in [cm, transfer_cm, pvc]]
-
-
-def _make_transfer_cm(params: dict) -> ConfigMap:
+def _make_transfer_cm(params: dict, name: str) -> ConfigMap:
     """ The transfer config map sets the globus source endpoint ID and the local destination
 
     - The local destination must be the mountPath of the attached PVC
     - local_dest must have read / write permissions for the globus-client user
     - the volume-mount-hack initContainer fixes PVC permissions
     """
-    meta = ObjectMeta(namespace=config.NAMESPACE, generateName="transfer-", labels={'app': 'transfer'})
+    meta = ObjectMeta(namespace=config.NAMESPACE, name=name, labels={'app': 'transfer', 'cm_type': 'transfer'})
     globus_base_url = "https://g-1504d5.dd271.03c0.data.globus.org" if config.NAMESPACE == "dev" else "https://g-8b9225.dd271.03c0.data.globus.org"
     d = {'GLOBUS_GUEST_COLLECTION_ID': params['globus_details']['guest_collection_id'],
          'GLOBUS_BASE_URL': globus_base_url,
          'JOB_MESSAGE': json.dumps(params)}
+    if cache.enabled():
+        d['INPUT_CACHE_DIR'] = cache.CACHE_MOUNT_PATH
+        if config.INPUT_CACHE_BUDGET is not None:
+            d['INPUT_CACHE_BUDGET'] = str(config.INPUT_CACHE_BUDGET)
     cm = ConfigMap(immutable=True, metadata=meta, data=d)
-    logger.info(f"Creating transfer configmap: {d}")
-    cm.create()
+    logger.info(f"Making transfer configmap: {d}")
     return cm
 
-def _populate_job_instance(params: dict, client_id: str,pvc_vol: Volume) -> tuple[ConfigMap, Job]:
+
+def _populate_job_instance(params: dict, client_id: str, pvc_vol: Volume, suffix: str) -> tuple[ConfigMap, Job]:
     """ Populate a loaded base job instance with parameters from Kafka """
     nxf_job: Job = base_job()
+    nxf_job.metadata.name = f"pgsc-calc-{suffix}"
     cm: ConfigMap
     cm_vol: Volume
-    cm, cm_vol = make_cm_vol(params, client_id, pvc_vol)
+    with stage('cm_vol'):
+        cm, cm_vol = make_cm_vol(params, client_id, pvc_vol, f"nxf-vol-{suffix}")
     volumes = nxf_job.spec.template.spec.volumes
     # set up persistent data shared across transfer initContainer + job
     volumes[0] = pvc_vol
     # mount config map too
     volumes[1] = cm_vol
+    # target genomes are read from the input cache, if it's enabled
+    if cache.enabled():
+        cache_mount, cache_vol = cache.cache_volume(read_only=True)
+        volumes.append(cache_vol)
+        nxf_job.spec.template.spec.containers[0].volumeMounts.append(cache_mount)
 
     # TODO: add version to parameters, update consumer ID?
-    nxf_job.metadata.labels = nxf_job.metadata.labels | {'run-id': params['id'], 'version': '1.3'}
+    nxf_job.metadata.labels = nxf_job.metadata.labels | {'run-id': params['id'], 'version': '1.3',
+                                                         'submitter': client_id}
+    pod_meta = nxf_job.spec.template.metadata
+    pod_meta.labels = pod_meta.labels | {'run-id': params['id']}
 
     return cm, nxf_job
 
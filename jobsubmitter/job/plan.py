@@ -0,0 +1,132 @@
+""" A planned submission: every object a pipeline run needs, built locally before anything is created.
+
+Object names are set client side, so the Job can reference its ConfigMaps and PVC before they exist. The Job is
+created first, then each auxiliary object is created once with the Job already set as its owner. That's one API call
+per object, and no read or update round trips.
+
+The Job's pod waits (FailedMount / unbound PVC) until the auxiliary objects exist, which takes milliseconds.
+
+Objects are created with the raw kubernetes client and the response isn't deserialised into models (hikaru's create()
+does that, and it costs about 100 ms of CPU per object while holding the GIL). Only the created object's metadata is
+read back.
+
+If any create fails the submission is rolled back: every object created so far is deleted, so a Job missing its
+ConfigMaps or PVC isn't left pending forever. Objects a rollback can't delete are garbage collected with the Job, or
+deleted by the orphan sweeper (see sweeper.py).
+"""
+import json
+import logging
+import secrets
+
+from hikaru import get_clean_dict
+from hikaru.model.rel_1_21 import *
+from kubernetes import client
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import batch_api, core_api
+from jobsubmitter.job.config import adopt_object
+from jobsubmitter.metrics import SUBMISSION_ROLLBACKS, api_call, stage
+
+logger = logging.getLogger(__name__)
+
+# the same alphabet the API server uses for generateName, no vowels means no accidental words
+_SUFFIX_ALPHABET = "bcdfghjklmnpqrstvwxz2456789"
+
+
+def name_suffix(length: int = 8) -> str:
+    """ A random suffix for object names, like the API server would generate """
+    return ''.join(secrets.choice(_SUFFIX_ALPHABET) for _ in range(length))
+
+
+class SubmissionPlan:
+    """ A Job and the auxiliary objects (ConfigMaps, PVC) that it owns """
+
+    def __init__(self, job: Job, owned: list):
+        self.job = job
+        self.owned = owned
+        self.api_calls: int = 0  # API calls made by execute()
+
+    def execute(self) -> None:
+        """ Create the Job, then create each owned object with its ownerReference already set. If anything fails,
+        the objects created so far are deleted before the exception is raised """
+        created: list = []
+        try:
+            self._create(self.job, created)
+            logger.debug(f"Submitted job {self.job.metadata.name} to K8S")
+
+            # set job as owner of auxiliary objects (configmap / pvc)
+            # when job dies, these objects must die too
+            for obj in self.owned:
+                with stage('adopt'):
+                    adopt_object(self.job, obj)
+                self._create(obj, created)
+                logger.debug(f"Created {obj.kind} {obj.metadata.name}")
+        except Exception:
+            self.rollback(created)
+            raise
+
+        logger.info(f"Job {self.job.metadata.name} submitted in {self.api_calls} API calls")
+
+    def _create(self, obj, created: list) -> None:
+        """ Create obj, and add it to created if it might exist """
+        operation = f"create_{obj.kind.lower()}"
+        self.api_calls += 1
+        try:
+            with stage(operation), api_call(operation):
+                metadata = create_object(obj)
+        except Exception as e:
+            if not isinstance(e, client.exceptions.ApiException) or e.status >= 500:
+                created.append(obj)  # e.g. a timeout, the API server might have created it
+            raise
+        obj.metadata.uid = metadata['uid']  # read by adopt_object
+        obj.metadata.resourceVersion = metadata.get('resourceVersion')
+        created.append(obj)
+
+    def rollback(self, created: list) -> None:
+        """ Delete created objects, newest first. Failures are logged: the Job's owned objects are garbage collected
+        if it's deleted, and the orphan sweeper deletes anything else """
+        if not created:
+            return
+        logger.warning(f"Submission of job {self.job.metadata.name} failed, deleting {len(created)} created objects")
+        result = 'complete'
+        for obj in reversed(created):
+            try:
+                delete_object(obj.kind, obj.metadata.name)
+                self.api_calls += 1
+            except Exception:
+                logger.error(f"Deleting {obj.kind} {obj.metadata.name} failed", exc_info=True)
+                result = 'failed'
+        SUBMISSION_ROLLBACKS.labels(result).inc()
+
+
+def create_object(obj) -> dict:
+    """ Create a Job, ConfigMap or PersistentVolumeClaim, and return the created object's metadata """
+    body: dict = get_clean_dict(obj)
+    if obj.kind == 'Job':
+        response = batch_api().create_namespaced_job(config.NAMESPACE, body, _preload_content=False)
+    elif obj.kind == 'ConfigMap':
+        response = core_api().create_namespaced_config_map(config.NAMESPACE, body, _preload_content=False)
+    elif obj.kind == 'PersistentVolumeClaim':
+        response = core_api().create_namespaced_persistent_volume_claim(config.NAMESPACE, body,
+                                                                         _preload_content=False)
+    else:
+        raise ValueError(f"Can't create a {obj.kind}")
+    return json.loads(response.data)['metadata']
+
+
+def delete_object(kind: str, name: str) -> None:
+    """ Delete a Job (and everything it owns), ConfigMap or PersistentVolumeClaim, if it exists """
+    operation = f"delete_{kind.lower()}"
+    try:
+        with api_call(operation):
+            if kind == 'Job':
+                batch_api().delete_namespaced_job(name, config.NAMESPACE, propagation_policy='Background')
+            elif kind == 'ConfigMap':
+                core_api().delete_namespaced_config_map(name, config.NAMESPACE)
+            elif kind == 'PersistentVolumeClaim':
+                core_api().delete_namespaced_persistent_volume_claim(name, config.NAMESPACE)
+            else:
+                raise ValueError(f"Can't delete a {kind}")
+    except client.exceptions.ApiException as e:
+        if e.status != 404:
+            raise
@@ -0,0 +1,117 @@
+""" Lease based leader election, so one replica publishes job status while every replica consumes launch messages
+
+Replicas compete for a coordination.k8s.io Lease. The holder renews it every renew_period seconds. Other replicas
+take over once the Lease hasn't changed for lease_duration seconds, measured on their own clock (like client-go, so
+clock skew between nodes doesn't matter). Writes are conditional on the resourceVersion that was read, so only one
+replica can take over an expired Lease. A leader that can't renew for renew_deadline seconds (for any reason,
+including connection errors) stops leading before anyone else can take over. Requests time out after renew_period,
+so a hung connection can't keep the leader from stepping down.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from kubernetes import client
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import coordination_api
+from jobsubmitter.metrics import IS_LEADER, api_call
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElector:
+    """ Hold a Lease while this replica is the leader """
+
+    def __init__(self, identity: str, name: str = 'jobsubmitter-watcher', lease_duration: int = 15,
+                 renew_deadline: float = None, renew_period: float = None):
+        self.identity = identity
+        self.name = name
+        self.lease_duration = lease_duration
+        self.renew_deadline = renew_deadline or lease_duration * 2 / 3
+        self.renew_period = renew_period or lease_duration / 7
+        assert self.renew_period < self.renew_deadline < self.lease_duration
+        self._leading = threading.Event()
+        self._renewed: float = 0  # time.monotonic() of the last successful renewal
+        self._observed: tuple = None  # (holder, renew time) of the Lease when it last changed
+        self._observed_at: float = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leading.is_set()
+
+    def start(self) -> None:
+        threading.Thread(target=self._elect_loop, name="leader-election", daemon=True).start()
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Block until this replica is the leader. Returns False if timeout expired first """
+        return self._leading.wait(timeout)
+
+    def try_acquire(self) -> bool:
+        """ Create, renew or take over the Lease. Returns True if this replica holds it """
+        api = coordination_api()
+        now = datetime.now(timezone.utc)
+        try:
+            with api_call('read_lease'):
+                lease = api.read_namespaced_lease(self.name, config.NAMESPACE,
+                                                   _request_timeout=self.renew_period)
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            lease = client.V1Lease(metadata=client.V1ObjectMeta(name=self.name, namespace=config.NAMESPACE,
+                                                                labels={'app': 'jobsubmitter'}),
+                                   spec=client.V1LeaseSpec(holder_identity=self.identity, acquire_time=now,
+                                                           renew_time=now, lease_duration_seconds=self.lease_duration,
+                                                           lease_transitions=0))
+            with api_call('create_lease'):
+                api.create_namespaced_lease(config.NAMESPACE, lease, _request_timeout=self.renew_period)
+            return True
+
+        spec = lease.spec
+        observed = (spec.holder_identity, spec.renew_time)
+        if observed != self._observed:
+            self._observed, self._observed_at = observed, time.monotonic()
+
+        if spec.holder_identity != self.identity:
+            if spec.holder_identity and time.monotonic() - self._observed_at < (spec.lease_duration_seconds or
+                                                                                  self.lease_duration):
+                return False  # held by another replica
+            logger.info(f"Lease {self.name} held by {spec.holder_identity} expired, taking over")
+            spec.holder_identity = self.identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.renew_time = now
+        spec.lease_duration_seconds = self.lease_duration
+
+        with api_call('replace_lease'):
+            # 409 if anyone else wrote it first
+            api.replace_namespaced_lease(self.name, config.NAMESPACE, lease, _request_timeout=self.renew_period)
+        return True
+
+    def _elect_loop(self) -> None:
+        while True:
+            try:
+                acquired = self.try_acquire()
+            except Exception as e:  # e.g. an API error, or a connection error or timeout
+                if not (isinstance(e, client.exceptions.ApiException) and e.status == 409):
+                    logger.error(f"Acquiring lease {self.name} failed", exc_info=True)
+                acquired = None  # unknown, try again and step down once renew_deadline passes
+
+            if acquired:
+                self._renewed = time.monotonic()
+                self._set_leading(True)
+            elif acquired is False or time.monotonic() - self._renewed > self.renew_deadline:
+                self._set_leading(False)
+            time.sleep(self.renew_period)
+
+    def _set_leading(self, leading: bool) -> None:
+        if leading == self.is_leader:
+            return
+        if leading:
+            logger.info(f"{self.identity} is the leader (lease {self.name})")
+            self._leading.set()
+        else:
+            logger.warning(f"{self.identity} stopped leading (lease {self.name})")
+            self._leading.clear()
+        IS_LEADER.set(int(leading))
@@ -0,0 +1,109 @@
+""" Prometheus metrics for the submission and watch paths
+
+prometheus_client is optional (poetry install -E metrics). Without it every metric is a no-op, so instrumented code
+doesn't need to check.
+
+Submission stages (jobsubmitter_stage_seconds):
+
+- decode_validate: decode and validate a launch message
+- transfer_cm, init_containers, cm_vol: build the transfer ConfigMap, PVC + initContainers, and the job ConfigMap
+- create_job: create the Job
+- adopt: set the Job as the owner of an auxiliary object
+- create_configmap, create_persistentvolumeclaim: create an auxiliary object
+"""
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+except ImportError:
+    start_http_server = None
+
+    class _NoopMetric:
+        """ Accepts (and ignores) the prometheus_client metric methods used here """
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def labels(self, *args, **kwargs):
+            return self
+
+        def time(self):
+            return contextlib.nullcontext()
+
+        def observe(self, amount):
+            pass
+
+        def inc(self, amount=1):
+            pass
+
+        def set(self, value):
+            pass
+
+    Counter = Gauge = Histogram = _NoopMetric
+
+# API calls take milliseconds to seconds, the default buckets stop at 10 s
+_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram('jobsubmitter_stage_seconds', 'Time spent in each submission stage', ['stage'],
+                          buckets=_BUCKETS)
+SUBMISSION_SECONDS = Histogram('jobsubmitter_submission_seconds', 'Time to build and create every object of a job',
+                               buckets=_BUCKETS)
+VALIDATION_FAILURES = Counter('jobsubmitter_validation_failures_total', 'Launch messages that failed validation',
+                              ['reason'])
+SUBMISSION_ROLLBACKS = Counter('jobsubmitter_submission_rollbacks_total',
+                               'Failed submissions whose created objects were deleted (complete) or not (failed)',
+                               ['result'])
+ORPHANS_DELETED = Counter('jobsubmitter_orphans_deleted_total', 'Unowned objects of failed submissions deleted',
+                          ['kind'])
+API_ERRORS = Counter('jobsubmitter_api_errors_total', 'Kubernetes API errors', ['operation', 'status'])
+API_RETRIES = Counter('jobsubmitter_api_retries_total', 'Kubernetes API requests retried after a 429 or 5xx',
+                      ['status'])
+API_THROTTLE_SECONDS = Counter('jobsubmitter_api_throttle_seconds_total',
+                               'Time requests waited for the client side API rate limit')
+CONSUMER_LAG = Gauge('jobsubmitter_consumer_lag', 'Messages in a partition not yet fetched by the consumer',
+                     ['topic', 'partition'])
+WATCH_LOOP_SECONDS = Histogram('jobsubmitter_watch_loop_seconds',
+                               'Time to process a job list (list) or a watch event (event)', ['operation'],
+                               buckets=_BUCKETS)
+ADMISSION_QUEUE = Gauge('jobsubmitter_admission_queue', 'Launch requests waiting for capacity')
+ACTIVE_JOBS = Gauge('jobsubmitter_active_jobs', 'Unfinished jobs counted by admission, including jobs being submitted')
+PVC_POOL_SIZE = Gauge('jobsubmitter_pvc_pool_size', 'Target number of warming and available pooled PVCs')
+PVC_POOL_REFILL_RATE = Gauge('jobsubmitter_pvc_pool_refill_rate', 'Maximum pooled PVCs created per minute')
+PVC_POOL = Gauge('jobsubmitter_pvc_pool', 'Pooled PVCs in each state', ['state'])
+PVC_POOL_CLAIMS = Counter('jobsubmitter_pvc_pool_claims_total', 'Attempts to claim a pooled PVC', ['result'])
+READY = Gauge('jobsubmitter_ready', '1 once the consumer, producer and K8S client are ready')
+IS_LEADER = Gauge('jobsubmitter_is_leader', '1 if this replica holds the watcher lease and publishes job status')
+JOB_PHASES = Gauge('jobsubmitter_job_phases', 'Running jobs in each phase, from their pods', ['phase'])
+STUCK_JOBS = Counter('jobsubmitter_stuck_jobs_total', 'Jobs failed for missing a phase deadline', ['phase'])
+STATUS_PUBLISH_LAG = Histogram('jobsubmitter_status_publish_lag_seconds',
+                               'Time from a job finishing to its status being published',
+                               buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+
+
+def start_server(port: int) -> None:
+    """ Serve metrics on http://0.0.0.0:port/metrics """
+    if start_http_server is None:
+        logger.warning("prometheus_client isn't installed, metrics are disabled")
+        return
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
+
+
+def stage(name: str):
+    """ Time a submission stage, e.g. with stage('create_job'): ... """
+    return STAGE_SECONDS.labels(name).time()
+
+
+@contextlib.contextmanager
+def api_call(operation: str):
+    """ Count Kubernetes API errors raised in the block """
+    from kubernetes.client.exceptions import ApiException  # kubernetes is imported in the background at startup
+
+    try:
+        yield
+    except ApiException as e:
+        API_ERRORS.labels(operation, str(e.status)).inc()
+        raise
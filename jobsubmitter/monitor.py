@@ -0,0 +1,179 @@
+""" Monitor the pods of started jobs, publish what they're doing and fail jobs that are stuck
+
+The job watcher publishes STARTED once a Job starts. The monitor lists the Job's pod every period and publishes
+finer grained states until the Job finishes:
+
+- QUEUED: the pod is pending, e.g. waiting to be scheduled, for its PVC to bind or for an image to pull. Also once the
+  initContainers have finished, until the driver container runs (e.g. pulling its image, or in CrashLoopBackOff)
+- TRANSFERRING: the initContainers are staging target genomes (see transfer/init_container.py), until the last one
+  terminates
+- RUNNING: the nextflow driver is running
+
+Each state has an optional deadline, measured from timestamps in the pod status (so they survive restarts). A Job
+past a deadline, or with a container restarted more than max_restarts times, is failed by setting its
+activeDeadlineSeconds: the job controller kills its pod and the watcher publishes FAILED. Its transfer PVC is deleted
+as well, so storage is released without waiting for ttlSecondsAfterFinished.
+
+With leader election only the leader monitors pods. Published states aren't checkpointed, so a restarted or new
+leader publishes the current state of every running job once.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from kubernetes import client
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import batch_api, core_api
+from jobsubmitter.metrics import JOB_PHASES, STUCK_JOBS, WATCH_LOOP_SECONDS, api_call
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('queued', 'transferring', 'running')
+POD_SELECTOR = 'app=nextflow,run-id,job-name'  # driver pods of pgsc-calc jobs, not nextflow worker pods
+
+
+class PodMonitor:
+    """ Publish the phase of each running job, and fail jobs that stay in a phase for longer than its deadline """
+
+    def __init__(self, deadlines: dict[str, float] = None, max_restarts: int = None, period: int = 15,
+                 page_size: int = 100, leader=None):
+        self.deadlines: dict[str, float] = {k: v for k, v in (deadlines or {}).items() if v is not None}
+        self.max_restarts = max_restarts
+        self.period = period
+        self.page_size = page_size
+        self.leader = leader
+        self._producer = None
+        self._sent: dict[str, str] = {}  # job name: last phase published
+        self._failed: set[str] = set()  # job names failed by the monitor, while their pods terminate
+
+    def start(self, producer) -> None:
+        """ Monitor pods in a background thread, publishing with producer (a status.StatusPublisher) """
+        self._producer = producer
+        threading.Thread(target=self._monitor_loop, name="pod-monitor", daemon=True).start()
+
+    def check(self) -> None:
+        """ List driver pods, publish phase changes and fail stuck jobs """
+        api = core_api()
+        now = datetime.now(timezone.utc)
+        seen: dict[str, str] = {}  # job name: phase, of unfinished jobs
+        listed: set[str] = set()
+        counts = dict.fromkeys(PHASES, 0)
+
+        _continue = None
+        while True:
+            with api_call('list_pods'):
+                page = api.list_namespaced_pod(config.NAMESPACE, label_selector=POD_SELECTOR, limit=self.page_size,
+                                               _continue=_continue)
+            for pod in page.items:
+                job_name = pod.metadata.labels['job-name']
+                listed.add(job_name)
+                phase, since, reason = pod_phase(pod)
+                if phase is None or pod.metadata.deletion_timestamp is not None or job_name in self._failed:
+                    continue  # finished or finishing, the watcher publishes COMPLETED or FAILED
+                seen[job_name] = phase
+                counts[phase] += 1
+
+                if self._sent.get(job_name) != phase:
+                    logger.info(f"Job {job_name} is {phase}" + (f" ({reason})" if reason else ""))
+                    self._producer.send(job_name, {'status': phase.upper(),
+                                                   'pipeline_id': pod.metadata.labels['run-id'],
+                                                   'outdir': ""}, source='monitor')
+                    self._sent[job_name] = phase
+
+                stuck = self._stuck(pod, phase, (now - since).total_seconds())
+                if stuck:
+                    self._fail(api, pod, job_name, phase, stuck)
+                    self._failed.add(job_name)
+            _continue = page.metadata._continue
+            if not _continue:
+                break
+
+        self._sent = {k: v for k, v in self._sent.items() if k in seen}
+        self._failed &= listed
+        for phase, count in counts.items():
+            JOB_PHASES.labels(phase).set(count)
+
+    def _stuck(self, pod, phase: str, elapsed: float) -> str:
+        """ Why a job should be failed, or None """
+        deadline = self.deadlines.get(phase)
+        if deadline is not None and elapsed > deadline:
+            return f"{phase} for {elapsed:.0f}s, deadline {deadline:.0f}s"
+        if self.max_restarts is not None:
+            statuses = (pod.status.init_container_statuses or []) + (pod.status.container_statuses or [])
+            restarts = max((x.restart_count for x in statuses), default=0)
+            if restarts > self.max_restarts:
+                return f"{restarts} container restarts, maximum {self.max_restarts}"
+        return None
+
+    def _fail(self, api, pod, job_name: str, phase: str, reason: str) -> None:
+        """ Fail the job (the job controller kills its pod), and delete its transfer PVC """
+        logger.warning(f"Job {job_name} is stuck ({reason}), failing it")
+        STUCK_JOBS.labels(phase).inc()
+        try:
+            with api_call('patch_job'):
+                # a JSON patch: the client sends any patch body as application/json-patch+json
+                batch_api().patch_namespaced_job(job_name, config.NAMESPACE,
+                                                 [{'op': 'add', 'path': '/spec/activeDeadlineSeconds', 'value': 1}])
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            return
+
+        # the PVC is deleted once the pod stops using it (the pvc-protection finalizer)
+        for volume in pod.spec.volumes or []:
+            claim = volume.persistent_volume_claim
+            if claim is not None and claim.claim_name != config.INPUT_CACHE_PVC:
+                try:
+                    with api_call('delete_persistentvolumeclaim'):
+                        api.delete_namespaced_persistent_volume_claim(claim.claim_name, config.NAMESPACE)
+                except client.exceptions.ApiException as e:
+                    if e.status != 404:
+                        raise
+
+    def _monitor_loop(self) -> None:
+        while True:
+            if self.leader is not None and not self.leader.is_leader:
+                self._sent = {}
+                self.leader.wait(self.period)
+                continue
+            try:
+                with WATCH_LOOP_SECONDS.labels('pods').time():
+                    self.check()
+            except Exception:
+                logger.error("Monitoring pods failed, retrying next period", exc_info=True)
+            time.sleep(self.period)
+
+
+def pod_phase(pod) -> tuple[str, datetime, str]:
+    """ The phase of a job's pod, when the phase started and why it's waiting (if it is). The phase is None if the
+    pod finished """
+    status = pod.status
+    if status.phase in ('Succeeded', 'Failed'):
+        return None, None, None
+
+    for container in status.container_statuses or []:
+        if container.state.running is not None:
+            return 'running', container.state.running.started_at, None
+
+    # transferring from when the first initContainer started, until the last one terminated. After that the driver
+    # is queued (e.g. pulling its image, or in CrashLoopBackOff) until it runs
+    init_containers = status.init_container_statuses or []
+    if init_containers and (init_containers[0].state.running or init_containers[0].state.terminated) \
+            and init_containers[-1].state.terminated is None:
+        first = init_containers[0].state
+        return 'transferring', (first.running or first.terminated).started_at, None
+    if init_containers and init_containers[-1].state.terminated is not None:
+        since = init_containers[-1].state.terminated.finished_at
+    else:
+        since = pod.metadata.creation_timestamp
+
+    reason = None
+    for condition in status.conditions or []:
+        if condition.type == 'PodScheduled' and condition.status == 'False':
+            reason = condition.reason + (f": {condition.message}" if condition.message else "")
+    for container in (status.init_container_statuses or []) + (status.container_statuses or []):
+        if container.state.waiting is not None and container.state.waiting.reason not in (None, 'PodInitializing'):
+            reason = container.state.waiting.reason
+    return 'queued', since, reason
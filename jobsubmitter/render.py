@@ -0,0 +1,182 @@
+""" Render the K8S objects of recorded launch messages offline, without a cluster or a Kafka broker
+
+Each message is decoded and validated like the consumer does (consume._read_message), then every object of its
+submission is built (job.job.plan_job: the Job, its parameter, executor and transfer ConfigMaps, PVC and
+initContainers) and serialised. Messages are spread across a process pool and the manifests are streamed, in input
+order, to stdout or one file per message. Object names get random suffixes, like they do when submitting.
+
+Throughput and the per-message cost of each stage are reported on stderr, to check large backfills before they're
+replayed and to measure the CPU cost of building objects apart from API latency:
+
+$ render_jobs messages.jsonl --output_dir manifests/
+$ render_jobs messages.jsonl --discard --processes 8
+$ render_jobs messages.jsonl --format json | kubectl apply --dry-run=server -f -
+
+The exit status is 1 if any message is invalid.
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+from hikaru import get_clean_dict
+from ruamel.yaml import YAML
+
+from jobsubmitter import config
+from jobsubmitter.consume import _read_message
+from jobsubmitter.job.job import plan_job
+from jobsubmitter.templates import preload_templates
+from jobsubmitter.validate.schema import create_validator
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('decode_validate', 'build', 'serialise')
+# config set in worker processes, which don't inherit it with the spawn start method
+SETTINGS = ('NAMESPACE', 'OUTPUT_BUCKET', 'MANIFEST_DIR', 'PVC_HEADROOM', 'PVC_BASE_SIZE', 'PVC_MIN_SIZE',
+            'PVC_MAX_SIZE', 'STORAGE_TIERS', 'INPUT_CACHE_PVC', 'INPUT_CACHE_BUDGET')
+
+_validator = None
+_format: str = None
+_client_id: str = None
+
+
+def render(line: bytes) -> tuple[str, str, dict[str, float]]:
+    """ Validate and build the objects of one launch message. Returns its run id (None if it's invalid), the
+    serialised manifests and the seconds spent in each stage """
+    seconds = {}
+    start = time.perf_counter()
+    params = _read_message(line, _validator)
+    seconds['decode_validate'] = time.perf_counter() - start
+    if params == {}:
+        return None, None, seconds
+
+    start = time.perf_counter()
+    plan = plan_job(params, _client_id)
+    objects = [plan.job] + plan.owned
+    seconds['build'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    items = [get_clean_dict(x) for x in objects]
+    if _format == 'json':
+        manifests = json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': items}) + '\n'
+    else:
+        # values parsed from manifest templates are ruamel scalar types, which a safe dumper can't represent
+        stream = io.StringIO()
+        yaml = YAML(typ='safe', pure=True)
+        yaml.default_flow_style = False
+        yaml.explicit_start = True  # so the documents of consecutive messages are separated too
+        yaml.dump_all(json.loads(json.dumps(items)), stream)
+        manifests = stream.getvalue()
+    seconds['serialise'] = time.perf_counter() - start
+    return params['pipeline_param']['id'], manifests, seconds
+
+
+def _init_worker(settings: dict, validation_engine: str, fmt: str, client_id: str) -> None:
+    global _validator, _format, _client_id
+    for k, v in settings.items():
+        setattr(config, k, v)
+    preload_templates()
+    _validator = create_validator(validation_engine)
+    _format = fmt
+    _client_id = client_id
+
+
+def _read_lines(path: str):
+    with (sys.stdin.buffer if path == '-' else open(path, 'rb')) as f:
+        yield from (line for line in f if line.strip())
+
+
+def report(costs: dict[str, list[float]], rendered: int, invalid: int, elapsed: float, processes: int) -> str:
+    """ Throughput and per-message cost (milliseconds) of each stage """
+    total = rendered + invalid
+    lines = [f"{total} messages ({invalid} invalid) in {elapsed:.2f} s with {processes} processes: "
+             f"{total / elapsed:.1f} messages/s",
+             f"{'stage':>16} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}"]
+    for name, values in costs.items():
+        if not values:
+            continue
+        p95 = statistics.quantiles(values, n=100, method='inclusive')[94] if len(values) > 1 else values[0]
+        lines.append(f"{name:>16} {statistics.mean(values) * 1000:>8.2f} {statistics.median(values) * 1000:>8.2f} "
+                     f"{p95 * 1000:>8.2f} {max(values) * 1000:>8.2f}")
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("messages", help="A JSONL file of launch messages (one message per line), - for stdin")
+    parser.add_argument("--output_dir", help="Write each message's manifests to <run id>.<format> here, instead of "
+                                             "stdout")
+    parser.add_argument("--discard", help="Don't write manifests, only report", action='store_true')
+    parser.add_argument("--format", help="Multi-document YAML, or a JSON List per line", choices=['yaml', 'json'],
+                        default='yaml')
+    parser.add_argument("--processes", help="Worker processes (1 renders in this process)", type=int,
+                        default=os.cpu_count())
+    parser.add_argument("--chunk_size", help="Messages sent to a worker at once", type=int, default=16)
+    parser.add_argument("--validation_engine", choices=['jsonschema', 'fast'], default='jsonschema')
+    parser.add_argument("--client_id", help="Submitter label of rendered jobs", default='render')
+    parser.add_argument("--namespace", default=config.NAMESPACE)
+    parser.add_argument("--output_bucket", default=config.OUTPUT_BUCKET)
+    parser.add_argument("--manifest_dir", help="Directory of manifests that override packaged manifests")
+    parser.add_argument("--pvc_headroom", type=float, default=config.PVC_HEADROOM)
+    parser.add_argument("--pvc_base_size", default=config.PVC_BASE_SIZE)
+    parser.add_argument("--pvc_min_size", default=config.PVC_MIN_SIZE)
+    parser.add_argument("--pvc_max_size", default=config.PVC_MAX_SIZE)
+    parser.add_argument("--storage_tiers", default=config.STORAGE_TIERS)
+    parser.add_argument("--input_cache_pvc")
+    parser.add_argument("--input_cache_budget", type=int, help="Bytes")
+    parser.add_argument("--verbose", action='store_true')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, stream=sys.stderr)
+
+    settings = {k: getattr(args, k.lower()) for k in SETTINGS}
+    initargs = (settings, args.validation_engine, args.format, args.client_id)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    costs: dict[str, list[float]] = {name: [] for name in STAGES}
+    seen: set[str] = set()
+    rendered = invalid = 0
+    start = time.perf_counter()
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, initializer=_init_worker, initargs=initargs)
+        results = pool.imap(render, _read_lines(args.messages), chunksize=args.chunk_size)
+    else:
+        pool = None
+        _init_worker(*initargs)
+        results = map(render, _read_lines(args.messages))
+
+    for i, (run_id, manifests, seconds) in enumerate(results, start=1):
+        for name, value in seconds.items():
+            costs[name].append(value)
+        if run_id is None:
+            logger.error(f"Message {i} is invalid")
+            invalid += 1
+            continue
+        rendered += 1
+        if run_id in seen:
+            logger.warning(f"Message {i} has a duplicate run id {run_id}, it would be dropped when it's replayed")
+        seen.add(run_id)
+
+        if args.discard:
+            continue
+        if args.output_dir is not None:
+            with open(os.path.join(args.output_dir, f"{run_id}.{args.format}"), 'w') as f:
+                f.write(manifests)
+        else:
+            sys.stdout.write(manifests)
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print(report(costs, rendered, invalid, elapsed, args.processes), file=sys.stderr)
+    sys.exit(1 if invalid else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+""" Start the job submitter quickly, profile its startup and signal readiness
+
+Most of a cold start is importing the kubernetes client and hikaru models (CPU) and connecting the Kafka consumer and
+producer (network), so submit_job.main runs them in parallel as tasks. Only light modules are imported by
+submit_job itself: modules that build K8S objects are imported once the models are loaded.
+
+Readiness is signalled once the consumer, producer, kubernetes client, shared ConfigMap and submission index are all
+ready: a file is created (for an exec readinessProbe) and the jobsubmitter_ready metric is set. With
+--profile_startup the time of each step, and the thread that ran it, is logged.
+"""
+import contextlib
+import logging
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import Future
+
+from jobsubmitter.metrics import READY
+
+logger = logging.getLogger(__name__)
+
+STARTED = time.perf_counter()  # imported first by submit_job, so this is close to when the process started
+
+
+class StartupProfile:
+    """ Record how long each startup step took """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.steps: list[tuple[str, str, float, float]] = []  # (name, thread, start, seconds), start since STARTED
+
+    @contextlib.contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            self.steps.append((name, threading.current_thread().name, start - STARTED, end - start))
+
+    def task(self, name: str, fn, *args, **kwargs) -> Future:
+        """ Run fn(*args, **kwargs) as a step in a new thread. The future has its result, or raises its exception """
+        future = Future()
+
+        def run():
+            try:
+                with self.step(name):
+                    result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+        return future
+
+    def report(self) -> str:
+        lines = [f"{'step':<24} {'thread':<24} {'start':>7} {'seconds':>8}"]
+        for name, thread, start, seconds in sorted(self.steps, key=lambda x: x[2]):
+            lines.append(f"{name:<24} {thread:<24} {start:>7.3f} {seconds:>8.3f}")
+        lines.append(f"ready after {time.perf_counter() - STARTED:.3f} s")
+        return "\n".join(lines)
+
+
+def clear_ready(path: str = None) -> None:
+    """ Remove a ready file left by an earlier run of the container """
+    READY.set(0)
+    if path is not None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def set_ready(path: str = None) -> None:
+    READY.set(1)
+    if path is not None:
+        pathlib.Path(path).touch()
+    logger.info("Ready and listening for job requests")
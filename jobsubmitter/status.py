@@ -0,0 +1,153 @@
+""" Publish job status messages to the pipeline-status topic
+
+Status changes are coalesced per job for coalesce_ms, so a job that starts and completes quickly only sends its latest
+state. Messages from the job watcher (STARTED, COMPLETED, FAILED) and the pod monitor (QUEUED, TRANSFERRING, RUNNING)
+are coalesced separately, so a pod phase never replaces a job state. Once a job's COMPLETED or FAILED message is
+queued, pod phases for it are dropped: a pod list taken before the job finished can't send RUNNING after it.
+Messages are keyed by pipeline id, so every state of a job goes to the same partition and is read in order.
+Every send is tracked: failed deliveries (after the producer's own retries), and messages that couldn't be sent at all
+(e.g. the broker is down), are reported by pop_unsent(), so the watcher can forget it sent them and try again. Jobs
+with messages that aren't confirmed delivered yet are reported by unconfirmed(), so the watcher checkpoint only saves
+statuses that were published.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+from kafka import KafkaProducer
+
+from jobsubmitter.metrics import STATUS_PUBLISH_LAG
+
+logger = logging.getLogger(__name__)
+
+TERMINAL = ('COMPLETED', 'FAILED')
+FINISHED_TTL = 600  # seconds finished jobs are remembered, much longer than a pod monitor period
+
+try:
+    import orjson
+
+    SERIALIZER = 'orjson'
+
+    def serialize(v) -> bytes:
+        return orjson.dumps(v)
+except ImportError:
+    SERIALIZER = 'json'
+    _encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def serialize(v) -> bytes:
+        return _encoder.encode(v).encode('utf-8')
+
+
+class StatusPublisher:
+    """ A KafkaProducer that coalesces status messages and tracks their delivery """
+
+    def __init__(self, bootstrap_servers, topic: str = 'pipeline-status', coalesce_ms: int = 500,
+                 linger_ms: int = 5, batch_size: int = 16384, compression_type: str = None, retries: int = 5):
+        self.topic = topic
+        self.coalesce_ms = coalesce_ms
+        self.producer = KafkaProducer(bootstrap_servers=bootstrap_servers,
+                                      value_serializer=serialize,
+                                      linger_ms=linger_ms,
+                                      batch_size=batch_size,
+                                      compression_type=compression_type,
+                                      retries=retries)
+        self._lock = threading.Lock()
+        # (job name, source): (latest message, time the job finished)
+        self._pending: dict[tuple[str, str], tuple[dict, float]] = {}
+        self._finished: dict[str, float] = {}  # job name: time.monotonic() its COMPLETED or FAILED message was queued
+        self._unsent: set[str] = set()
+        self._in_flight: collections.Counter = collections.Counter()  # job name: messages sent, not yet acknowledged
+
+    def bootstrap_connected(self) -> bool:
+        return self.producer.bootstrap_connected()
+
+    def start(self) -> None:
+        threading.Thread(target=self._flush_loop, name="status-publisher", daemon=True).start()
+
+    def send(self, run_id: str, message: dict, finished_at: float = None, source: str = 'watch') -> None:
+        """ Queue a message, replacing any message for the same job from the same source (watch or monitor) that
+        hasn't been sent yet
+
+        finished_at is when a completed or failed job finished (seconds since the epoch), to measure publish lag """
+        with self._lock:
+            if message['status'] in TERMINAL:
+                self._finished[run_id] = time.monotonic()
+                self._pending.pop((run_id, 'monitor'), None)
+            elif run_id in self._finished:
+                logger.debug(f"Dropping {message['status']} status message for finished job {run_id}")
+                return
+
+            key = (run_id, source)
+            if key in self._pending:
+                logger.debug(f"Coalescing status messages for job {run_id}")
+                del self._pending[key]  # sent after anything queued since
+            self._pending[key] = (message, finished_at)
+            if source == 'watch' and (run_id, 'monitor') in self._pending:
+                self._pending[(run_id, 'monitor')] = self._pending.pop((run_id, 'monitor'))  # the finer state last
+
+    def flush(self) -> None:
+        """ Send queued messages and wait for delivery """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._in_flight.update(run_id for run_id, _ in pending)
+            expired = time.monotonic() - FINISHED_TTL
+            self._finished = {k: v for k, v in self._finished.items() if v > expired}
+
+        batch = list(pending.items())
+        for i, ((run_id, _), (message, finished_at)) in enumerate(batch):
+            logger.debug(f"Sending message for job {run_id}: {message}")
+            try:
+                future = self.producer.send(self.topic, message, key=message['pipeline_id'].encode('utf-8'))
+            except Exception as e:
+                # e.g. KafkaTimeoutError, metadata couldn't be fetched in max_block_ms. Later sends would fail too
+                unsent = {x for (x, _), _ in batch[i:]}
+                logger.error(f"Sending status messages failed, {len(unsent)} jobs will be sent again: {e}")
+                with self._lock:
+                    self._unsent |= unsent
+                    self._in_flight.subtract(x for (x, _), _ in batch[i:])
+                    self._in_flight = +self._in_flight  # drop jobs with nothing in flight
+                break
+            future.add_errback(self._failed, run_id)
+            future.add_callback(self._delivered, run_id, finished_at)
+
+        if pending:
+            self.producer.flush()
+
+    def pop_unsent(self) -> set[str]:
+        """ Get (and forget) jobs with messages that failed to deliver """
+        with self._lock:
+            unsent, self._unsent = self._unsent, set()
+        return unsent
+
+    def unconfirmed(self) -> set[str]:
+        """ Jobs with messages that aren't confirmed delivered: queued, sent and waiting for an acknowledgement, or
+        failed (until pop_unsent) """
+        with self._lock:
+            return {run_id for run_id, _ in self._pending} | set(self._in_flight) | self._unsent
+
+    def _delivered(self, run_id: str, finished_at: float, record_metadata) -> None:
+        self._acknowledged(run_id)
+        if finished_at is not None:
+            STATUS_PUBLISH_LAG.observe(time.time() - finished_at)
+
+    def _failed(self, run_id: str, exc: Exception) -> None:
+        logger.error(f"Status message for job {run_id} failed to deliver: {exc}")
+        with self._lock:
+            self._unsent.add(run_id)
+        self._acknowledged(run_id)
+
+    def _acknowledged(self, run_id: str) -> None:
+        with self._lock:
+            self._in_flight[run_id] -= 1
+            if self._in_flight[run_id] <= 0:
+                del self._in_flight[run_id]
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.coalesce_ms / 1000)
+            try:
+                self.flush()
+            except Exception:
+                logger.error("Flushing status messages failed", exc_info=True)
@@ -1,19 +1,37 @@
+from __future__ import annotations
+
+from jobsubmitter import startup  # first, to time imports
+
 import logging
 import argparse
+import time
+from decimal import Decimal
 from threading import Thread
+from typing import TYPE_CHECKING
 
-import kubernetes
+from kafka import TopicPartition
+from kafka.errors import CommitFailedError
 
-from jobsubmitter import config
-from jobsubmitter.consume import create_consumer
-from jobsubmitter.job.job import submit_job
-from jobsubmitter.job.config import make_shared_cm
-from jobsubmitter.watch import job_watcher
+from jobsubmitter import config, metrics
+
+# the kubernetes client and hikaru models are imported in the background at startup, with the modules that use them
+if TYPE_CHECKING:
+    from jobsubmitter.admission import AdmissionController
+    from jobsubmitter.dedupe import SubmissionIndex
+    from jobsubmitter.executor import SubmissionExecutor
+    from jobsubmitter.transfer.pool import PVCPool
 
 logger = logging.getLogger(__name__)
 log_fmt = "%(name)s: %(asctime)s %(levelname)-8s %(message)s"
 
 
+def parse_quantity(value: str) -> Decimal:
+    """ Parse a quantity like 80Gi, without importing kubernetes for options that aren't set """
+    from kubernetes.utils import parse_quantity
+
+    return parse_quantity(value)
+
+
 def parse_args(args=None) -> argparse.Namespace:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description='Consume Kafka messages and launch jobs')
     parser.add_argument("--kafka_bootstrap_urls", help="Path to kafka bootstrap server",required=True)
@@ -22,13 +40,129 @@ def parse_args(args=None) -> argparse.Namespace:
     parser.add_argument("--output_bucket", help="s3 root URL of output bucket", required=True)
     parser.add_argument("--local_config", help="Use local KUBECONFIG", action='store_true')
     parser.add_argument("--verbose", help="Chattier logs", action='store_true')
-    return parser.parse_args(args)
+    parser.add_argument("--watch_mode", help="Poll the job list every minute or stream job events",
+                        choices=['poll', 'stream'], default='poll')
+    parser.add_argument("--resync_period", help="Seconds between full job relists in stream mode",
+                        type=int, default=600)
+    parser.add_argument("--checkpoint_interval", help="Seconds between watcher checkpoint writes (0 disables)",
+                        type=int, default=10)
+    parser.add_argument("--status_coalesce_ms", help="Milliseconds status changes are held, so only the latest state "
+                                                     "of a job is sent", type=int, default=500)
+    parser.add_argument("--status_linger_ms", help="Kafka producer linger_ms for status messages", type=int, default=5)
+    parser.add_argument("--status_batch_size", help="Kafka producer batch_size for status messages",
+                        type=int, default=16384)
+    parser.add_argument("--status_compression", help="Kafka producer compression for status messages",
+                        choices=['gzip', 'snappy', 'lz4', 'zstd'])
+    parser.add_argument("--watch_own_jobs", help="Only watch jobs labelled with this client_id",
+                        action='store_true')
+    parser.add_argument("--list_page_size", help="Maximum number of jobs fetched per list request",
+                        type=int, default=100)
+    parser.add_argument("--workers", help="Number of jobs submitted concurrently", type=int, default=1)
+    parser.add_argument("--max_in_flight", help="Maximum number of messages queued or being submitted",
+                        type=int, default=10)
+    parser.add_argument("--submit_retries", help="Times a message whose submission failed is consumed again before "
+                                                 "it's given up on", type=int, default=5)
+    parser.add_argument("--shared_cm_resync_period", help="Seconds between checks of the shared ConfigMap for drift",
+                        type=int, default=300)
+    parser.add_argument("--validation_engine", help="Validate messages with jsonschema, or a compiled schema (fast)",
+                        choices=['jsonschema', 'fast'], default='jsonschema')
+    parser.add_argument("--batch", help="Poll and validate messages in batches", action='store_true')
+    parser.add_argument("--batch_size", help="Maximum number of messages per batch", type=int, default=100)
+    parser.add_argument("--fetch_min_bytes", help="Minimum bytes returned by a Kafka fetch request",
+                        type=int, default=1)
+    parser.add_argument("--fetch_max_wait_ms", help="Maximum time a Kafka fetch request waits for fetch_min_bytes",
+                        type=int, default=500)
+    parser.add_argument("--fetch_max_bytes", help="Maximum bytes returned by a Kafka fetch request",
+                        type=int, default=52428800)
+    parser.add_argument("--max_partition_fetch_bytes", help="Maximum bytes returned per partition by a Kafka fetch",
+                        type=int, default=1048576)
+    parser.add_argument("--dedupe_max_size", help="Maximum number of run ids remembered to drop duplicate messages",
+                        type=int)
+    parser.add_argument("--dedupe_ttl", help="Seconds a run id is remembered to drop duplicate messages", type=int)
+    parser.add_argument("--manifest_dir", help="Directory of manifests that override packaged manifests")
+    parser.add_argument("--reload_manifests", help="Reload manifests when their files change", action='store_true')
+    parser.add_argument("--metrics_port", help="Serve Prometheus metrics on this port", type=int)
+    parser.add_argument("--max_active_jobs", help="Maximum number of unfinished jobs", type=int)
+    parser.add_argument("--max_active_cpu", help="Maximum CPU requested by unfinished jobs, e.g. 40",
+                        type=parse_quantity)
+    parser.add_argument("--max_active_memory", help="Maximum memory requested by unfinished jobs, e.g. 80Gi",
+                        type=parse_quantity)
+    parser.add_argument("--max_active_storage", help="Maximum PVC storage requested by unfinished jobs, e.g. 2Ti",
+                        type=parse_quantity)
+    parser.add_argument("--admission_quota", help="Limit unfinished jobs to the namespace ResourceQuotas",
+                        action='store_true')
+    parser.add_argument("--quota_resync_period", help="Seconds between reads of the namespace ResourceQuotas",
+                        type=int, default=60)
+    parser.add_argument("--pvc_pool_size", help="Number of transfer PVCs kept provisioned and ready (0 disables)",
+                        type=int, default=0)
+    parser.add_argument("--pvc_pool_refill_rate", help="Maximum pooled PVCs created per minute", type=float,
+                        default=10)
+    parser.add_argument("--pvc_pool_claim_size", help="Storage requested by pooled PVCs, e.g. 40Gi", default='40Gi')
+    parser.add_argument("--pvc_headroom", help="Transfer PVC space for the nextflow work directory, as a multiple of "
+                                               "the target genome size", type=float, default=2.0)
+    parser.add_argument("--pvc_base_size", help="Transfer PVC space for everything except target genomes",
+                        default='10Gi')
+    parser.add_argument("--pvc_min_size", help="Minimum transfer PVC size", default='10Gi')
+    parser.add_argument("--pvc_max_size", help="Maximum transfer PVC size")
+    parser.add_argument("--storage_tiers", help="Transfer PVC storage class by size, smallest first, e.g. "
+                                                "100Gi=example-nfs-ssd,example-nfs-hdd", default='example-nfs-ssd')
+    parser.add_argument("--input_cache_pvc", help="A ReadWriteMany PVC to cache target genomes across runs")
+    parser.add_argument("--input_cache_budget", help="Maximum size of cached target genomes, e.g. 2Ti",
+                        type=parse_quantity)
+    parser.add_argument("--input_cache_dir", help="Where the input cache PVC is mounted, so the orphan sweeper can "
+                                                  "remove the links of finished runs")
+    parser.add_argument("--leader_elect", help="Elect a leader to publish job status, so replicas can scale out",
+                        action='store_true')
+    parser.add_argument("--lease_duration", help="Seconds before a leader that stopped renewing its lease is replaced",
+                        type=int, default=15)
+    parser.add_argument("--monitor_pods", help="Publish QUEUED, TRANSFERRING and RUNNING states from job pods",
+                        action='store_true')
+    parser.add_argument("--monitor_period", help="Seconds between checks of job pods", type=int, default=15)
+    parser.add_argument("--queued_deadline", help="Seconds a job's pod can be pending before the job is failed",
+                        type=float)
+    parser.add_argument("--transfer_deadline", help="Seconds a job can spend transferring before it's failed",
+                        type=float)
+    parser.add_argument("--running_deadline", help="Seconds a job's nextflow driver can run before it's failed",
+                        type=float)
+    parser.add_argument("--max_restarts", help="Container restarts before a job is failed", type=int)
+    parser.add_argument("--api_qps", help="Kubernetes API requests per second, after a burst (0 is unlimited)",
+                        type=float, default=20)
+    parser.add_argument("--api_burst", help="Kubernetes API requests sent at once before --api_qps applies",
+                        type=int, default=40)
+    parser.add_argument("--api_pool_size", help="Kubernetes API connections kept open (default: workers + 8)",
+                        type=int)
+    parser.add_argument("--api_retries", help="Retries of Kubernetes API requests throttled (429) or failed (5xx)",
+                        type=int, default=3)
+    parser.add_argument("--admission_queue_size", help="Launch requests held for capacity before consumption pauses",
+                        type=int, default=10)
+    parser.add_argument("--orphan_sweep_period", help="Seconds between sweeps of objects of failed submissions "
+                                                      "(0 disables)", type=int, default=0)
+    parser.add_argument("--orphan_grace_period", help="Seconds an object can be unowned, or a Job can be missing its "
+                                                      "objects, before it's swept", type=int, default=600)
+    parser.add_argument("--ready_file", help="Create this file once ready, for a readinessProbe")
+    parser.add_argument("--profile_startup", help="Log the time taken by each import and initialisation step",
+                        action='store_true')
+    args = parser.parse_args(args)
+    if args.leader_elect and args.watch_own_jobs:
+        parser.error("--watch_own_jobs can't be used with --leader_elect, the leader watches jobs of every replica")
+    return args
 
 
 def main(args=None):
+    profile = startup.StartupProfile()
+    profile.record('import', startup.STARTED, time.perf_counter())
     args = parse_args(args)
     config.NAMESPACE = args.namespace
     config.OUTPUT_BUCKET = args.output_bucket
+    config.MANIFEST_DIR = args.manifest_dir
+    config.RELOAD_MANIFESTS = args.reload_manifests
+    config.PVC_HEADROOM = args.pvc_headroom
+    config.PVC_BASE_SIZE = args.pvc_base_size
+    config.PVC_MIN_SIZE = args.pvc_min_size
+    config.PVC_MAX_SIZE = args.pvc_max_size
+    config.STORAGE_TIERS = args.storage_tiers
+    config.INPUT_CACHE_PVC = args.input_cache_pvc
+    config.INPUT_CACHE_BUDGET = int(args.input_cache_budget) if args.input_cache_budget is not None else None
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG,
@@ -40,39 +174,301 @@ def main(args=None):
                             datefmt='%Y-%m-%d %H:%M:%S')
 
     logger.info(args)
+    startup.clear_ready(args.ready_file)
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+
     bootstrap_list = args.kafka_bootstrap_urls.strip().split(",")
+    fetch_config = {'fetch_min_bytes': args.fetch_min_bytes,
+                    'fetch_max_wait_ms': args.fetch_max_wait_ms,
+                    'fetch_max_bytes': args.fetch_max_bytes,
+                    'max_partition_fetch_bytes': args.max_partition_fetch_bytes}
+    publisher_config = {'coalesce_ms': args.status_coalesce_ms,
+                        'linger_ms': args.status_linger_ms,
+                        'batch_size': args.status_batch_size,
+                        'compression_type': args.status_compression}
+
+    from jobsubmitter.executor import RebalanceListener
+
+    # the kafka clients connect while the kubernetes client and models are imported
+    rebalance = RebalanceListener()  # bound to the executor once it's created, before the first poll
+    consumer_init = profile.task('consumer', _init_consumer, args, bootstrap_list, fetch_config, rebalance)
+    publisher_init = profile.task('producer', _init_publisher, bootstrap_list, publisher_config,
+                                  args.validation_engine == 'fast')
+    profile.task('kubernetes', _init_kubernetes, args, profile).result()
+
+    with profile.step('import submitter'):
+        from jobsubmitter.admission import AdmissionController
+        from jobsubmitter.checkpoint import WatchCheckpoint
+        from jobsubmitter.dedupe import SubmissionIndex
+        from jobsubmitter.executor import SubmissionExecutor
+        from jobsubmitter.job.config import reconcile_shared_cm, shared_cm_reconciler
+        from jobsubmitter.leader import LeaderElector
+        from jobsubmitter.monitor import PodMonitor
+        from jobsubmitter.sweeper import OrphanSweeper
+        from jobsubmitter.templates import preload_templates
+        from jobsubmitter.transfer.pool import PVCPool
+        from jobsubmitter.watch import job_watcher
+
+    with profile.step('templates'):
+        preload_templates()
+    shared_cm_init = profile.task('shared_cm', reconcile_shared_cm)  # ensure the shared configmap is provisioned
+
+    leader = None
+    if args.leader_elect:
+        # client_id is unique to each replica (e.g. the pod name), and labels the jobs the replica submits
+        leader = LeaderElector(identity=args.client_id, lease_duration=args.lease_duration)
+        leader.start()
+
+    checkpoint = WatchCheckpoint(interval=args.checkpoint_interval, leader=leader) if args.checkpoint_interval else None
+    index = SubmissionIndex(max_size=args.dedupe_max_size, ttl=args.dedupe_ttl)
+    index_init = profile.task('index', index.seed, page_size=args.list_page_size)
+
+    pool = None
+    if args.pvc_pool_size:
+        pool = PVCPool(size=args.pvc_pool_size, refill_rate=args.pvc_pool_refill_rate,
+                       claim_size=args.pvc_pool_claim_size, leader=leader)
+        pool.start()
+
+    if args.orphan_sweep_period:
+        OrphanSweeper(grace_period=args.orphan_grace_period, period=args.orphan_sweep_period,
+                      page_size=args.list_page_size, leader=leader, cache_dir=args.input_cache_dir).start()
+
+    executor = SubmissionExecutor(lambda params, client_id: _submit_job(index, admission, params, client_id, pool),
+                                  workers=args.workers, max_in_flight=args.max_in_flight,
+                                  retries=args.submit_retries)
+    limits = {'jobs': args.max_active_jobs,
+              'cpu': args.max_active_cpu,
+              'memory': args.max_active_memory,
+              'storage': args.max_active_storage}
+    admission = AdmissionController(executor, limits=limits, quota=args.admission_quota,
+                                    quota_resync_period=args.quota_resync_period,
+                                    max_queued=args.admission_queue_size, publisher=publisher_init.result())
+    admission.start()
+
+    monitor = None
+    if args.monitor_pods:
+        monitor = PodMonitor(deadlines={'queued': args.queued_deadline,
+                                        'transferring': args.transfer_deadline,
+                                        'running': args.running_deadline},
+                             max_restarts=args.max_restarts, period=args.monitor_period,
+                             page_size=args.list_page_size, leader=leader)
+
+    shared_cm_init.result()
+    Thread(target=shared_cm_reconciler, kwargs={'resync_period': args.shared_cm_resync_period}, daemon=True).start()
+    index_init.result()
+
+    watch_kwargs = {'bootstrap_servers': bootstrap_list,
+                    'mode': args.watch_mode,
+                    'resync_period': args.resync_period,
+                    'submitter': args.client_id if args.watch_own_jobs else None,
+                    'page_size': args.list_page_size,
+                    'index': index,
+                    'checkpoint': checkpoint,
+                    'admission': admission,
+                    'leader': leader,
+                    'monitor': monitor,
+                    'publisher': publisher_init.result()}
+    watch_thread = Thread(target=job_watcher, kwargs=watch_kwargs, daemon=True)
+    watch_thread.start()
+    assert watch_thread.is_alive()
+
+    consumer, validator = consumer_init.result()
+    rebalance.bind(consumer, executor)
+    startup.set_ready(args.ready_file)
+    if args.profile_startup:
+        logger.info(f"Startup profile:\n{profile.report()}")
+
+    if args.batch:
+        _consume_batches(consumer, executor, admission, index, validator, args.client_id, args.batch_size,
+                         watch_thread, args.ready_file)
+    else:
+        _consume(consumer, executor, admission, index, args.client_id, watch_thread, args.ready_file)
+
+
+def _init_kubernetes(args, profile: startup.StartupProfile) -> None:
+    """ Import the kubernetes client and models, and load the kube config """
+    with profile.step('import kubernetes'):
+        import kubernetes
+        from jobsubmitter import apiclient
 
     if args.local_config:
         kubernetes.config.load_kube_config()
     else:
         kubernetes.config.load_incluster_config()
+    # one connection for each worker, plus the watcher and background threads
+    apiclient.configure(qps=args.api_qps, burst=args.api_burst, pool_size=args.api_pool_size or args.workers + 8,
+                        retries=args.api_retries)
 
-    make_shared_cm()  # ensure the shared configmap is provisioned at startup
+    with profile.step('import models'):
+        import hikaru.model.rel_1_21  # noqa: F401
 
-    watch_thread = Thread(target=job_watcher, kwargs={'bootstrap_servers': bootstrap_list}, daemon=True)
-    watch_thread.start()
-    assert watch_thread.is_alive()
 
-    consumer = create_consumer(args.client_id, bootstrap_list)
+def _init_consumer(args, bootstrap_list: list[str], fetch_config: dict, listener=None) -> tuple:
+    """ Connect the launch message consumer, and create the validator for batches """
+    from jobsubmitter.consume import create_consumer
+    from jobsubmitter.validate.schema import create_validator
 
+    consumer = create_consumer(args.client_id, bootstrap_list, validation_engine=args.validation_engine,
+                               batch=args.batch, listener=listener, **fetch_config)
     if not consumer.topics():
         logger.critical("Can't connect to kafka broker")
         raise RuntimeError()
+    return consumer, create_validator(args.validation_engine) if args.batch else None
+
+
+def _init_publisher(bootstrap_list: list[str], publisher_config: dict, fast: bool = False):
+    """ Connect the status producer. fast warns if the fast extra's serializer isn't installed """
+    from jobsubmitter.status import SERIALIZER, StatusPublisher
+
+    if fast and SERIALIZER != 'orjson':
+        logger.warning("orjson isn't installed (the fast extra), serialising status messages with json")
+    publisher = StatusPublisher(bootstrap_list, **publisher_config)
+    if not publisher.bootstrap_connected():
+        logger.critical("Can't connect to kafka broker")
+        raise RuntimeError()
+    logger.debug("Producer connected to bootstrap server")
+    return publisher
+
+
+def _consume(consumer, executor: SubmissionExecutor, admission: AdmissionController, index: SubmissionIndex,
+             client_id: str, watch_thread: Thread, ready_file: str = None) -> None:
+    """ Submit validated messages one by one """
+    while True:
+        for message in consumer:
+            _check_watcher(watch_thread, ready_file)
+            _submit(executor, admission, index, message, message.value, client_id)
+            _commit(consumer, executor)
+            _backpressure(consumer, admission)
+
+        _check_watcher(watch_thread, ready_file)
+        _commit(consumer, executor)  # idle, commit anything that finished since the last message
+        _backpressure(consumer, admission)
+
+
+def _consume_batches(consumer, executor: SubmissionExecutor, admission: AdmissionController, index: SubmissionIndex,
+                     validator, client_id: str, batch_size: int, watch_thread: Thread,
+                     ready_file: str = None) -> None:
+    """ Poll, validate and submit batches of messages
+
+    Offsets are committed once the K8S objects of a message (and every earlier message) exist """
+    from jobsubmitter.consume import read_batch
+
+    while True:
+        _check_watcher(watch_thread, ready_file)
+        _backpressure(consumer, admission)
+
+        records = consumer.poll(timeout_ms=1000, max_records=batch_size)
+        for tp, messages in records.items():
+            for message, params in zip(messages, read_batch([x.value for x in messages], validator)):
+                _submit(executor, admission, index, message, params, client_id)
+
+        _commit(consumer, executor)
+
+
+def _check_watcher(watch_thread: Thread, ready_file: str = None) -> None:
+    """ Stop (and stop being ready) if the job watcher died or stopped making progress
+
+    Without the watcher no status messages are sent, so it's better for the container to be restarted than to keep
+    submitting jobs """
+    from jobsubmitter.watch import STALL_TIMEOUT, stalled
+
+    if not watch_thread.is_alive():
+        startup.clear_ready(ready_file)
+        logger.critical("Job watcher stopped")
+        raise RuntimeError("Job watcher stopped")
+    if stalled():
+        startup.clear_ready(ready_file)
+        logger.critical(f"Job watcher made no progress for {STALL_TIMEOUT} s")
+        raise RuntimeError("Job watcher stalled")
+
+
+def _backpressure(consumer, admission: AdmissionController) -> None:
+    """ Pause partitions while launch requests are waiting for capacity (or the executor), so excess work waits in
+    Kafka. The consumer keeps its group membership without fetching more messages """
+    if admission.saturated and not consumer.paused():
+        logger.info(f"{admission.queued} launch requests waiting for capacity, pausing partitions")
+        consumer.pause(*consumer.assignment())
+    elif not admission.saturated and consumer.paused():
+        logger.info("Resuming partitions")
+        consumer.resume(*consumer.paused())
+
+
+def _submit(executor: SubmissionExecutor, admission: AdmissionController, index: SubmissionIndex, message,
+            params: dict, client_id: str) -> None:
+    from jobsubmitter.admission import storage_request
+
+    tp = TopicPartition(message.topic, message.partition)
+
+    if params == {}:  # messages that fail validation are returned empty
+        logging.error(message)
+        executor.skip(tp, message.offset)
+    elif not index.claim(params['pipeline_param']['id']):
+        logger.warning(f"Job already submitted for run {params['pipeline_param']['id']}, dropping duplicate message")
+        executor.skip(tp, message.offset)
     else:
-        logger.info("Ready and listening for job requests")
+        logging.info(message)
+        if not admission.submit(params['pipeline_param']['id'], tp, message.offset, _priority(message), params,
+                                client_id, storage=storage_request(params)):
+            index.discard(params['pipeline_param']['id'])  # rejected, the run can be launched again with new limits
+
+    logger.debug(f"Admission queue depth: {admission.queued}, submission queue depth: {executor.queue_depth}")
+
+
+def _priority(message) -> int:
+    """ Launch messages can set a priority header: an integer, higher is admitted first (default 0) """
+    for key, value in message.headers or []:
+        if key == 'priority':
+            try:
+                return int(value)
+            except ValueError:
+                logger.warning(f"Ignoring invalid priority header {value!r}")
+    return 0
+
+
+def _submit_job(index: SubmissionIndex, admission: AdmissionController, params: dict, client_id: str,
+                pool: PVCPool = None) -> None:
+    from jobsubmitter.job.job import submit_job
+
+    run_id: str = params['pipeline_param']['id']
+    try:
+        submit_job(params, client_id, pool)
+    except Exception:
+        index.discard(run_id)  # a redelivered message can try again
+        admission.release(run_id)
+        raise
+    admission.submitted(run_id)
+
+
+def _commit(consumer, executor: SubmissionExecutor) -> None:
+    """ Commit offsets of messages that have been submitted, including every message before them """
+    _rewind(consumer, executor)
+    offsets = executor.committable()
+    if offsets:
+        try:
+            consumer.commit(offsets)
+            logger.debug(f"Committed offsets {offsets}")
+        except CommitFailedError:
+            logger.warning("Offset commit failed (partitions reassigned), messages may be redelivered")
+    _record_lag(consumer)
+
 
-    for message in consumer:
-        make_shared_cm() # make sure cm is present
-        assert watch_thread.is_alive()
-        params = message.value
+def _rewind(consumer, executor: SubmissionExecutor) -> None:
+    """ Seek back to messages whose submission failed, so they're consumed again. Partitions that were reassigned
+    are consumed from their last committed offset by their new owner, which is never after a failed message """
+    assignment = consumer.assignment()
+    for tp, offset in executor.rewinds().items():
+        if tp in assignment:
+            logger.warning(f"Consuming {tp.topic}-{tp.partition} again from offset {offset}, after a failed submission")
+            consumer.seek(tp, offset)
 
-        if params == {}:  # messages that fail validation are returned empty
-            logging.error(message)
-            continue
-        else:
-            logging.info(message)
 
-        submit_job(params, args.client_id)
+def _record_lag(consumer) -> None:
+    """ Export the lag of each assigned partition (high water mark - position), from the last fetch """
+    for tp in consumer.assignment():
+        highwater = consumer.highwater(tp)
+        if highwater is not None:
+            metrics.CONSUMER_LAG.labels(tp.topic, str(tp.partition)).set(highwater - consumer.position(tp))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+""" Delete objects of failed submissions, so they don't leak NFS capacity, etcd space and admission slots
+
+A submission's ConfigMaps and PVC are created with their Job as the owner, so they're garbage collected with the Job,
+and a failed submission deletes whatever it created (see job.plan.SubmissionPlan). Objects are still left behind if
+a rollback fails (e.g. while the API server is unavailable), and by older versions of the job submitter.
+
+Every period the sweeper deletes, one by one:
+
+- ConfigMaps and PVCs without an owner that are older than grace_period and that no Job uses. They're found by their
+  run-id label, or for transfer ConfigMaps and PVCs made by older versions (labelled app=transfer only), by their app
+  label. Pooled PVCs (see transfer/pool.py) are never swept.
+- Unfinished Jobs older than grace_period that use a ConfigMap or PVC of their own that doesn't exist (their rollback
+  failed to delete them). Their pod can never start, and they hold an admission slot. Shared objects (the nxf-base
+  ConfigMap, the input cache PVC) don't count, they're reconciled or provisioned separately.
+- If cache_dir is set (where the input cache PVC is mounted), the input cache links of runs whose Job finished or is
+  gone, so the cached files they used can be evicted (see transfer/cache.py).
+
+With leader election only the leader sweeps.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from kubernetes import client
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import batch_api, core_api
+from jobsubmitter.job.base_manifests import base_configmap
+from jobsubmitter.job.plan import delete_object
+from jobsubmitter.metrics import ORPHANS_DELETED, WATCH_LOOP_SECONDS, api_call
+from jobsubmitter.transfer import cache
+from jobsubmitter.watch import job_selector, list_jobs
+
+logger = logging.getLogger(__name__)
+
+# kind: list method of CoreV1Api
+KINDS = {'ConfigMap': 'list_namespaced_config_map',
+         'PersistentVolumeClaim': 'list_namespaced_persistent_volume_claim'}
+SELECTOR = 'app in (nextflow,transfer)'
+
+
+def _sweepable(labels: dict) -> bool:
+    """ True for ConfigMaps and PVCs made for one run: labelled with a run-id, or transfer objects made by older
+    versions (labelled app=transfer only). Not pooled PVCs, or shared objects like nxf-base """
+    return ('run-id' in labels or labels.get('app') == 'transfer') and 'pool-state' not in labels
+
+
+class OrphanSweeper:
+    """ Delete unowned ConfigMaps and PVCs that no Job uses, and Jobs missing their ConfigMaps or PVC """
+
+    def __init__(self, grace_period: int = 600, period: int = 600, page_size: int = 100, leader=None,
+                 cache_dir: str = None):
+        self.grace_period = grace_period  # seconds an object can be unowned, longer than any submission takes
+        self.period = period
+        self.page_size = page_size
+        self.leader = leader
+        self.cache_dir = cache_dir
+
+    def start(self) -> None:
+        threading.Thread(target=self._sweep_loop, name="orphan-sweeper", daemon=True).start()
+
+    def sweep(self) -> int:
+        """ Delete orphaned objects. Returns the number deleted """
+        api = core_api()
+        with api_call('list_jobs'):
+            jobs = [job for page in list_jobs(batch_api(), job_selector(), self.page_size) for job in page.items]
+        used: dict[str, set[str]] = {kind: set() for kind in KINDS}  # kind: names used by a Job
+        for job in jobs:
+            for kind, names in _references(job).items():
+                used[kind] |= names
+
+        deleted = 0
+        existing: dict[str, set[str]] = {}  # kind: names of ConfigMaps and PVCs matching SELECTOR
+        for kind, list_method in KINDS.items():
+            existing[kind] = set()
+            orphans: list[str] = []
+            for obj, orphaned in self._list(kind, getattr(api, list_method)):
+                existing[kind].add(obj.metadata.name)
+                if orphaned and _sweepable(obj.metadata.labels or {}) and obj.metadata.name not in used[kind]:
+                    orphans.append(obj.metadata.name)
+            for name in orphans:
+                delete_object(kind, name)
+            deleted += self._count(kind, len(orphans))
+
+        stuck = [job.metadata.name for job in jobs if self._stuck(job, existing)]
+        for name in stuck:
+            logger.warning(f"Deleting Job {name}, its ConfigMaps or PVC don't exist")
+            delete_object('Job', name)
+        deleted += self._count('Job', len(stuck))
+
+        if self.cache_dir is not None:
+            active = {job.metadata.labels.get('run-id') for job in jobs
+                      if not (job.status.succeeded or job.status.failed)}
+            removed = cache.remove_finished_runs(self.cache_dir, active, self.grace_period)
+            deleted += self._count('InputCacheRun', removed)
+        return deleted
+
+    def _list(self, kind: str, list_method):
+        """ Yield (object, True if it has no owner and is older than the grace period) for objects matching
+        SELECTOR """
+        _continue = None
+        while True:
+            with api_call(f"list_{kind.lower()}s"):
+                page = list_method(config.NAMESPACE, label_selector=SELECTOR, limit=self.page_size,
+                                   _continue=_continue)
+            for obj in page.items:
+                meta = obj.metadata
+                yield obj, not meta.owner_references and meta.deletion_timestamp is None and self._expired(meta)
+            _continue = page.metadata._continue
+            if not _continue:
+                break
+
+    def _stuck(self, job, existing: dict[str, set[str]]) -> bool:
+        """ True if an unfinished Job older than the grace period uses a ConfigMap or PVC of its own that's missing """
+        if job.status.succeeded or job.status.failed or job.metadata.deletion_timestamp is not None:
+            return False
+        if not self._expired(job.metadata):
+            return False
+        shared = {'ConfigMap': {base_configmap().metadata.name}, 'PersistentVolumeClaim': {config.INPUT_CACHE_PVC}}
+        # objects that weren't listed might just be labelled differently, so they're read to check they're missing
+        return any(_missing(kind, name) for kind, names in _references(job).items()
+                   for name in names - shared[kind] - existing[kind])
+
+    def _expired(self, meta) -> bool:
+        return (datetime.now(timezone.utc) - meta.creation_timestamp).total_seconds() > self.grace_period
+
+    @staticmethod
+    def _count(kind: str, count: int) -> int:
+        if count:
+            logger.info(f"Deleted {count} orphaned {kind}s")
+            ORPHANS_DELETED.labels(kind).inc(count)
+        return count
+
+    def _sweep_loop(self) -> None:
+        while True:
+            if self.leader is not None and not self.leader.is_leader:
+                self.leader.wait(self.period)
+                continue
+            try:
+                with WATCH_LOOP_SECONDS.labels('sweep').time():
+                    self.sweep()
+            except Exception:
+                logger.error("Sweeping orphaned objects failed, retrying next period", exc_info=True)
+            time.sleep(self.period)
+
+
+def _missing(kind: str, name: str) -> bool:
+    """ True if a ConfigMap or PersistentVolumeClaim doesn't exist """
+    try:
+        with api_call(f"read_{kind.lower()}"):
+            if kind == 'ConfigMap':
+                core_api().read_namespaced_config_map(name, config.NAMESPACE)
+            else:
+                core_api().read_namespaced_persistent_volume_claim(name, config.NAMESPACE)
+    except client.exceptions.ApiException as e:
+        if e.status == 404:
+            return True
+        raise
+    return False
+
+
+def _references(job) -> dict[str, set[str]]:
+    """ Names of the ConfigMaps and PVCs a Job's pod uses: as volumes, or in environment variables """
+    spec = job.spec.template.spec
+    configmaps: set[str] = set()
+    pvcs: set[str] = set()
+    for volume in spec.volumes or []:
+        if volume.config_map is not None:
+            configmaps.add(volume.config_map.name)
+        if volume.persistent_volume_claim is not None:
+            pvcs.add(volume.persistent_volume_claim.claim_name)
+    for container in (spec.init_containers or []) + (spec.containers or []):
+        for env in container.env or []:
+            if env.value_from is not None and env.value_from.config_map_key_ref is not None:
+                configmaps.add(env.value_from.config_map_key_ref.name)
+        for env_from in container.env_from or []:
+            if env_from.config_map_ref is not None:
+                configmaps.add(env_from.config_map_ref.name)
+    return {'ConfigMap': configmaps, 'PersistentVolumeClaim': pvcs}
@@ -0,0 +1,95 @@
+""" A cache of parsed manifest templates
+
+Parsing YAML and building hikaru objects is slow (tens of milliseconds per manifest). Each manifest is parsed once and
+kept as a pickled hikaru object. Unpickling is a fast deep copy, so each submission gets an independent object it can
+modify freely.
+
+Manifests are read from the package, unless a file with the same name exists in config.MANIFEST_DIR (e.g. a mounted
+ConfigMap). If config.RELOAD_MANIFESTS is set, a template is parsed again when its source file changes.
+"""
+import importlib.resources
+import logging
+import os
+import pickle
+import threading
+
+from hikaru.model.rel_1_21 import *
+from ruamel.yaml import YAML
+
+from jobsubmitter import config
+from jobsubmitter.job import manifests as job_manifests
+from jobsubmitter.transfer import manifests as transfer_manifests
+
+logger = logging.getLogger(__name__)
+
+# every manifest used to build a job
+MANIFESTS = [(job_manifests, 'pgsc-job.yaml', Job),
+             (job_manifests, 'k8s-executor.yaml', ConfigMap),
+             (job_manifests, 'nxf-base.yaml', ConfigMap),
+             (transfer_manifests, 'transfer.yaml', Pod),
+             (transfer_manifests, 'volume_mount.yaml', Container)]
+
+
+class ManifestTemplate:
+    """ A manifest parsed once into a hikaru object, cloned for each use """
+
+    def __init__(self, package, filename: str, cls):
+        self.package = package
+        self.filename = filename
+        self.cls = cls
+        self._lock = threading.Lock()
+        self._source = None
+        self._mtime = None
+        self._pickled: bytes = self._parse()
+
+    def clone(self):
+        """ Get an independent copy of the parsed manifest """
+        if config.RELOAD_MANIFESTS:
+            with self._lock:
+                if self._changed():
+                    logger.info(f"Manifest {self._source} changed, reloading")
+                    self._pickled = self._parse()
+        return pickle.loads(self._pickled)
+
+    def _path(self):
+        if config.MANIFEST_DIR is not None:
+            path = os.path.join(config.MANIFEST_DIR, self.filename)
+            if os.path.exists(path):
+                return path
+        return importlib.resources.files(self.package).joinpath(self.filename)
+
+    def _changed(self) -> bool:
+        path = self._path()
+        return str(path) != str(self._source) or os.stat(path).st_mtime != self._mtime
+
+    def _parse(self) -> bytes:
+        path = self._path()
+        logger.debug(f"Parsing manifest {path}")
+        self._source = path
+        self._mtime = os.stat(path).st_mtime
+        with open(path) as f:
+            obj = self.cls.from_yaml(YAML().load(f))
+        return pickle.dumps(obj)
+
+
+_templates: dict[tuple[str, str], ManifestTemplate] = {}
+_templates_lock = threading.Lock()
+
+
+def load_template(package, filename: str, cls):
+    """ Get an independent copy of a manifest, parsing it on first use """
+    key = (package.__name__, filename)
+    template = _templates.get(key)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(key)
+            if template is None:
+                template = _templates[key] = ManifestTemplate(package, filename, cls)
+    return template.clone()
+
+
+def preload_templates() -> None:
+    """ Parse every manifest at startup, so the first submission doesn't pay for it """
+    for package, filename, cls in MANIFESTS:
+        load_template(package, filename, cls)
+    logger.info(f"Loaded {len(MANIFESTS)} manifest templates")
@@ -0,0 +1,66 @@
+""" A content-addressed cache of target genomes, shared across runs on one ReadWriteMany PVC
+
+The transfer initContainer (transfer/globus/transfer.py) looks up each file by its collection id, path, size and
+ETag. Files that aren't cached are downloaded into the cache. Either way the file is hard linked into a directory for
+the run, at its path relative to the collection directory. The nextflow job and its worker pods read from there
+(target_genomes are rewritten to point there):
+
+    /cache/objects/<key>/<file name>    downloaded files, evicted least recently used first to fit a size budget
+    /cache/runs/<run id>/<path>         hard links to the objects a run uses, so they can't be evicted mid-run
+    /cache/tmp/<key>.<run id>/          downloads in progress
+
+Once a run's Job finishes, the orphan sweeper removes its links (see remove_finished_runs), so the objects it used can
+be evicted. The transfer initContainer only removes links older than INPUT_CACHE_TTL, in case the sweeper is disabled.
+
+The layout is duplicated in transfer.py, which can't import jobsubmitter.
+"""
+import os
+import shutil
+import time
+
+from hikaru.model.rel_1_21 import *
+
+from jobsubmitter import config
+
+CACHE_MOUNT_PATH = '/cache'
+
+
+def enabled() -> bool:
+    return config.INPUT_CACHE_PVC is not None
+
+
+def run_path(run_id: str, path: str) -> str:
+    """ Where a run reads a target genome file from """
+    return os.path.join(CACHE_MOUNT_PATH, 'runs', run_id, os.path.normpath(path.lstrip('/')))
+
+
+def remove_finished_runs(root: str, active: set[str], grace_period: float) -> int:
+    """ Remove the links (and abandoned downloads) of runs that aren't active: their Job finished, or is gone.
+    Runs changed within grace_period are kept, their Job may have been created after active was listed. Returns the
+    number of runs removed """
+    now = time.time()
+    removed = set()
+    for directory in ('runs', 'tmp'):
+        try:
+            entries = list(os.scandir(os.path.join(root, directory)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            run_id = entry.name if directory == 'runs' else entry.name.partition('.')[2]  # tmp/<key>.<run id>
+            if run_id in active or now - entry.stat().st_mtime <= grace_period:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed.add(run_id)
+    return len(removed)
+
+
+def cache_volume(read_only: bool) -> tuple[VolumeMount, Volume]:
+    """ A mount and volume for the cache PVC. Only the transfer initContainer writes to the cache """
+    volume = Volume(name='input-cache',
+                    persistentVolumeClaim=PersistentVolumeClaimVolumeSource(claimName=config.INPUT_CACHE_PVC))
+    return VolumeMount(name='input-cache', mountPath=CACHE_MOUNT_PATH, readOnly=read_only), volume
+
+
+def pod_directive() -> str:
+    """ A nextflow process.pod directive that mounts the cache in worker pods """
+    return f"[volumeClaim:'{config.INPUT_CACHE_PVC}',mountPath:'{CACHE_MOUNT_PATH}',readOnly:true]"
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+""" Stage the target genomes of a launch message from a Globus guest collection to the transfer PVC, over HTTPS
+
+Files are downloaded concurrently, TRANSFER_PARALLELISM requests at a time. Files bigger than TRANSFER_CHUNK_SIZE are
+fetched in byte ranges (in parallel) if the collection supports range requests. Downloads are written to
+<file>.part, and the ranges that are complete are recorded in <file>.part.json, so a restarted container resumes
+where it left off. Failed requests are retried with exponential backoff. A file is renamed into place once its size
+matches the Content-Range reported by the collection (and globus_details.file_sizes, if it's declared).
+
+If INPUT_CACHE_DIR is set (a volume shared by every run), files are looked up in a content-addressed cache by their
+collection id, path, size and ETag, and downloaded into the cache if they're missing. Cached files are hard linked
+into a directory for the run, see jobsubmitter/transfer/cache.py. Files keep their path relative to the collection
+directory, so files with the same name in different directories don't overwrite each other.
+
+Progress is written to transfer_log.json while files are downloading: the overall status (running, complete or
+failed), and the size, bytes transferred, attempts, status and last error of each file.
+
+Environment variables:
+    GLOBUS_BASE_URL, GLOBUS_SECRET_TOKEN, GLOBUS_GUEST_COLLECTION_ID, JOB_MESSAGE: see transfer.yaml
+    GLOBUS_AUTH_URL: the token endpoint (default: https://auth.globus.org/v2/oauth2/token)
+    TRANSFER_PARALLELISM: concurrent requests (default: 4)
+    TRANSFER_CHUNK_SIZE: bytes fetched per range request (default: 64 MiB)
+    TRANSFER_RETRIES: attempts per request after the first (default: 5)
+    TRANSFER_TIMEOUT: seconds a request can stall before it's retried (default: 60)
+    INPUT_CACHE_DIR: mount path of the input cache (default: unset, no cache)
+    INPUT_CACHE_BUDGET: bytes of cached files kept, least recently used files are evicted first (default: unlimited)
+    INPUT_CACHE_TTL: seconds a run's links to cached files are kept if the job submitter doesn't remove them when
+        its Job finishes, longer than any run (default: 7 days)
+
+Only the standard library is used, so the transfer image just needs python.
+"""
+import contextlib
+import hashlib
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+logger = logging.getLogger("transfer")
+
+AUTH_URL = "https://auth.globus.org/v2/oauth2/token"
+GENOME_FILES = ('pgen', 'pvar', 'psam', 'bed', 'bim', 'fam', 'vcf_path')
+LOG_PATH = "transfer_log.json"
+BLOCK_SIZE = 2 ** 20
+MAX_BACKOFF = 60
+_RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class TransferError(Exception):
+    """ A download that can't succeed, or that's still failing after every retry """
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _write_json(path: str, obj) -> None:
+    """ Replace a JSON file atomically, so it's never read half written """
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def retry(fn, retries: int, backoff: float = 1):
+    """ Call fn until it succeeds, sleeping backoff * 2^attempt seconds (with jitter) between attempts
+
+    Client errors (HTTP 4xx, except timeouts and rate limits) aren't retried """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except urllib.error.HTTPError as e:
+            if e.code not in _RETRY_STATUS or attempt == retries:
+                raise TransferError(f"HTTP {e.code} {e.reason}: {e.url}") from e
+            error = e
+        except (OSError, http.client.HTTPException, TransferError) as e:  # URLError and timeouts are OSErrors
+            if attempt == retries:
+                raise TransferError(str(e)) from e
+            error = e
+        delay = min(backoff * 2 ** attempt, MAX_BACKOFF) * random.uniform(0.5, 1.5)
+        logger.warning(f"{error}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+        time.sleep(delay)
+
+
+def grab_access_token(auth_url: str, secret_token: str, collection_id: str, retries: int = 5,
+                      timeout: float = 60) -> str:
+    """ Exchange client credentials for an access token scoped to the guest collection's HTTPS server """
+    data = urllib.parse.urlencode({'scope': f"https://auth.globus.org/scopes/{collection_id}/https",
+                                   'grant_type': 'client_credentials'}).encode()
+    request = urllib.request.Request(auth_url, data=data, method='POST',
+                                     headers={'Authorization': f"Basic {secret_token}"})
+
+    def grab():
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.load(response)['access_token']
+
+    return retry(grab, retries)
+
+
+def file_paths(message: dict) -> list[str]:
+    """ Paths of the target genome files in a launch message, relative to the guest collection directory """
+    paths = []
+    for genome in message['pipeline_param']['target_genomes']:
+        paths.extend(genome[x] for x in GENOME_FILES if genome.get(x))
+    return list(dict.fromkeys(paths))
+
+
+def relative_path(path: str) -> str:
+    """ Where a file is written, relative to the run's directory: its path on the collection, relative to the
+    collection directory. Raises TransferError for paths outside the collection directory """
+    relative = os.path.normpath(path.lstrip('/'))
+    if relative == '.' or relative.startswith('..'):
+        raise TransferError(f"{path} isn't a file in the collection directory")
+    return relative
+
+
+class Progress:
+    """ Download progress of every file, written to transfer_log.json at most once per interval """
+
+    def __init__(self, path: str = LOG_PATH, interval: float = 1):
+        self.path = path
+        self.interval = interval
+        self.log = {'status': 'running', 'started': _now(), 'finished': None, 'files': {}}
+        self._lock = threading.Lock()
+        self._written = 0
+
+    def update(self, name: str, transferred: int = 0, **fields) -> None:
+        """ Update a file's fields and add transferred bytes. Status changes are always written """
+        with self._lock:
+            entry = self.log['files'].setdefault(name, {'transferred': 0})
+            entry['transferred'] += transferred
+            entry.update(fields)
+            if 'status' in fields or time.monotonic() - self._written >= self.interval:
+                self._write()
+
+    def attempt(self, name: str) -> None:
+        with self._lock:
+            entry = self.log['files'][name]
+            entry['attempts'] = entry.get('attempts', 0) + 1
+
+    def finish(self, status: str) -> None:
+        with self._lock:
+            self.log.update(status=status, finished=_now())
+            self._write()
+
+    def _write(self) -> None:
+        self._written = time.monotonic()
+        _write_json(self.path, self.log)
+
+
+class Cache:
+    """ A content-addressed store of downloaded files on a volume shared by every run
+
+    objects/<key>/<file name>: a downloaded file, evicted least recently used (mtime) first
+    runs/<run id>/<path>: hard links to the objects a run uses (see relative_path). The job submitter removes them
+        when the run's Job finishes, otherwise they're removed after ttl seconds
+    tmp/<key>.<run id>/: downloads in progress
+    """
+
+    def __init__(self, root: str, budget: int = None, ttl: float = 7 * 86400):
+        self.root = root
+        self.budget = budget
+        self.ttl = ttl
+
+    @staticmethod
+    def key(collection_id: str, path: str, size: int, etag: str = None) -> str:
+        return hashlib.sha256('\0'.join(map(str, (collection_id, path, size, etag or ''))).encode()).hexdigest()
+
+    def _object(self, key: str, name: str) -> str:
+        return os.path.join(self.root, 'objects', key, os.path.basename(name))
+
+    def link(self, key: str, name: str, run_id: str) -> bool:
+        """ Hard link a cached file into the run's directory, at its relative path. Returns False if it isn't
+        cached """
+        obj = self._object(key, name)
+        link = os.path.join(self.root, 'runs', run_id, name)
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        try:
+            os.utime(obj)  # most recently used
+            if os.path.exists(link) and os.path.samefile(link, obj):
+                return True
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f"{link}.tmp")
+            os.link(obj, f"{link}.tmp")
+            os.replace(f"{link}.tmp", link)
+        except FileNotFoundError:  # not cached, or just evicted by another run
+            return False
+        return True
+
+    def staging(self, key: str, run_id: str) -> str:
+        path = os.path.join(self.root, 'tmp', f"{key}.{run_id}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def publish(self, key: str, name: str, run_id: str) -> None:
+        """ Move a finished download into the cache and link it into the run's directory """
+        staging = self.staging(key, run_id)
+        os.makedirs(os.path.dirname(self._object(key, name)), exist_ok=True)
+        # same content if another run cached it
+        os.replace(os.path.join(staging, os.path.basename(name)), self._object(key, name))
+        shutil.rmtree(staging, ignore_errors=True)
+        if not self.link(key, name, run_id):
+            raise TransferError(f"{name} was evicted from the cache before it was linked")
+
+    def evict(self, needed: int = 0) -> None:
+        """ Remove expired runs and abandoned downloads, then evict objects until needed bytes fit in the budget """
+        now = time.time()
+        for directory in ('runs', 'tmp'):
+            for entry in self._scan(os.path.join(self.root, directory)):
+                if now - entry.stat().st_mtime > self.ttl:
+                    logger.info(f"Removing expired {directory}/{entry.name} from the cache")
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        if self.budget is None:
+            return
+
+        objects = [(x.stat(), x.path) for key in self._scan(os.path.join(self.root, 'objects'))
+                   for x in self._scan(key.path)]
+        used = sum(stat.st_size for stat, _ in objects)
+        for stat, path in sorted(objects, key=lambda x: x[0].st_mtime):
+            if used + needed <= self.budget:
+                break
+            if stat.st_nlink > 1:
+                continue  # linked into a run, removing it wouldn't free any space
+            logger.info(f"Evicting {path} from the cache")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(path))
+            used -= stat.st_size
+        if used + needed > self.budget:
+            logger.warning(f"Cache is over budget: {used + needed} bytes needed, budget {self.budget} bytes")
+
+    @staticmethod
+    def _scan(path: str) -> list[os.DirEntry]:
+        try:
+            return list(os.scandir(path))
+        except FileNotFoundError:
+            return []
+
+
+class Download:
+    """ One file, downloaded to <name>.part in chunks. Completed chunks are recorded in <name>.part.json """
+
+    def __init__(self, name: str, url: str, dest: str, size: int, ranges: bool, chunk_size: int, key: str = None):
+        self.url = url
+        self.dest = dest
+        self.key = key  # cache key, if it's downloaded into the cache
+        self.name = name  # path relative to the run's directory
+        self.size = size
+        self.part = f"{dest}.part"
+        self.state = f"{dest}.part.json"
+        self._lock = threading.Lock()
+        if ranges and size:
+            self.chunks = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+        else:
+            self.chunks = [(0, size)]
+        self.ranges = ranges
+        self.done: set[int] = self._resume()
+
+    def _resume(self) -> set[int]:
+        """ Chunks completed by an earlier attempt, if it was downloading the same file in the same chunks """
+        try:
+            with open(self.state) as f:
+                state = json.load(f)
+            if self.ranges and state['size'] == self.size and state['chunks'] == [list(x) for x in self.chunks] \
+                    and os.path.getsize(self.part) == self.size:
+                return set(state['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        with open(self.part, 'wb') as f:
+            f.truncate(self.size)
+        return set()
+
+    @property
+    def pending(self) -> list[tuple[int, int]]:
+        return [x for i, x in enumerate(self.chunks) if i not in self.done]
+
+    @property
+    def resumed(self) -> int:
+        return sum(end - start for i, (start, end) in enumerate(self.chunks) if i in self.done)
+
+    def complete(self, chunk: tuple[int, int]) -> bool:
+        """ Record a finished chunk. Returns True once every chunk is finished """
+        with self._lock:
+            self.done.add(self.chunks.index(chunk))
+            _write_json(self.state, {'size': self.size, 'chunks': self.chunks, 'done': sorted(self.done)})
+            return len(self.done) == len(self.chunks)
+
+    def finalise(self, expected: int = None) -> None:
+        """ Check the size of the downloaded file, then move it into place """
+        actual = os.path.getsize(self.part)
+        for size in filter(lambda x: x is not None, (self.size, expected)):
+            if actual != size:
+                raise TransferError(f"{self.name} is {actual} bytes, expected {size}")
+        os.replace(self.part, self.dest)
+        os.remove(self.state)
+
+
+class Transfer:
+    """ Download a list of files from a base URL into dest, sharing parallelism between files and chunks
+
+    If cache is set, files are linked into the run's directory in the cache instead of dest """
+
+    def __init__(self, base_url: str, access_token: str, dest: str = '.', parallelism: int = 4,
+                 chunk_size: int = 64 * 2 ** 20, retries: int = 5, timeout: float = 60, backoff: float = 1,
+                 progress: Progress = None, cache: Cache = None, collection_id: str = '', run_id: str = ''):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': f"Bearer {access_token}"}
+        self.dest = dest
+        self.parallelism = parallelism
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.progress = progress or Progress(os.path.join(dest, LOG_PATH))
+        self.cache = cache
+        self.collection_id = collection_id
+        self.run_id = run_id
+
+    def run(self, paths: list[str], directory: str = '', sizes: dict[str, int] = None) -> None:
+        """ Download paths (relative to directory on the collection). Raises TransferError if any file fails """
+        sizes = sizes or {}
+        try:
+            with ThreadPoolExecutor(self.parallelism, thread_name_prefix="transfer") as pool:
+                # probe files concurrently, then queue chunks in file order
+                downloads = list(pool.map(lambda x: self._prepare(x, directory), paths))
+                if self.cache is not None:
+                    self.cache.evict(sum(x.size - x.resumed for x in downloads if x is not None and x.size))
+                futures = [pool.submit(self._fetch, download, chunk, sizes.get(path))
+                           for path, download in zip(paths, downloads) if download is not None
+                           for chunk in download.pending]
+                finished, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                failed = [x.exception() for x in finished if x.exception() is not None]
+                if failed:
+                    pool.shutdown(cancel_futures=True)
+                    raise failed[0]
+        except Exception:
+            self.progress.finish('failed')
+            raise
+        self.progress.finish('complete')
+
+    def _url(self, directory: str, path: str) -> str:
+        return '/'.join([self.base_url] + [urllib.parse.quote(x.strip('/')) for x in (directory, path) if x.strip('/')])
+
+    def _prepare(self, path: str, directory: str):
+        """ Find the size of a file and whether the collection serves byte ranges. Returns None if the file was
+        already downloaded (or cached) """
+        url = self._url(directory, path)
+        name = relative_path(path)
+        dest = os.path.join(self.dest, name)
+        self.progress.update(name, url=url, status='pending', attempts=0, error=None)
+        try:
+            size, ranges, etag = retry(lambda: self._probe(url), self.retries, self.backoff)
+        except TransferError as e:
+            self.progress.update(name, status='failed', error=str(e))
+            raise
+
+        key = None
+        if self.cache is not None and size is not None:
+            key = self.cache.key(self.collection_id, url, size, etag)
+            if self.cache.link(key, name, self.run_id):
+                logger.info(f"{name} is cached")
+                self.progress.update(name, size=size, status='cached')
+                return None
+            dest = os.path.join(self.cache.staging(key, self.run_id), os.path.basename(name))
+        elif os.path.exists(dest) and os.path.getsize(dest) == size:
+            logger.info(f"{name} already downloaded")
+            self.progress.update(name, size=size, transferred=size, status='complete')
+            return None
+
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        download = Download(name, url, dest, size, ranges, self.chunk_size, key)
+        self.progress.update(name, size=size, transferred=download.resumed, chunks=len(download.chunks),
+                             status='downloading', started=_now())
+        if download.resumed:
+            logger.info(f"Resuming {name}, {download.resumed} of {size} bytes already downloaded")
+        return download
+
+    def _probe(self, url: str) -> tuple[int, bool, str]:
+        """ Request the first byte: a 206 response reports the file size in its Content-Range. Returns the size,
+        whether ranges are supported and the ETag (if there is one) """
+        request = urllib.request.Request(url, headers={**self.headers, 'Range': 'bytes=0-0'})
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 416:  # empty file, nothing to satisfy the range
+                return int(e.headers.get('Content-Range', '/0').rpartition('/')[2]), True, e.headers.get('ETag')
+            raise
+        with response:
+            etag = response.headers.get('ETag')
+            if response.status == 206:
+                return int(response.headers['Content-Range'].rpartition('/')[2]), True, etag
+            length = response.headers.get('Content-Length')
+            return (int(length) if length is not None else None), False, etag
+
+    def _fetch(self, download: Download, chunk: tuple[int, int], expected: int = None) -> None:
+        """ Download a chunk, resuming from the last byte written when a request is retried """
+        offset = [chunk[0]]
+
+        def fetch():
+            self.progress.attempt(download.name)
+            headers = dict(self.headers)
+            if download.ranges:
+                headers['Range'] = f"bytes={offset[0]}-{chunk[1] - 1}"
+            elif offset[0]:  # no ranges, start again
+                self.progress.update(download.name, transferred=-offset[0])
+                offset[0] = 0
+            request = urllib.request.Request(download.url, headers=headers)
+            with urllib.request.urlopen(request, timeout=self.timeout) as response, \
+                    open(download.part, 'r+b') as f:
+                if not download.ranges:
+                    f.truncate(0)
+                f.seek(offset[0])
+                while block := response.read(BLOCK_SIZE):
+                    f.write(block)
+                    offset[0] += len(block)
+                    self.progress.update(download.name, transferred=len(block))
+            if download.size is not None and offset[0] != chunk[1]:
+                raise TransferError(f"{download.name}: connection closed after {offset[0]} of {chunk[1]} bytes")
+
+        if chunk[0] == chunk[1] and download.ranges:
+            pass  # empty file
+        else:
+            try:
+                retry(fetch, self.retries, self.backoff)
+            except TransferError as e:
+                self.progress.update(download.name, status='failed', error=str(e))
+                raise
+
+        if download.complete(chunk):
+            download.finalise(expected)
+            if download.key is not None:
+                self.cache.publish(download.key, download.name, self.run_id)
+            self.progress.update(download.name, status='complete', finished=_now())
+            logger.info(f"Downloaded {download.name}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(asctime)s %(levelname)-8s %(message)s")
+    env = {x: os.environ[x] for x in ("GLOBUS_BASE_URL", "GLOBUS_SECRET_TOKEN", "GLOBUS_GUEST_COLLECTION_ID",
+                                      "JOB_MESSAGE")}  # KeyError if anything's missing
+    message = json.loads(env['JOB_MESSAGE'])
+    retries = int(os.environ.get('TRANSFER_RETRIES', 5))
+    timeout = float(os.environ.get('TRANSFER_TIMEOUT', 60))
+
+    token = grab_access_token(os.environ.get('GLOBUS_AUTH_URL', AUTH_URL), env['GLOBUS_SECRET_TOKEN'],
+                              env['GLOBUS_GUEST_COLLECTION_ID'], retries, timeout)
+    cache = None
+    if os.environ.get('INPUT_CACHE_DIR'):
+        budget = os.environ.get('INPUT_CACHE_BUDGET')
+        cache = Cache(os.environ['INPUT_CACHE_DIR'], budget=int(budget) if budget else None,
+                      ttl=float(os.environ.get('INPUT_CACHE_TTL', 7 * 86400)))
+    transfer = Transfer(env['GLOBUS_BASE_URL'], token,
+                        parallelism=int(os.environ.get('TRANSFER_PARALLELISM', 4)),
+                        chunk_size=int(os.environ.get('TRANSFER_CHUNK_SIZE', 64 * 2 ** 20)),
+                        retries=retries, timeout=timeout, cache=cache,
+                        collection_id=env['GLOBUS_GUEST_COLLECTION_ID'], run_id=message['pipeline_param']['id'])
+    globus_details = message['globus_details']
+    transfer.run(file_paths(message), globus_details['dir_path_on_guest_collection'],
+                 globus_details.get('file_sizes'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,28 @@
-import importlib.resources
 import itertools
 import logging
 import pathlib
 
 import hikaru
 from hikaru.model.rel_1_21 import *
-from ruamel.yaml import YAML
 
 from jobsubmitter import config
-from jobsubmitter.transfer import manifests
+from jobsubmitter.templates import load_template
+from jobsubmitter.transfer import cache, manifests
 
 import kubernetes
 
 logger = logging.getLogger(__name__)
 
 
-def build_init_containers(config_map_name) -> tuple[Volume, list[Container]]:
+def build_init_containers(config_map_name: str, pvc_name: str, pool=None, job_name: str = None, size: str = '40Gi',
+                          storage_class: str = 'example-nfs-ssd') -> tuple[PersistentVolumeClaim, Volume,
+                                                                           list[Container]]:
+    """ Build the transfer initContainers and the PVC they stage data to (see sizing.pvc_size). Nothing is created in
+    the cluster.
+
+    If pool (a transfer.pool.PVCPool) is set, a pooled PVC that's big enough is claimed for job_name instead. The PVC
+    already exists, so None is returned in its place. If the input cache is enabled, the transfer container also mounts
+    the cache PVC (the job must add its volume, see cache.cache_volume) """
     # 1. read pod from manifest
     logger.info("Reading transfer pod from manifest")
     pod = _load_pod()
@@ -23,41 +30,43 @@ def build_init_containers(config_map_name) -> tuple[Volume, list[Container]]:
     # 2. set config map name
     pod.spec.containers[0].env = _update_env_var_cm_ref(pod, config_map_name)
 
-    # 3. make a PVC for initContainer (PVC name is generated)
-    pvc = _instantiate_pvc()
-    pvc.create()
-    logger.info(f"PVC {pvc.metadata.name} created in {pvc.metadata.namespace}")
+    # 3. claim a pooled PVC (already bound with fixed permissions), or make a PVC for initContainer
+    claimed: str = pool.claim(job_name, size, storage_class) if pool is not None else None
+    pvc = None if claimed else _instantiate_pvc(pvc_name, size, storage_class)
 
     # add a volumeMount PVC to pod
-    volume_mount, volume = _instantiate_volumes(pvc)
+    volume_mount, volume = _instantiate_volumes(claimed or pvc.metadata.name)
     pod.spec.containers[0].volumeMounts = [volume_mount]
+    if cache.enabled():
+        pod.spec.containers[0].volumeMounts.append(cache.cache_volume(read_only=False)[0])
+
+    if claimed:
+        return pvc, volume, [pod.spec.containers[0]]
 
     # order is important: volume mount fix must run first
     init_containers: list[Container] = [_load_volume_mount_fix(), pod.spec.containers[0]]
-    return volume, init_containers
+    return pvc, volume, init_containers
 
 
-def _instantiate_pvc() -> PersistentVolumeClaim:
-    logger.info("Making ReadWriteMany Persistent Volume Claim")
-    # TODO: make namespace dynamic
-    meta = ObjectMeta(namespace=config.NAMESPACE, generateName="transfer-", labels={'app': 'transfer'})
+def _instantiate_pvc(name: str, size: str = '40Gi', storage_class: str = 'example-nfs-ssd') -> PersistentVolumeClaim:
+    logger.info(f"Making {size} ReadWriteMany Persistent Volume Claim ({storage_class})")
+    meta = ObjectMeta(namespace=config.NAMESPACE, name=name, labels={'app': 'transfer'})
     pv = PersistentVolumeClaim()
     pv.metadata = meta
     pv_spec = PersistentVolumeClaimSpec()
     pv_spec.accessModes = ["ReadWriteMany"]
     # TODO: RWX is a pain
-    pv_spec.storageClassName = "example-nfs-ssd"
-    # TODO: make storage size dynamic. from globus?
-    pv_spec.resources = ResourceRequirements(requests={'storage': '40Gi'})
+    pv_spec.storageClassName = storage_class
+    pv_spec.resources = ResourceRequirements(requests={'storage': size})
     pv.spec = pv_spec
     return pv
 
 
-def _instantiate_volumes(pvc) -> tuple[VolumeMount, Volume]:
+def _instantiate_volumes(claim_name: str) -> tuple[VolumeMount, Volume]:
     logger.info("Creating volume mount")
     vm = VolumeMount(name="vol-1", mountPath="/data")
     logger.debug("Creating volume with PVC source")
-    pvcvs = PersistentVolumeClaimVolumeSource(claimName=pvc.metadata.name)
+    pvcvs = PersistentVolumeClaimVolumeSource(claimName=claim_name)
     vol = Volume(name="vol-1", persistentVolumeClaim=pvcvs)
     return vm, vol
 
@@ -68,11 +77,12 @@ def _update_env_var_cm_ref(pod: Pod, config_map_name: str) -> list[EnvVar]:
     env_list = pod.object_at_path(['spec', 'containers', 0, 'env'])
     # GLOBUS_SECRET* env vars are managed by secret
     # the secret is managed independently of the job submitter
-    not_secrets: list[bool] = ["GLOBUS_SECRET" not in x.name for x in env_list]
-    secrets = list(itertools.compress(env_list, [not x for x in not_secrets]))
-    not_secret_env = list(itertools.compress(env_list, not_secrets))
+    # TRANSFER_* env vars are set in the manifest
+    cm_refs: list[bool] = ["GLOBUS_SECRET" not in x.name and x.valueFrom is not None for x in env_list]
+    other_env = list(itertools.compress(env_list, [not x for x in cm_refs]))
+    cm_env = list(itertools.compress(env_list, cm_refs))
 
-    return secrets + [_update_configmap_selector(x, config_map_name) for x in not_secret_env]
+    return other_env + [_update_configmap_selector(x, config_map_name) for x in cm_env]
 
 
 def _update_configmap_selector(env, config_map_name) -> EnvVar:
@@ -88,9 +98,7 @@ def _load_pod():
 
     After populating PVC mount names and config map names, the container will be extracted. The extracted container is
     used as an initContainer. """
-    with importlib.resources.files(manifests).joinpath('transfer.yaml') as f:
-        yaml = YAML()
-        return Pod.from_yaml(yaml.load(f))
+    return load_template(manifests, 'transfer.yaml', Pod)
 
 
 def _load_volume_mount_fix():
@@ -110,9 +118,7 @@ def _load_volume_mount_fix():
     """
     logger.info("Reading volume mount fix container manifest")
     # note: assumes that the PVC-backed volume is called vol-1
-    with importlib.resources.files(manifests).joinpath('volume_mount.yaml') as f:
-        yaml = YAML()
-        return Container.from_yaml(yaml.load(f))
+    return load_template(manifests, 'volume_mount.yaml', Container)
 
 
 
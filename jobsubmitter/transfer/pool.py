@@ -0,0 +1,204 @@
+""" A pool of pre-provisioned transfer PVCs, to take NFS provisioning off the launch critical path
+
+Pooled PVCs are labelled with their pool-state:
+
+- warming: just created. A warm-up pod mounts the claim, so it's provisioned and bound, and fixes its permissions (see
+  init_container._load_volume_mount_fix)
+- available: bound and ready. The warm-up pod is deleted
+- claimed: taken by a job. Claims are an update with the resourceVersion the PVC was listed at, so two submitters can
+  never claim the same PVC
+
+Claims happen before the Job exists, so claimed PVCs aren't owned by their Job. Instead they're annotated with the
+Job's name and deleted once the Job is gone (after its ttlSecondsAfterFinished, or if it was never created). The pool
+is refilled up to size, creating at most refill_rate PVCs a minute.
+
+The pool is shared by every replica. If leader is set (a leader.LeaderElector), only the leader creates, promotes
+and deletes pooled PVCs, and other replicas only claim them.
+
+Pooled PVCs all request claim_size, so a job can only claim one if its own PVC (see sizing.pvc_size) would be the
+same size or smaller, in the same storage class.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from hikaru.model.rel_1_21 import *
+from kubernetes import client
+from kubernetes.utils import parse_quantity
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import api_client, batch_api, core_api
+from jobsubmitter.job.plan import name_suffix
+from jobsubmitter.metrics import PVC_POOL, PVC_POOL_CLAIMS, PVC_POOL_REFILL_RATE, PVC_POOL_SIZE
+from jobsubmitter.transfer.init_container import _instantiate_pvc, _load_volume_mount_fix
+from jobsubmitter.transfer.sizing import storage_class
+from jobsubmitter.watch import job_selector, list_jobs
+
+logger = logging.getLogger(__name__)
+
+STATE_LABEL = 'pool-state'
+JOB_ANNOTATION = 'jobsubmitter/job-name'
+CLAIMED_ANNOTATION = 'jobsubmitter/claimed-at'
+
+
+class PVCPool:
+    """ Keep size PVCs provisioned, bound and ready to be claimed by jobs """
+
+    def __init__(self, size: int, refill_rate: float = 10, claim_size: str = '40Gi', period: int = 10,
+                 claim_grace_period: int = 300, leader=None):
+        self.size = size
+        self.leader = leader
+        self.claim_size = claim_size
+        self.storage_class = storage_class(parse_quantity(claim_size))
+        self.refill_rate = refill_rate
+        self.period = period
+        self.claim_grace_period = claim_grace_period  # seconds a claimed PVC can wait for its Job to exist
+        self._lock = threading.Lock()
+        self._available: list[client.V1PersistentVolumeClaim] = []  # from the last refill, oldest first
+        self._allowance: float = refill_rate  # PVCs that can be created now
+        PVC_POOL_SIZE.set(size)
+        PVC_POOL_REFILL_RATE.set(refill_rate)
+
+    @property
+    def available(self) -> int:
+        """ Number of PVCs ready to be claimed, as of the last refill """
+        with self._lock:
+            return len(self._available)
+
+    def start(self) -> None:
+        threading.Thread(target=self._refill_loop, name="pvc-pool", daemon=True).start()
+
+    def claim(self, job_name: str, size: str, storage_class_name: str) -> str:
+        """ Claim an available PVC for a job that needs size storage. Returns the PVC name, or None if the pool is
+        empty or its PVCs are too small """
+        if parse_quantity(size) > parse_quantity(self.claim_size) or storage_class_name != self.storage_class:
+            PVC_POOL_CLAIMS.labels('too_small').inc()
+            logger.info(f"Pooled PVCs don't fit job {job_name} ({size}, {storage_class_name}), provisioning a new PVC")
+            return None
+
+        api = core_api()
+        while True:
+            with self._lock:
+                if not self._available:
+                    PVC_POOL_CLAIMS.labels('empty').inc()
+                    logger.info("PVC pool is empty, provisioning a new PVC")
+                    return None
+                pvc = self._available.pop(0)
+
+            pvc.metadata.labels[STATE_LABEL] = 'claimed'
+            pvc.metadata.annotations = (pvc.metadata.annotations or {}) | {
+                JOB_ANNOTATION: job_name,
+                CLAIMED_ANNOTATION: datetime.now(timezone.utc).isoformat()}
+            try:
+                api.replace_namespaced_persistent_volume_claim(pvc.metadata.name, config.NAMESPACE, pvc)
+            except client.exceptions.ApiException as e:
+                if e.status not in (404, 409):
+                    raise
+                PVC_POOL_CLAIMS.labels('conflict').inc()
+                logger.debug(f"PVC {pvc.metadata.name} was claimed or deleted elsewhere, trying the next PVC")
+                continue
+
+            PVC_POOL_CLAIMS.labels('claimed').inc()
+            logger.info(f"Claimed pooled PVC {pvc.metadata.name} for job {job_name}")
+            return pvc.metadata.name
+
+    def refill(self) -> None:
+        """ Promote warmed PVCs, delete claimed PVCs whose Job is gone, and create PVCs up to the pool size """
+        api = core_api()
+        pvcs = api.list_namespaced_persistent_volume_claim(config.NAMESPACE,
+                                                           label_selector=f"app=transfer,{STATE_LABEL}").items
+        by_state: dict[str, list] = {'warming': [], 'available': [], 'claimed': []}
+        for pvc in sorted(pvcs, key=lambda x: x.metadata.creation_timestamp):
+            by_state.setdefault(pvc.metadata.labels[STATE_LABEL], []).append(pvc)
+
+        if self.leader is not None and not self.leader.is_leader:  # the leader maintains the pool
+            with self._lock:
+                self._available = by_state['available']
+            return
+
+        warming, by_state['warming'] = by_state['warming'], []
+        for pvc in warming:
+            state = self._warm_up(api, pvc)
+            if state is not None:
+                by_state[state].append(pvc)
+        self._recycle(api, by_state['claimed'])
+
+        with self._lock:
+            self._available = by_state['available']
+        for state, claims in by_state.items():
+            PVC_POOL.labels(state).set(len(claims))
+
+        self._allowance = min(self._allowance + self.refill_rate * self.period / 60, max(self.refill_rate, 1))
+        missing = self.size - len(by_state['available']) - len(by_state['warming'])
+        for _ in range(min(missing, int(self._allowance))):
+            self._create()
+            self._allowance -= 1
+
+    def _warm_up(self, api, pvc) -> str:
+        """ Mark a warming PVC available once its warm-up pod succeeded. Returns its state (available or warming), or
+        None if it was deleted """
+        pod_name = f"{pvc.metadata.name}-warm"
+        try:
+            pod = api.read_namespaced_pod(pod_name, config.NAMESPACE)
+        except client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+            logger.warning(f"Warm-up pod of PVC {pvc.metadata.name} is missing, deleting PVC")
+            api.delete_namespaced_persistent_volume_claim(pvc.metadata.name, config.NAMESPACE)
+            return None
+
+        if pod.status.phase == 'Failed':
+            logger.warning(f"Warm-up pod of PVC {pvc.metadata.name} failed, deleting PVC")
+            api.delete_namespaced_persistent_volume_claim(pvc.metadata.name, config.NAMESPACE)
+            return None
+        elif pod.status.phase != 'Succeeded':
+            return 'warming'
+
+        pvc.metadata.labels[STATE_LABEL] = 'available'
+        # claims replace the PVC at this resourceVersion
+        pvc.metadata.resource_version = api.replace_namespaced_persistent_volume_claim(
+            pvc.metadata.name, config.NAMESPACE, pvc).metadata.resource_version
+        api.delete_namespaced_pod(pod_name, config.NAMESPACE)
+        logger.debug(f"Pooled PVC {pvc.metadata.name} is available")
+        return 'available'
+
+    def _recycle(self, api, claimed: list) -> None:
+        """ Delete claimed PVCs once their Job is gone """
+        if not claimed:
+            return
+        job_names = {job.metadata.name for page in list_jobs(batch_api(), job_selector(), page_size=100)
+                     for job in page.items}
+        now = datetime.now(timezone.utc)
+        for pvc in claimed:
+            annotations = pvc.metadata.annotations or {}
+            claimed_for = (now - datetime.fromisoformat(annotations[CLAIMED_ANNOTATION])).total_seconds()
+            if annotations[JOB_ANNOTATION] in job_names or claimed_for < self.claim_grace_period:
+                continue
+            logger.info(f"Job {annotations[JOB_ANNOTATION]} is gone, deleting its pooled PVC {pvc.metadata.name}")
+            api.delete_namespaced_persistent_volume_claim(pvc.metadata.name, config.NAMESPACE)
+
+    def _create(self) -> None:
+        """ Create a PVC and a warm-up pod (owned by the PVC) that binds it and fixes its permissions """
+        pvc: PersistentVolumeClaim = _instantiate_pvc(f"transfer-pool-{name_suffix()}", self.claim_size,
+                                                      self.storage_class)
+        pvc.metadata.labels[STATE_LABEL] = 'warming'
+        pvc.create(namespace=config.NAMESPACE, client=api_client())
+
+        owner = OwnerReference(apiVersion='v1', kind='PersistentVolumeClaim', name=pvc.metadata.name,
+                               uid=pvc.metadata.uid)
+        volume = Volume(name='vol-1', persistentVolumeClaim=PersistentVolumeClaimVolumeSource(
+            claimName=pvc.metadata.name))
+        pod = Pod(metadata=ObjectMeta(name=f"{pvc.metadata.name}-warm", namespace=config.NAMESPACE,
+                                      labels={'app': 'transfer', 'pool-warmer': 'true'}, ownerReferences=[owner]),
+                  spec=PodSpec(containers=[_load_volume_mount_fix()], volumes=[volume], restartPolicy='Never'))
+        pod.create(namespace=config.NAMESPACE, client=api_client())
+        logger.info(f"Created pooled PVC {pvc.metadata.name}")
+
+    def _refill_loop(self) -> None:
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                logger.error("Refilling the PVC pool failed, retrying next period", exc_info=True)
+            time.sleep(self.period)
@@ -0,0 +1,106 @@
+""" Size transfer PVCs from the target genomes in a launch message
+
+A PVC holds the transferred target genomes and the nextflow work directory:
+
+    size = base + input * (1 + headroom), clamped to [min, max] and rounded up to a whole GiB
+
+If the input cache is enabled (see cache.py) the target genomes are stored in the cache, so only the headroom is
+claimed for them.
+
+The input size is the sum of every target genome file (pgen / pvar / psam, bed / bim / fam, or vcf). Sizes declared in
+globus_details.file_sizes (file name: bytes) are used if they're set, otherwise each file is estimated from its type.
+The storage class is the first tier (config.STORAGE_TIERS) the PVC fits in.
+
+Nothing here calls the K8S API, so sizing can be checked offline against recorded launch messages:
+
+$ python -m jobsubmitter.transfer.sizing messages.jsonl
+"""
+import argparse
+import json
+import math
+from decimal import Decimal
+
+from kubernetes.utils import parse_quantity
+
+from jobsubmitter import config
+from jobsubmitter.transfer import cache
+
+GIB = 2 ** 30
+GENOME_FILES = ('pgen', 'pvar', 'psam', 'bed', 'bim', 'fam', 'vcf_path')
+# rough sizes of a whole genome file with a few thousand samples, used when a size isn't declared. Files split by
+# chromosome (chrom is set) are estimated at 1/22 of this
+ESTIMATED_SIZES = {'pgen': 4 * GIB, 'pvar': 1 * GIB, 'psam': 2 ** 20,
+                   'bed': 8 * GIB, 'bim': 1 * GIB, 'fam': 2 ** 20,
+                   'vcf_path': 16 * GIB}
+
+
+def input_size(params: dict) -> int:
+    """ Bytes of target genome files that will be transferred to the PVC """
+    declared: dict[str, int] = params.get('globus_details', {}).get('file_sizes') or {}
+    size = 0
+    for genome in params['pipeline_param']['target_genomes']:
+        for file_type in GENOME_FILES:
+            path = genome.get(file_type)
+            if not path:
+                continue
+            if path in declared:
+                size += declared[path]
+            else:
+                size += ESTIMATED_SIZES[file_type] // (22 if genome.get('chrom') else 1)
+    return size
+
+
+def pvc_size(params: dict) -> tuple[str, str]:
+    """ The storage request (e.g. 20Gi) and storage class of a launch message's transfer PVC """
+    inputs = 0 if cache.enabled() else 1  # cached inputs aren't stored on the PVC
+    size = parse_quantity(config.PVC_BASE_SIZE) + input_size(params) * (inputs + Decimal(str(config.PVC_HEADROOM)))
+    size = max(size, parse_quantity(config.PVC_MIN_SIZE))
+    if config.PVC_MAX_SIZE is not None:
+        size = min(size, parse_quantity(config.PVC_MAX_SIZE))
+    gib = math.ceil(size / GIB)
+    return f"{gib}Gi", storage_class(gib * GIB)
+
+
+def storage_class(size: int) -> str:
+    """ The storage class of the first tier that fits size bytes """
+    tiers = parse_tiers(config.STORAGE_TIERS)
+    for limit, name in tiers:
+        if limit is None or size <= limit:
+            return name
+    return tiers[-1][1]  # bigger than every tier
+
+
+def parse_tiers(tiers: str) -> list[tuple[Decimal, str]]:
+    """ Parse storage tiers, e.g. "100Gi=example-nfs-ssd,example-nfs-hdd", into (max size, storage class). A tier
+    without a size has no maximum """
+    parsed = []
+    for tier in tiers.split(','):
+        limit, _, name = tier.strip().rpartition('=')
+        parsed.append((parse_quantity(limit) if limit else None, name))
+    return parsed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Print the transfer PVC size of recorded launch messages")
+    parser.add_argument("messages", help="A JSONL file of launch messages (one message per line)")
+    parser.add_argument("--pvc_headroom", type=float, default=config.PVC_HEADROOM)
+    parser.add_argument("--pvc_base_size", default=config.PVC_BASE_SIZE)
+    parser.add_argument("--pvc_min_size", default=config.PVC_MIN_SIZE)
+    parser.add_argument("--pvc_max_size", default=config.PVC_MAX_SIZE)
+    parser.add_argument("--storage_tiers", default=config.STORAGE_TIERS)
+    args = parser.parse_args(args)
+    config.PVC_HEADROOM = args.pvc_headroom
+    config.PVC_BASE_SIZE = args.pvc_base_size
+    config.PVC_MIN_SIZE = args.pvc_min_size
+    config.PVC_MAX_SIZE = args.pvc_max_size
+    config.STORAGE_TIERS = args.storage_tiers
+
+    with open(args.messages) as f:
+        for line in filter(str.strip, f):
+            params = json.loads(line)
+            size, name = pvc_size(params)
+            print(f"{params['pipeline_param']['id']}\t{input_size(params) / GIB:.1f}Gi input\t{size}\t{name}")
+
+
+if __name__ == '__main__':
+    main()
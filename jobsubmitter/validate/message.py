@@ -4,7 +4,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def validate_message(message, validator: jsonschema.Draft202012Validator) -> dict:
+def validate_message(message, validator) -> dict:
     """ Validate JSON message structure against API schema """
     try:
         validator.validate(message)
@@ -1,22 +1,116 @@
+import copy
 import json
 import importlib.resources
+import logging
+
 from jsonschema import Draft202012Validator, RefResolver
+from jsonschema.exceptions import ValidationError
 from . import schemas
 
+logger = logging.getLogger(__name__)
+
 
-def create_validator() -> Draft202012Validator:
+def create_validator(engine: str = 'jsonschema'):
     """ Make a validator object from local schema.
 
      Don't use jsonschema.validate to validate multiple instances. The Draft202012Validator will cache the resolved
      references after the first fetch from pgsc_calc repository (checked against debug logs) .
+
+     engine 'fast' compiles the bundled schema with fastjsonschema (optional dependency), and falls back to
+     jsonschema if it's not installed. Both engines validate the same (rewritten) schemas, see read_schema.
     """
-    schemas_path = importlib.resources.path(schemas, 'api.json').parent
+    schemas_path = importlib.resources.files(schemas)
 
-    schema = json.loads(importlib.resources.read_text(schemas, 'api.json'))
+    schema = read_schema('api.json')
+    # referenced schemas are read from the store, rather than fetched by the resolver without being rewritten
+    store = {f"{schemas_path.as_uri()}/{x.name}": read_schema(x.name) for x in schemas_path.iterdir()
+             if x.name.endswith('.json')}
     resolver = RefResolver(base_uri=f"{schemas_path.as_uri()}/",
-                           referrer=schema)
+                           referrer=schema, store=store)
+    validator = Draft202012Validator(schema, resolver)
+
+    if engine == 'fast':
+        try:
+            return FastValidator(bundle_schema(), validator)
+        except ImportError:
+            logger.warning("fastjsonschema isn't installed, using jsonschema validation engine")
+
+    return validator
+
+
+class FastValidator:
+    """ Validate instances with a compiled schema
+
+    Compiled validators are much faster, but their errors aren't very helpful. Invalid instances are validated again
+    with the jsonschema validator, which raises a detailed jsonschema.exceptions.ValidationError """
+
+    def __init__(self, schema: dict, fallback: Draft202012Validator):
+        import fastjsonschema
+        self._exception = fastjsonschema.JsonSchemaException
+        # jsonschema doesn't insert defaults, so don't do it here either
+        self._validate = fastjsonschema.compile(schema, use_default=False)
+        self.fallback = fallback
+
+    def validate(self, instance) -> None:
+        try:
+            self._validate(instance)
+        except self._exception as e:
+            self.fallback.validate(instance)
+            # the engines should agree (see tests/test_validation.py), but an instance is never accepted by one alone
+            raise ValidationError(f"Rejected by the compiled schema: {e}") from e
+
+
+def bundle_schema() -> dict:
+    """ Inline the bundled schemas that api.json references into one self-contained schema
+
+    fastjsonschema only supports draft-07, so 2019-09 keywords are rewritten to draft-07 equivalents """
+    return _to_draft7(_inline_refs(read_schema('api.json')))
+
+
+def read_schema(name: str) -> dict:
+    """ Read a bundled schema
+
+    The pgsc_calc schemas declare draft-07 but use the 2019-09 dependentRequired keyword, which draft-07 validators
+    ignore. It's rewritten to its draft-07 equivalent (dependencies), so pgen, pvar and psam files are required
+    together by both engines """
+    schema = json.loads(importlib.resources.files(schemas).joinpath(name).read_text())
+    if 'draft-07' in schema.get('$schema', ''):
+        schema = _dependencies(schema)
+    return schema
+
+
+def _inline_refs(node):
+    if isinstance(node, dict):
+        if '$ref' in node:
+            ref = read_schema(node['$ref'])
+            # inlined schemas mustn't change the base URI or dialect of the bundle
+            ref = {k: v for k, v in ref.items() if k not in ('$id', '$schema')}
+            node = {k: v for k, v in node.items() if k != '$ref'} | ref
+        return {k: _inline_refs(v) for k, v in node.items()}
+    elif isinstance(node, list):
+        return [_inline_refs(x) for x in node]
+    return node
 
-    return Draft202012Validator(schema, resolver)
 
+def _to_draft7(node):
+    if isinstance(node, dict):
+        node = copy.copy(node)
+        node.pop('$schema', None)
+        # jsonschema doesn't check formats (no format_checker), and fastjsonschema rejects formats it doesn't know
+        if isinstance(node.get('format'), str):
+            del node['format']
+        if 'dependentRequired' in node:
+            node['dependencies'] = node.pop('dependentRequired')
+        return {k: _to_draft7(v) for k, v in node.items()}
+    elif isinstance(node, list):
+        return [_to_draft7(x) for x in node]
+    return node
 
 
+def _dependencies(node):
+    """ Rewrite dependentRequired to dependencies """
+    if isinstance(node, dict):
+        return {('dependencies' if k == 'dependentRequired' else k): _dependencies(v) for k, v in node.items()}
+    elif isinstance(node, list):
+        return [_dependencies(x) for x in node]
+    return node
@@ -1,53 +1,320 @@
-import json
+import contextlib
 import time
 
 import logging
 
-from kafka import KafkaProducer
-from kubernetes import client
+from kubernetes import client, watch
 
 from jobsubmitter import config
+from jobsubmitter.apiclient import batch_api
+from jobsubmitter.metrics import WATCH_LOOP_SECONDS, api_call
+from jobsubmitter.status import StatusPublisher
 
 logger = logging.getLogger(__name__)
 
+WATCH_TIMEOUT = 300  # seconds, server side timeout of a single watch request
+FOLLOWER_WATCH_TIMEOUT = 10  # seconds, shorter so a replica that becomes the leader notices quickly
+CONNECT_TIMEOUT = 10  # seconds
+READ_MARGIN = 30  # seconds allowed past the server side timeout before a silent watch is given up (half-open socket)
+LIST_READ_TIMEOUT = 60  # seconds, for a single page of the job list
+MAX_BACKOFF = 60  # seconds between attempts after unexpected errors
+STALL_TIMEOUT = 2 * (WATCH_TIMEOUT + READ_MARGIN)  # seconds without progress before the watcher counts as stalled
 
-def job_watcher(bootstrap_servers):
-    producer = KafkaProducer(bootstrap_servers=bootstrap_servers,
-                             value_serializer=lambda v: json.dumps(v).encode('utf-8'))
+_last_progress: float = time.monotonic()
+
+
+def progress() -> None:
+    """ Record that the watcher listed or watched jobs successfully """
+    global _last_progress
+    _last_progress = time.monotonic()
+
+
+def stalled() -> bool:
+    """ True if the watcher hasn't made progress for STALL_TIMEOUT seconds (stuck on a request, or failing) """
+    return time.monotonic() - _last_progress > STALL_TIMEOUT
+
+
+def job_watcher(bootstrap_servers, mode: str = 'poll', resync_period: int = 600, submitter: str = None,
+                page_size: int = 100, index=None, checkpoint=None, publisher_config: dict = None, admission=None,
+                leader=None, monitor=None, publisher: StatusPublisher = None):
+    """ Monitor jobs and publish status changes to Kafka
+
+    mode 'poll' lists jobs once a minute. mode 'stream' lists once, then streams job events from the watch API, only
+    relisting after a 410 Gone or every resync_period seconds.
+
+    Jobs are filtered server side by label, and only jobs created by submitter are watched if it's set.
+
+    The run id of every job seen is added to index (a dedupe.SubmissionIndex), if it's set. Known jobs are restored
+    from and saved to checkpoint (a checkpoint.WatchCheckpoint), if it's set. Unfinished jobs are counted by admission
+    (an admission.AdmissionController), if it's set.
+
+    If leader (a leader.LeaderElector) is set, status changes are only published while this replica is the leader.
+    Jobs are watched either way, to keep index and admission current. A replica that becomes the leader restores the
+    checkpoint and relists, so it publishes anything that changed since the last leader's checkpoint.
+
+    If monitor (a monitor.PodMonitor) is set, it publishes finer grained states of started jobs with the same producer.
+
+    publisher_config is passed to status.StatusPublisher (e.g. linger_ms), unless publisher is an already created
+    StatusPublisher """
+    producer = publisher or StatusPublisher(bootstrap_servers, **(publisher_config or {}))
 
     if not producer.bootstrap_connected():
         logger.critical("Can't connect to kafka broker")
         raise RuntimeError()
     else:
         logger.debug("Producer connected to bootstrap server")
-        logger.info(f"Job watch starting")
+        logger.info(f"Job watch starting ({mode} mode)")
+        producer.start()
+
+    api_client = batch_api()
+    selector: str = job_selector(submitter)
+    logger.info(f"Watching jobs with label selector {selector}")
 
-    api_client = client.BatchV1Api()
     known_jobs: dict[str, str] = {}
+    if checkpoint is not None:
+        if leader is None:
+            known_jobs = checkpoint.restore()
+        checkpoint.start(producer)
+    if leader is not None:
+        producer = _LeaderOnly(producer, leader)
+    if monitor is not None:
+        monitor.start(producer)
+
+    if mode == 'stream':
+        _stream_jobs(producer, api_client, selector, page_size, resync_period, known_jobs, index, checkpoint,
+                     admission, leader)
+    else:
+        _poll_jobs(producer, api_client, selector, page_size, known_jobs, index, checkpoint, admission, leader)
+
 
+def job_selector(submitter: str = None) -> str:
+    """ A label selector matching pgsc-calc jobs (see job/manifests/pgsc-job.yaml) """
+    selector = 'app=nextflow,run-id'
+    if submitter is not None:
+        selector += f',submitter={submitter}'
+    return selector
+
+
+class _LeaderOnly:
+    """ A StatusPublisher that drops status messages while this replica isn't the leader """
+
+    def __init__(self, producer: StatusPublisher, leader):
+        self._producer = producer
+        self._leader = leader
+
+    def send(self, *args, **kwargs) -> None:
+        if self._leader.is_leader:
+            self._producer.send(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._producer, name)
+
+
+def _take_over(checkpoint) -> dict[str, str]:
+    """ Known jobs for a replica that just became the leader: the last status the previous leader saved """
+    logger.info("Leading the job watch, publishing status changes")
+    return checkpoint.restore() if checkpoint is not None else {}
+
+
+def _poll_jobs(producer, api_client, selector: str, page_size: int, known_jobs: dict[str, str], index, checkpoint,
+               admission, leader=None):
+    leading = leader is None
     while True:
-        logger.info("Getting list of jobs")
-        jobs = api_client.list_namespaced_job(config.NAMESPACE)
+        if leader is not None and leader.is_leader != leading:
+            leading = leader.is_leader
+            if leading:
+                known_jobs = _take_over(checkpoint)
 
-        if len(jobs.items) == 0:
-            logger.debug("Found no jobs in job list, sleeping 1 minute")
-            known_jobs: dict[str, str] = _prune_jobs(known_jobs, jobs)
+        logger.info("Getting list of jobs")
+        try:
+            with WATCH_LOOP_SECONDS.labels('list').time(), api_call('list_jobs'):
+                known_jobs, _ = _sync_jobs(producer, api_client, selector, page_size, known_jobs, index, admission,
+                                           checkpoint)
+            _save(checkpoint, known_jobs)
+            progress()
+        except client.exceptions.ApiException as e:
+            if e.status == 410:
+                logger.info("Job list continue token expired (410 Gone), retrying next poll")
+            else:
+                logger.exception("Job list failed, retrying next poll")
+        except Exception:
+            logger.exception("Job list failed, retrying next poll")
+        logger.debug("Sleeping 1 minute")
+        if leading:
             time.sleep(60)
         else:
-            logger.debug("Found jobs in job list")
-            for job in jobs.items:
-                if 'pgsc-calc' in job.metadata.name:
-                    logger.debug(f"Found pgsc-calc job {job.metadata.name}")
-                    run_id: str
-                    status: str
-                    uid, run_id, status = _get_job_status(job)
-                    pruned_jobs: dict[str, str] = _prune_jobs(known_jobs, jobs)
-                    known_jobs: dict[str, str] = _update_jobs(producer=producer, pipeline_id=uid, run_id=run_id, status=status, known_jobs=pruned_jobs)
-                else:
-                    logger.debug("Job not pgsc-calc, ignoring")
-                    continue
-            logger.debug("Sleeping 1 minute")
-            time.sleep(60)
+            leader.wait(60)  # list again as soon as this replica becomes the leader
+
+
+def _stream_jobs(producer, api_client, selector: str, page_size: int, resync_period: int,
+                 known_jobs: dict[str, str], index, checkpoint, admission, leader=None):
+    resource_version = None
+    last_sync: float = 0
+    leading = leader is None
+    backoff: float = 0
+
+    while True:
+        if leader is not None and leader.is_leader != leading:
+            leading = leader.is_leader
+            if leading:
+                known_jobs = _take_over(checkpoint)
+                resource_version = None  # relist
+
+        try:
+            if resource_version is None or time.monotonic() - last_sync > resync_period:
+                logger.info("Getting list of jobs (resync)")
+                with WATCH_LOOP_SECONDS.labels('list').time(), api_call('list_jobs'):
+                    known_jobs, resource_version = _sync_jobs(producer, api_client, selector, page_size, known_jobs,
+                                                              index, admission, checkpoint)
+                _save(checkpoint, known_jobs)
+                last_sync = time.monotonic()
+                progress()
+
+            with api_call('watch_jobs'):
+                resource_version, known_jobs = _watch_jobs(producer, api_client, selector, resource_version,
+                                                           known_jobs, index, checkpoint, admission, leader,
+                                                           leading)
+            progress()
+            backoff = 0
+        except client.exceptions.ApiException as e:
+            if e.status == 410:
+                logger.info("Job resourceVersion expired (410 Gone), relisting")
+                resource_version = None
+            else:
+                backoff = _failed(backoff)
+                resource_version = None
+        except Exception:
+            backoff = _failed(backoff)
+            resource_version = None
+
+
+def _failed(backoff: float) -> float:
+    """ Log an unexpected watch error and wait before relisting. Returns the next backoff """
+    backoff = min(max(2 * backoff, 1), MAX_BACKOFF)
+    logger.exception(f"Job watch failed, relisting in {backoff:.0f} s")
+    time.sleep(backoff)
+    return backoff
+
+
+def _watch_jobs(producer, api_client, selector: str, resource_version: str,
+                known_jobs: dict[str, str], index=None, checkpoint=None,
+                admission=None, leader=None, leading: bool = True) -> tuple[str, dict[str, str]]:
+    """ Stream job events from resource_version until the server closes the watch, or leadership changes
+
+    Returns the last seen resourceVersion (including bookmarks), so the next watch can resume without relisting """
+    logger.debug(f"Watching jobs from resourceVersion {resource_version}")
+    timeout = WATCH_TIMEOUT if leading else FOLLOWER_WATCH_TIMEOUT
+    w = watch.Watch()
+    for event in w.stream(api_client.list_namespaced_job, config.NAMESPACE,
+                          label_selector=selector,
+                          resource_version=resource_version,
+                          allow_watch_bookmarks=True,
+                          timeout_seconds=timeout,
+                          _request_timeout=(CONNECT_TIMEOUT, timeout + READ_MARGIN)):
+        if leader is not None and leader.is_leader != leading:
+            w.stop()
+            break
+
+        progress()
+        if event['type'] == 'BOOKMARK':
+            resource_version = event['raw_object']['metadata']['resourceVersion']
+            logger.debug(f"Bookmark at resourceVersion {resource_version}")
+            continue
+
+        with WATCH_LOOP_SECONDS.labels('event').time():
+            job = event['object']
+            resource_version = job.metadata.resource_version
+            known_jobs = _forget_unsent(producer, known_jobs, checkpoint)
+
+            if event['type'] == 'DELETED':
+                logger.debug(f"Removing {job.metadata.name} from known jobs (cleaned up by K8S)")
+                known_jobs.pop(job.metadata.name, None)
+                if admission is not None:
+                    admission.release(job.metadata.labels.get('run-id'))
+            else:
+                uid, run_id, status = _get_job_status(job)
+                if index is not None:
+                    index.add(uid)
+                if admission is not None:
+                    admission.observe(uid, status)
+                known_jobs = _update_jobs(producer=producer, pipeline_id=uid, run_id=run_id, status=status,
+                                          known_jobs=known_jobs, finished_at=_finished_at(job))
+            _save(checkpoint, known_jobs, [job.metadata.name])
+
+    return resource_version, known_jobs
+
+
+def list_jobs(api_client, selector: str, page_size: int):
+    """ List jobs matching a label selector one page at a time
+
+    Yields pages, so only page_size jobs are held in memory at once. All pages share the resourceVersion of the
+    first page (a consistent snapshot) """
+    _continue = None
+    while True:
+        page = api_client.list_namespaced_job(config.NAMESPACE, label_selector=selector, limit=page_size,
+                                              _continue=_continue,
+                                              _request_timeout=(CONNECT_TIMEOUT, LIST_READ_TIMEOUT))
+        yield page
+        _continue = page.metadata._continue
+        if not _continue:
+            break
+
+
+def _sync_jobs(producer, api_client, selector: str, page_size: int,
+               known_jobs: dict[str, str], index=None, admission=None, checkpoint=None) -> tuple[dict[str, str], str]:
+    """ Send messages for any status changes in the job list, then prune cleaned up jobs
+
+    Returns updated known jobs and the resourceVersion of the list """
+    job_names: set[str] = set()
+    active: set[str] = set()  # run ids of unfinished jobs
+    listed_at: float = time.monotonic()
+    resource_version = None
+    known_jobs = _forget_unsent(producer, known_jobs, checkpoint)
+
+    for page in list_jobs(api_client, selector, page_size):
+        resource_version = resource_version or page.metadata.resource_version
+        logger.debug(f"Found {len(page.items)} jobs in job list page")
+        for job in page.items:
+            logger.debug(f"Found pgsc-calc job {job.metadata.name}")
+            job_names.add(job.metadata.name)
+            run_id: str
+            status: str
+            uid, run_id, status = _get_job_status(job)
+            if index is not None:
+                index.add(uid)
+            if status not in ('completed', 'failed'):
+                active.add(uid)
+            known_jobs = _update_jobs(producer=producer, pipeline_id=uid, run_id=run_id, status=status,
+                                      known_jobs=known_jobs, finished_at=_finished_at(job))
+
+    if admission is not None:
+        admission.sync(active, listed_at)
+    return _prune_jobs(known_jobs, job_names), resource_version
+
+
+def _forget_unsent(producer: StatusPublisher, known_jobs: dict[str, str], checkpoint=None) -> dict[str, str]:
+    """ Forget the status of jobs with failed messages, so the next update sends them again
+
+    The checkpoint forgets them at the same time: once they're popped, the publisher no longer reports them
+    unconfirmed """
+    with checkpoint.lock if checkpoint is not None else contextlib.nullcontext():
+        unsent = producer.pop_unsent()
+        for run_id in unsent:
+            logger.info(f"Status message for job {run_id} wasn't delivered, will send again")
+            known_jobs.pop(run_id, None)
+        if unsent:
+            _save(checkpoint, known_jobs, unsent)
+    return known_jobs
+
+
+def _save(checkpoint, known_jobs: dict[str, str], names=None) -> None:
+    """ Record every known job in the checkpoint, or only names """
+    if checkpoint is None:
+        return
+    if names is None:
+        checkpoint.save(known_jobs)
+    else:
+        checkpoint.update(known_jobs, names)
 
 
 def _get_job_status(job) -> tuple[str, str, str]:
@@ -65,24 +332,37 @@ def _get_job_status(job) -> tuple[str, str, str]:
     return uid, run_id, status
 
 
-def _update_jobs(producer, pipeline_id: str, run_id: str, status: str, known_jobs: dict[str, str]) -> dict[str, str]:
+def _finished_at(job) -> float:
+    """ When a job completed or failed (seconds since the epoch, second resolution), or None if it's still running """
+    if job.status.completion_time is not None:
+        return job.status.completion_time.timestamp()
+    for condition in job.status.conditions or []:
+        if condition.type == 'Failed' and condition.status == 'True' and condition.last_transition_time is not None:
+            return condition.last_transition_time.timestamp()
+    return None
+
+
+def _update_jobs(producer, pipeline_id: str, run_id: str, status: str, known_jobs: dict[str, str],
+                 finished_at: float = None) -> dict[str, str]:
     if run_id in known_jobs:
         if known_jobs[run_id] == status:
             logger.info(f"Message already sent for job {run_id}")
             return known_jobs
         else:
             logger.info(f"Status change for job {run_id}")
-            _send_message(producer=producer, status=status, run_id=run_id, pipeline_id=pipeline_id)
+            _send_message(producer=producer, status=status, run_id=run_id, pipeline_id=pipeline_id,
+                          finished_at=finished_at)
     else:
         logger.info(f"New job found: {run_id}")
-        _send_message(producer=producer, status=status, run_id=run_id, pipeline_id=pipeline_id)
+        _send_message(producer=producer, status=status, run_id=run_id, pipeline_id=pipeline_id,
+                      finished_at=finished_at)
 
-    return known_jobs | {run_id: status}
+    known_jobs[run_id] = status
+    return known_jobs
 
 
-def _prune_jobs(known_jobs: dict[str, str], job_list) -> dict[str, str]:
+def _prune_jobs(known_jobs: dict[str, str], job_names: set[str]) -> dict[str, str]:
     # If a job is known but missing from the job list, it's been cleaned up, so remove it
-    job_names: set = {x.metadata.name for x in job_list.items}
     missing_jobs = set(known_jobs.keys()).difference(job_names)
     if missing_jobs:
         for x in missing_jobs:
@@ -93,7 +373,7 @@ def _prune_jobs(known_jobs: dict[str, str], job_list) -> dict[str, str]:
     return known_jobs
 
 
-def _send_message(producer, status: str, run_id: str, pipeline_id: str) -> None:
+def _send_message(producer, status: str, run_id: str, pipeline_id: str, finished_at: float = None) -> None:
     message = {'status': status.upper(), 'pipeline_id': pipeline_id, 'outdir': ""}
-    logger.debug(f"Sending message for job {run_id}: {message}")
-    producer.send('pipeline-status', message)
+    logger.debug(f"Queueing message for job {run_id}: {message}")
+    producer.send(run_id, message, finished_at)
@@ -0,0 +1,19 @@
+import kubernetes
+import pytest
+
+from benchmarks.fakes import FakeApiServer
+from jobsubmitter import apiclient, config
+
+NAMESPACE = 'test'
+
+
+@pytest.fixture
+def api_server(monkeypatch) -> FakeApiServer:
+    """ A fake Kubernetes API server, used by the shared API client """
+    server = FakeApiServer(job_start_s=60)
+    server.start()
+    kubernetes.client.Configuration.set_default(kubernetes.client.Configuration(host=server.url))
+    apiclient.configure(qps=0, retries=0)
+    monkeypatch.setattr(config, 'NAMESPACE', NAMESPACE)
+    yield server
+    server.stop()
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+from kafka import TopicPartition
+from kubernetes.utils import parse_quantity
+
+from jobsubmitter.admission import AdmissionController, storage_request
+
+TP = TopicPartition('pipeline-launch', 0)
+
+
+class _Executor:
+    """ A SubmissionExecutor that records submitted run ids """
+
+    def __init__(self):
+        self.held: list[int] = []
+        self.skipped: list[int] = []
+        self.submitted: list[str] = []
+        self._lock = threading.Condition()
+
+    def hold(self, tp: TopicPartition, offset: int) -> None:
+        self.held.append(offset)
+
+    def skip(self, tp: TopicPartition, offset: int) -> None:
+        self.skipped.append(offset)
+
+    def submit(self, key: str, tp: TopicPartition, offset: int, *args) -> None:
+        with self._lock:
+            self.submitted.append(key)
+            self._lock.notify_all()
+
+    def wait(self, n: int, timeout: float = 2) -> list[str]:
+        """ Wait for n submissions (or timeout), and return them """
+        with self._lock:
+            self._lock.wait_for(lambda: len(self.submitted) >= n, timeout)
+            return list(self.submitted)
+
+
+class _Publisher:
+    """ A StatusPublisher that records what was sent """
+
+    def __init__(self):
+        self.sent: list[tuple[str, str]] = []
+
+    def send(self, run_id: str, message: dict, finished_at: float = None, source: str = 'watch') -> None:
+        self.sent.append((run_id, message['status']))
+
+
+@pytest.fixture
+def executor() -> _Executor:
+    return _Executor()
+
+
+def _controller(executor: _Executor, publisher: _Publisher = None, **limits) -> AdmissionController:
+    admission = AdmissionController(executor, limits={k: parse_quantity(v) for k, v in limits.items()},
+                                    publisher=publisher)
+    admission.start()
+    admission.sync(set(), time.monotonic())
+    return admission
+
+
+def test_storage_counted_per_run(executor):
+    """ Each run reserves the storage its own PVC requests, not the default request """
+    admission = _controller(executor, storage='100Gi')
+    admission.submit('run-1', TP, 0, 0, storage=parse_quantity('60Gi'))
+    admission.submit('run-2', TP, 1, 0, storage=parse_quantity('60Gi'))
+    assert executor.wait(2, timeout=0.2) == ['run-1']
+
+    admission.release('run-1')
+    assert executor.wait(2) == ['run-1', 'run-2']
+
+
+def test_small_runs_share_storage(executor):
+    admission = _controller(executor, storage='100Gi')
+    for offset in range(4):
+        admission.submit(f"run-{offset}", TP, offset, 0, storage=parse_quantity('25Gi'))
+    assert len(executor.wait(4)) == 4
+
+
+def test_storage_over_limit_rejected(executor):
+    """ A run that needs more storage than the limit can never be admitted, so it mustn't block the queue """
+    publisher = _Publisher()
+    admission = _controller(executor, publisher, storage='100Gi')
+    assert not admission.submit('run-1', TP, 0, 0, storage=parse_quantity('310Gi'))
+    assert admission.submit('run-2', TP, 1, 0, storage=parse_quantity('60Gi'))
+
+    assert executor.wait(1) == ['run-2']
+    assert executor.skipped == [0]
+    assert publisher.sent == [('run-1', 'FAILED')]
+    assert admission.queued == 0
+
+
+def test_queued_request_rejected_when_limit_shrinks(executor):
+    publisher = _Publisher()
+    admission = _controller(executor, publisher, storage='100Gi')
+    admission.submit('run-1', TP, 0, 0, storage=parse_quantity('60Gi'))
+    admission.submit('run-2', TP, 1, 0, storage=parse_quantity('80Gi'))
+    admission.submit('run-3', TP, 2, 0, storage=parse_quantity('20Gi'))
+    assert executor.wait(1) == ['run-1']
+
+    with admission._lock:
+        admission._quota_limits = {'storage': parse_quantity('70Gi')}  # e.g. the ResourceQuota was lowered
+    admission.release('run-1')
+
+    assert executor.wait(2) == ['run-1', 'run-3']
+    assert publisher.sent == [('run-2', 'FAILED')]
+
+
+def test_storage_request_from_message():
+    """ Empty inputs only need the base size """
+    params = {'pipeline_param': {'id': 'INT000001', 'target_genomes': [
+        {'pgen': 'a.pgen', 'pvar': 'a.pvar', 'psam': 'a.psam', 'chrom': None}]},
+        'globus_details': {'file_sizes': {'a.pgen': 0, 'a.pvar': 0, 'a.psam': 0}}}
+    assert storage_request(params) == parse_quantity('10Gi')
@@ -0,0 +1,114 @@
+import pytest
+from kubernetes import client
+
+from jobsubmitter import apiclient
+from jobsubmitter.apiclient import RateLimitedApiClient, TokenBucket
+
+
+class Clock:
+    """ Replaces the time module in apiclient: sleeping advances monotonic time, and is recorded """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: list[float] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class MaxJitter:
+    """ Replaces the random module in apiclient: jitter is always the most it can be """
+
+    @staticmethod
+    def uniform(a: float, b: float) -> float:
+        return b
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(apiclient, 'time', clock)
+    monkeypatch.setattr(apiclient, 'random', MaxJitter)
+    return clock
+
+
+@pytest.fixture
+def responses(monkeypatch) -> list:
+    """ Responses of the underlying ApiClient.request, in order. Exceptions are raised """
+    responses = []
+
+    def request(self, method, url, *args, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(client.ApiClient, 'request', request)
+    return responses
+
+
+def _error(status: int, retry_after: str = None) -> client.exceptions.ApiException:
+    e = client.exceptions.ApiException(status=status, reason='error')
+    e.headers = {'Retry-After': retry_after} if retry_after is not None else {}
+    return e
+
+
+def test_bucket_burst(clock):
+    bucket = TokenBucket(qps=2, burst=3)
+    assert [bucket.acquire() for _ in range(5)] == [0, 0, 0, 0.5, 0.5]
+    assert clock.now == 1
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(qps=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 1  # two tokens
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0.5]
+
+    clock.now += 60  # refilled up to burst, not 120 tokens
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_retry_after(clock, responses):
+    responses.extend([_error(429, '2'), 'ok'])
+    api = RateLimitedApiClient(qps=0, retries=3, backoff=0.2)
+    assert api.request('POST', '/api/v1/pods') == 'ok'
+    assert clock.sleeps == [2.2]  # Retry-After and jitter
+    assert not responses
+
+
+def test_backoff_without_retry_after(clock, responses):
+    responses.extend([_error(429)] * 5 + ['ok'])
+    api = RateLimitedApiClient(qps=0, retries=5, backoff=1)
+    assert api.request('GET', '/api/v1/pods') == 'ok'
+    assert clock.sleeps == [1, 2, 4, 8, 10]  # exponential, capped at _MAX_BACKOFF
+
+
+def test_gives_up_after_retries(clock, responses):
+    responses.extend([_error(503)] * 3 + ['ok'])
+    api = RateLimitedApiClient(qps=0, retries=2, backoff=0.2)
+    with pytest.raises(client.exceptions.ApiException) as e:
+        api.request('GET', '/api/v1/pods')
+    assert e.value.status == 503
+    assert clock.sleeps == [0.2, 0.4]
+    assert responses == ['ok']  # the first attempt and 2 retries
+
+
+def test_server_errors_only_retried_if_idempotent(clock, responses):
+    responses.extend([_error(503), 'ok'])
+    api = RateLimitedApiClient(qps=0, retries=3)
+    with pytest.raises(client.exceptions.ApiException):
+        api.request('POST', '/api/v1/pods')
+    assert clock.sleeps == []
+
+
+def test_retries_take_a_token(clock, responses):
+    responses.extend([_error(429, '0'), 'ok'])
+    api = RateLimitedApiClient(qps=1, burst=1, retries=1, backoff=0)
+    assert api.request('GET', '/api/v1/pods') == 'ok'
+    assert clock.sleeps == [0, 1]  # Retry-After, then waiting for a token
@@ -0,0 +1,96 @@
+import pytest
+
+from jobsubmitter import config, watch
+from jobsubmitter.apiclient import batch_api
+from jobsubmitter.checkpoint import WatchCheckpoint
+
+
+class _Publisher:
+    """ A StatusPublisher that records what was sent, and confirms delivering everything except unconfirmed """
+
+    def __init__(self, unconfirmed: set[str] = ()):
+        self.sent: list[str] = []
+        self._unconfirmed = set(unconfirmed)
+        self._unsent: set[str] = set()
+
+    def send(self, run_id: str, message: dict, finished_at: float = None, source: str = 'watch') -> None:
+        self.sent.append(run_id)
+
+    def unconfirmed(self) -> set[str]:
+        return self._unconfirmed | self._unsent
+
+    def pop_unsent(self) -> set[str]:
+        unsent, self._unsent = self._unsent, set()
+        return unsent
+
+
+def _checkpoint(publisher: _Publisher) -> WatchCheckpoint:
+    checkpoint = WatchCheckpoint()
+    checkpoint.publisher = publisher
+    return checkpoint
+
+
+def test_only_confirmed_statuses_saved(api_server):
+    publisher = _Publisher()
+    checkpoint = _checkpoint(publisher)
+    checkpoint.save({'job-a': 'started', 'job-b': 'started'})
+    checkpoint.flush()
+
+    known_jobs = {'job-a': 'completed', 'job-c': 'started'}
+    publisher._unconfirmed = {'job-a', 'job-c'}
+    checkpoint.update(known_jobs, ['job-a', 'job-b', 'job-c'])  # job-b was deleted
+    checkpoint.flush()
+    # job-a keeps the status saved before, job-c isn't saved until its message is delivered
+    assert WatchCheckpoint().restore() == {'job-a': 'started'}
+
+    publisher._unconfirmed = set()
+    checkpoint.flush()  # nothing changed since, but unconfirmed statuses are written once they're delivered
+    assert WatchCheckpoint().restore() == known_jobs
+
+
+def test_unsent_statuses_forgotten(api_server):
+    publisher = _Publisher()
+    checkpoint = _checkpoint(publisher)
+    known_jobs = {'job-a': 'started', 'job-b': 'started'}
+    checkpoint.save(known_jobs)
+    publisher._unsent = {'job-b'}
+
+    assert watch._forget_unsent(publisher, known_jobs, checkpoint) == {'job-a': 'started'}
+    checkpoint.flush()
+    assert WatchCheckpoint().restore() == {'job-a': 'started'}
+
+
+def test_restarted_watcher_sends_unconfirmed_statuses(api_server):
+    """ A watcher restored from the checkpoint sends the statuses that weren't delivered before it stopped """
+    for name in ('pgsc-calc-a', 'pgsc-calc-b'):
+        api_server.create('jobs', config.NAMESPACE,
+                          {'metadata': {'name': name, 'labels': {'app': 'nextflow', 'run-id': name}},
+                           'spec': {'template': {'spec': {'containers': []}}}})
+    publisher = _Publisher(unconfirmed={'pgsc-calc-b'})
+    checkpoint = _checkpoint(publisher)
+    known_jobs, _ = watch._sync_jobs(publisher, batch_api(), watch.job_selector(), 10, {}, checkpoint=checkpoint)
+    watch._save(checkpoint, known_jobs)
+    checkpoint.flush()
+    assert sorted(publisher.sent) == ['pgsc-calc-a', 'pgsc-calc-b']
+
+    # restarted before pgsc-calc-b's message was delivered
+    publisher = _Publisher()
+    watch._sync_jobs(publisher, batch_api(), watch.job_selector(), 10, WatchCheckpoint().restore())
+    assert publisher.sent == ['pgsc-calc-b']
+
+
+def test_write_retried(api_server, monkeypatch):
+    checkpoint = _checkpoint(_Publisher())
+    checkpoint.save({'job-a': 'started'})
+    write = checkpoint._write
+
+    def unavailable(known_jobs: dict) -> None:
+        raise ConnectionError()
+
+    monkeypatch.setattr(checkpoint, '_write', unavailable)
+    with pytest.raises(ConnectionError):
+        checkpoint.flush()
+
+    monkeypatch.setattr(checkpoint, '_write', write)
+    checkpoint.flush()
+    assert WatchCheckpoint().restore() == {'job-a': 'started'}
@@ -0,0 +1,117 @@
+from kafka import TopicPartition
+
+from benchmarks.fakes import InMemoryKafka
+from jobsubmitter.executor import OffsetTracker, RebalanceListener, SubmissionExecutor
+
+TP = TopicPartition('pipeline-launch', 0)
+
+
+def test_offsets_out_of_order():
+    """ A rebalance or seek delivers lower offsets than ones already tracked """
+    tracker = OffsetTracker()
+    for offset in (5, 6):
+        tracker.add(TP, offset)
+        tracker.done(TP, offset)
+    tracker.add(TP, 3)
+    assert tracker.committable() == {}
+
+    tracker.done(TP, 3)
+    assert tracker.committable()[TP].offset == 7
+
+
+def test_failed_offset_held_until_redelivered():
+    tracker = OffsetTracker()
+    for offset in (0, 1, 2):
+        tracker.add(TP, offset)
+    tracker.done(TP, 0)
+    tracker.failed(TP, 1)
+    tracker.done(TP, 2)
+    assert tracker.committable()[TP].offset == 1
+    assert tracker.committable() == {}
+
+    tracker.add(TP, 1)  # delivered again after a seek
+    assert tracker.committable() == {}
+    tracker.done(TP, 1)
+    assert tracker.committable()[TP].offset == 3
+
+
+def test_redelivery_while_in_flight():
+    """ A duplicate delivery that's dropped doesn't complete the first delivery """
+    tracker = OffsetTracker()
+    tracker.add(TP, 0)
+    tracker.add(TP, 0)
+    tracker.done(TP, 0)
+    assert tracker.committable() == {}
+    tracker.done(TP, 0)
+    assert tracker.committable()[TP].offset == 1
+
+
+def _run(executor: SubmissionExecutor, offset: int) -> None:
+    executor.hold(TP, offset)
+    executor.submit('run', TP, offset, offset)
+    executor.join()
+
+
+def test_failed_submission_is_not_committed():
+    failures = {1}
+    executor = SubmissionExecutor(lambda offset: _fail_if(offset in failures), retries=1, retry_backoff=0)
+    for offset in (0, 1, 2):
+        _run(executor, offset)
+
+    assert executor.committable()[TP].offset == 1
+    assert executor.rewinds() == {TP: 1}
+
+    failures.clear()
+    for offset in (1, 2):  # consumed again
+        _run(executor, offset)
+    assert executor.committable()[TP].offset == 3
+    assert executor.rewinds() == {}
+
+
+def test_failed_submission_given_up_after_retries():
+    executor = SubmissionExecutor(lambda offset: _fail_if(True), retries=1, retry_backoff=0)
+    _run(executor, 0)
+    assert executor.rewinds() == {TP: 0}
+    _run(executor, 0)
+    assert executor.rewinds() == {}
+    assert executor.committable()[TP].offset == 1
+
+
+def test_rewind_waits_for_backoff():
+    executor = SubmissionExecutor(lambda offset: _fail_if(True), retries=1, retry_backoff=60)
+    _run(executor, 0)
+    assert executor.rewinds() == {}
+
+
+def test_revoke_and_reassign():
+    """ A revoked partition's failed offset and rewind are forgotten, and it's consumed from its committed offset
+    when it's assigned again """
+    kafka = InMemoryKafka()
+    for value in (b'0', b'1', b'2'):
+        kafka.produce(TP.topic, value)
+    failures = {1}
+    executor = SubmissionExecutor(lambda offset: _fail_if(offset in failures), retries=5, retry_backoff=0)
+    consumer = kafka.consumer()
+    listener = RebalanceListener()
+    listener.bind(consumer, executor)
+    consumer.subscribe([TP.topic], listener=listener)
+
+    for message in consumer.poll(max_records=3)[TP]:
+        _run(executor, message.offset)
+    consumer.commit(executor.committable())
+    assert kafka.committed[TP] == 1
+
+    consumer.rebalance()
+    assert executor.rewinds() == {}
+    assert executor.committable() == {}
+    assert consumer.position(TP) == 1
+
+    failures.clear()
+    for message in consumer.poll(max_records=3)[TP]:
+        _run(executor, message.offset)
+    assert executor.committable()[TP].offset == 3
+
+
+def _fail_if(fail: bool) -> None:
+    if fail:
+        raise RuntimeError("submission failed")
@@ -0,0 +1,24 @@
+import time
+
+from urllib3.exceptions import MaxRetryError
+
+from jobsubmitter.leader import LeaderElector
+
+
+def test_steps_down_on_connection_errors():
+    elector = LeaderElector('replica-0', lease_duration=0.7)
+    reachable = [True]
+
+    def try_acquire():
+        if reachable[0] is not False:
+            return reachable[0]  # True to renew, None once the test is done
+        raise MaxRetryError(None, '/apis/coordination.k8s.io/v1/leases', 'connection refused')
+
+    elector.try_acquire = try_acquire
+    elector.start()
+    assert elector.wait(1)
+
+    reachable[0] = False
+    time.sleep(elector.renew_deadline + 2 * elector.renew_period)
+    assert not elector.is_leader
+    reachable[0] = None
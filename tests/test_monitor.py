@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from kubernetes.client import (V1ContainerState, V1ContainerStateRunning, V1ContainerStateTerminated,
+                               V1ContainerStateWaiting, V1ContainerStatus, V1ObjectMeta,
+                               V1PersistentVolumeClaimVolumeSource, V1Pod, V1PodCondition, V1PodSpec, V1PodStatus,
+                               V1Volume)
+
+from jobsubmitter import config
+from jobsubmitter.apiclient import core_api
+from jobsubmitter.monitor import PodMonitor, pod_phase
+
+CREATED = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _at(minutes: int) -> datetime:
+    return CREATED + timedelta(minutes=minutes)
+
+
+def _state(state: str, minutes: int = 0, reason: str = None) -> V1ContainerState:
+    """ A container state: waiting, running (started at minutes) or terminated (started then, finished a minute
+    later) """
+    if state == 'waiting':
+        return V1ContainerState(waiting=V1ContainerStateWaiting(reason=reason))
+    if state == 'running':
+        return V1ContainerState(running=V1ContainerStateRunning(started_at=_at(minutes)))
+    return V1ContainerState(terminated=V1ContainerStateTerminated(exit_code=0, started_at=_at(minutes),
+                                                                  finished_at=_at(minutes + 1)))
+
+
+def _status(name: str, state: V1ContainerState, restarts: int = 0) -> V1ContainerStatus:
+    return V1ContainerStatus(name=name, image='image', image_id='', ready=False, restart_count=restarts, state=state)
+
+
+def _pod(init: list = None, driver: V1ContainerState = None, phase: str = 'Pending', conditions: list = None,
+         restarts: int = 0, claims: list = ()) -> V1Pod:
+    """ A driver pod with two initContainers (volume mount fix, transfer) """
+    volumes = [V1Volume(name=f"vol-{i}", persistent_volume_claim=V1PersistentVolumeClaimVolumeSource(claim_name=x))
+               for i, x in enumerate(claims)]
+    return V1Pod(metadata=V1ObjectMeta(name='pgsc-calc-a', creation_timestamp=CREATED,
+                                       labels={'job-name': 'pgsc-calc-a', 'run-id': 'INT000001'}),
+                 spec=V1PodSpec(containers=[], volumes=volumes),
+                 status=V1PodStatus(phase=phase, conditions=conditions,
+                                    init_container_statuses=[_status(f"init-{i}", x) for i, x in enumerate(init or [])],
+                                    container_statuses=[_status('nextflow', driver or _state('waiting',
+                                                                                           reason='PodInitializing'),
+                                                                restarts)]))
+
+
+def test_phase_queued_until_scheduled():
+    condition = V1PodCondition(type='PodScheduled', status='False', reason='Unschedulable', message='no nodes')
+    pod = _pod([_state('waiting'), _state('waiting')], conditions=[condition])
+    assert pod_phase(pod) == ('queued', CREATED, 'Unschedulable: no nodes')
+
+
+def test_phase_transferring_while_init_containers_run():
+    assert pod_phase(_pod([_state('running', 2), _state('waiting')])) == ('transferring', _at(2), None)
+    assert pod_phase(_pod([_state('terminated', 2), _state('running', 3)])) == ('transferring', _at(2), None)
+
+
+def test_phase_queued_after_transfer():
+    """ A driver waiting for its image once the transfer finished isn't transferring """
+    pod = _pod([_state('terminated', 2), _state('terminated', 3)], _state('waiting', reason='ImagePullBackOff'))
+    assert pod_phase(pod) == ('queued', _at(4), 'ImagePullBackOff')
+
+
+def test_phase_running_and_finished():
+    assert pod_phase(_pod([_state('terminated', 2), _state('terminated', 3)], _state('running', 5),
+                          phase='Running')) == ('running', _at(5), None)
+    assert pod_phase(_pod(phase='Succeeded')) == (None, None, None)
+
+
+def test_stuck():
+    monitor = PodMonitor(deadlines={'transferring': 600, 'running': None}, max_restarts=2)
+    pod = _pod()
+    assert monitor._stuck(pod, 'transferring', 601) == "transferring for 601s, deadline 600s"
+    assert monitor._stuck(pod, 'transferring', 599) is None
+    assert monitor._stuck(pod, 'running', 10 ** 6) is None  # no deadline
+    assert monitor._stuck(_pod(restarts=3), 'running', 0) == "3 container restarts, maximum 2"
+    assert monitor._stuck(_pod(restarts=2), 'running', 0) is None
+
+
+def test_fail_patches_job_and_deletes_pvc(api_server, monkeypatch):
+    monkeypatch.setattr(config, 'INPUT_CACHE_PVC', 'input-cache')
+    api_server.create('jobs', config.NAMESPACE, {'metadata': {'name': 'pgsc-calc-a'},
+                                                 'spec': {'template': {'spec': {'containers': []}}}})
+    for name in ('transfer-a', 'input-cache'):
+        api_server.create('persistentvolumeclaims', config.NAMESPACE, {'metadata': {'name': name}})
+
+    PodMonitor()._fail(core_api(), _pod(claims=['transfer-a', 'input-cache']), 'pgsc-calc-a', 'transferring', 'stuck')
+
+    assert api_server.patches == [('jobs', 'pgsc-calc-a', 'application/json-patch+json',
+                                   [{'op': 'add', 'path': '/spec/activeDeadlineSeconds', 'value': 1}])]
+    assert api_server.objects('jobs', config.NAMESPACE)['pgsc-calc-a']['spec']['activeDeadlineSeconds'] == 1
+    assert set(api_server.objects('persistentvolumeclaims', config.NAMESPACE)) == {'input-cache'}
+
+
+def test_fail_job_already_gone(api_server):
+    PodMonitor()._fail(core_api(), _pod(claims=['transfer-a']), 'pgsc-calc-a', 'queued', 'stuck')
+    assert len(api_server.patches) == 1
+
+
+def test_fail_error_raised(api_server, monkeypatch):
+    """ Anything but a 404 is raised, so the job isn't recorded as failed and is tried again next period """
+    monkeypatch.setattr(api_server, 'json_patch', lambda *args: (500, api_server._status(500, 'InternalError', '')))
+    with pytest.raises(Exception):
+        PodMonitor()._fail(core_api(), _pod(), 'pgsc-calc-a', 'queued', 'stuck')
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+from kubernetes import client
+
+from benchmarks.bench_validation import make_message
+from jobsubmitter import config
+from jobsubmitter.job.job import plan_job
+
+RESOURCES = ('jobs', 'configmaps', 'persistentvolumeclaims')
+
+
+def _plan():
+    params = json.loads(make_message(1))
+    params['pipeline_param']['id'] = 'INT000001'
+    return plan_job(params, 'test')
+
+
+def _calls(server, method: str) -> int:
+    return sum(n for (m, resource, _), n in server.requests.items() if m == method and resource in RESOURCES)
+
+
+def test_execute_creates_each_object_once(api_server):
+    plan = _plan()
+    plan.execute()
+
+    assert plan.api_calls == 4  # the Job, its two ConfigMaps and the transfer PVC
+    assert _calls(api_server, 'POST') == 4
+    assert sum(n for (method, *_), n in api_server.requests.items() if method != 'POST') == 0
+
+    job_uid = api_server.objects('jobs', config.NAMESPACE)[plan.job.metadata.name]['metadata']['uid']
+    for obj in plan.owned:
+        stored = api_server.objects(f"{obj.kind.lower()}s", config.NAMESPACE)[obj.metadata.name]
+        assert [x['uid'] for x in stored['metadata']['ownerReferences']] == [job_uid]
+
+
+def test_execute_rolls_back_created_objects(api_server):
+    plan = _plan()
+    pvc = plan.owned[-1]
+    assert pvc.kind == 'PersistentVolumeClaim'
+    api_server.create('persistentvolumeclaims', config.NAMESPACE, {'metadata': {'name': pvc.metadata.name}})
+
+    with pytest.raises(client.exceptions.ApiException) as e:
+        plan.execute()
+    assert e.value.status == 409
+
+    assert plan.api_calls == 4 + 3  # every create, then deletes of the Job and its ConfigMaps
+    assert _calls(api_server, 'POST') == 4
+    assert _calls(api_server, 'DELETE') == 3
+    assert api_server.objects('jobs', config.NAMESPACE) == {}
+    assert not any(name in api_server.objects('configmaps', config.NAMESPACE) for name in
+                   (x.metadata.name for x in plan.owned if x.kind == 'ConfigMap'))
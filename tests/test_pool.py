@@ -0,0 +1,108 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from jobsubmitter import config
+from jobsubmitter.transfer.pool import CLAIMED_ANNOTATION, JOB_ANNOTATION, STATE_LABEL, PVCPool
+
+
+def _pvc(server, name: str, state: str, **annotations) -> None:
+    server.create('persistentvolumeclaims', config.NAMESPACE,
+                  {'metadata': {'name': name, 'labels': {'app': 'transfer', STATE_LABEL: state},
+                                'annotations': annotations}})
+
+
+def _pvcs(server) -> dict[str, dict]:
+    return server.objects('persistentvolumeclaims', config.NAMESPACE)
+
+
+def _states(server) -> dict[str, str]:
+    return {name: pvc['metadata']['labels'][STATE_LABEL] for name, pvc in _pvcs(server).items()}
+
+
+def _finish_pod(server, name: str, phase: str) -> None:
+    """ Set a warm-up pod's phase, once the fake API server has marked it Pending """
+    while 'phase' not in server.objects('pods', config.NAMESPACE)[name]['status']:
+        time.sleep(0.01)
+    server.patch('pods', config.NAMESPACE, name, {'status': {'phase': phase}})
+
+
+def test_claim_race(api_server):
+    """ Replicas claim with the resourceVersion they listed, so a PVC claimed elsewhere is a conflict (409) """
+    for name in ('transfer-pool-a', 'transfer-pool-b'):
+        _pvc(api_server, name, 'available')
+    replicas = [PVCPool(size=2), PVCPool(size=2)]
+    for pool in replicas:
+        pool.refill()
+        assert pool.available == 2
+
+    size, storage_class = '10Gi', replicas[0].storage_class
+    assert replicas[0].claim('pgsc-calc-a', size, storage_class) == 'transfer-pool-a'
+    # the second replica's copy of transfer-pool-a is stale, so it's skipped
+    assert replicas[1].claim('pgsc-calc-b', size, storage_class) == 'transfer-pool-b'
+    assert replicas[1].claim('pgsc-calc-c', size, storage_class) is None  # empty
+
+    pvcs = _pvcs(api_server)
+    assert {name: pvc['metadata']['annotations'][JOB_ANNOTATION] for name, pvc in pvcs.items()} == \
+        {'transfer-pool-a': 'pgsc-calc-a', 'transfer-pool-b': 'pgsc-calc-b'}
+    assert set(_states(api_server).values()) == {'claimed'}
+
+
+def test_claim_too_small(api_server):
+    _pvc(api_server, 'transfer-pool-a', 'available')
+    pool = PVCPool(size=1, claim_size='40Gi')
+    pool.refill()
+    assert pool.claim('pgsc-calc-a', '50Gi', pool.storage_class) is None
+    assert pool.claim('pgsc-calc-a', '10Gi', 'another-class') is None
+    assert pool.available == 1
+
+
+def test_warm_up(api_server):
+    """ PVCs are available once their warm-up pod succeeds, and deleted if it fails or is missing """
+    pool = PVCPool(size=3)
+    pool.refill()
+    warming = sorted(_pvcs(api_server))
+    assert len(warming) == 3 and set(_states(api_server).values()) == {'warming'}
+    assert set(api_server.objects('pods', config.NAMESPACE)) == {f"{x}-warm" for x in warming}
+    assert pool.available == 0
+
+    succeeded, failed, missing = warming
+    _finish_pod(api_server, f"{succeeded}-warm", 'Succeeded')
+    _finish_pod(api_server, f"{failed}-warm", 'Failed')
+    api_server.delete('pods', config.NAMESPACE, f"{missing}-warm")
+    pool.refill()
+
+    states = _states(api_server)
+    assert states.pop(succeeded) == 'available'
+    assert failed not in states and missing not in states
+    assert list(states.values()) == ['warming', 'warming']  # replacements
+    assert f"{succeeded}-warm" not in api_server.objects('pods', config.NAMESPACE)  # deleted once it's available
+    assert pool.available == 1
+    assert pool.claim('pgsc-calc-a', '10Gi', pool.storage_class) == succeeded
+
+
+def test_recycle_after_job_is_gone(api_server):
+    """ Claimed PVCs are deleted once their Job is gone, after a grace period for the Job to be created """
+    now = datetime.now(timezone.utc)
+    api_server.create('jobs', config.NAMESPACE,
+                      {'metadata': {'name': 'pgsc-calc-running', 'labels': {'app': 'nextflow', 'run-id': 'a'}},
+                       'spec': {'template': {'spec': {'containers': []}}}})
+    for name, job_name, claimed in [('transfer-pool-running', 'pgsc-calc-running', 3600),
+                                    ('transfer-pool-gone', 'pgsc-calc-gone', 301),
+                                    ('transfer-pool-creating', 'pgsc-calc-creating', 10)]:
+        _pvc(api_server, name, 'claimed', **{JOB_ANNOTATION: job_name,
+                                              CLAIMED_ANNOTATION: (now - timedelta(seconds=claimed)).isoformat()})
+
+    PVCPool(size=0, claim_grace_period=300).refill()
+
+    assert set(_pvcs(api_server)) == {'transfer-pool-running', 'transfer-pool-creating'}
+
+
+def test_only_leader_maintains_pool(api_server):
+    class Follower:
+        is_leader = False
+
+    _pvc(api_server, 'transfer-pool-a', 'available')
+    pool = PVCPool(size=3, leader=Follower())
+    pool.refill()
+    assert pool.available == 1
+    assert set(_pvcs(api_server)) == {'transfer-pool-a'}
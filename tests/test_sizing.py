@@ -0,0 +1,63 @@
+import json
+import pathlib
+
+import pytest
+from kubernetes.utils import parse_quantity
+
+from jobsubmitter import config
+from jobsubmitter.transfer import sizing
+
+MESSAGES = pathlib.Path(__file__).parent / 'fixtures' / 'launch_messages.jsonl'
+TIERS = '100Gi=example-nfs-ssd,example-nfs-hdd'
+
+# run id: (input GiB, PVC size, storage class) with the default sizing options: 10Gi + input * (1 + 2.0 headroom)
+EXPECTED = {
+    'INT000001': (5.0, '26Gi', 'example-nfs-ssd'),  # no file_sizes: pgen 4Gi + pvar 1Gi + psam 1Mi estimated
+    'INT000002': (2.5, '18Gi', 'example-nfs-ssd'),  # file_sizes declared for every file
+    'INT000003': (5.0, '26Gi', 'example-nfs-ssd'),  # no file_sizes, split by chromosome: 22 files at 1/22 each
+    'INT000004': (41.0, '134Gi', 'example-nfs-hdd'),  # bed declared, bim and fam estimated
+    'INT000005': (0.0, '11Gi', 'example-nfs-ssd'),  # a few MiB, rounded up to a whole GiB
+    'INT000006': (100.0, '310Gi', 'example-nfs-hdd'),  # a declared vcf
+}
+
+
+@pytest.fixture
+def messages(monkeypatch) -> dict[str, dict]:
+    monkeypatch.setattr(config, 'STORAGE_TIERS', TIERS)
+    with open(MESSAGES) as f:
+        return {x['pipeline_param']['id']: x for x in map(json.loads, filter(str.strip, f))}
+
+
+@pytest.mark.parametrize('run_id', EXPECTED)
+def test_pvc_size(messages, run_id):
+    gib, size, storage_class = EXPECTED[run_id]
+    assert sizing.input_size(messages[run_id]) / sizing.GIB == pytest.approx(gib, abs=0.05)
+    assert sizing.pvc_size(messages[run_id]) == (size, storage_class)
+
+
+def test_clamped(messages, monkeypatch):
+    monkeypatch.setattr(config, 'PVC_MIN_SIZE', '20Gi')
+    monkeypatch.setattr(config, 'PVC_MAX_SIZE', '200Gi')
+    assert sizing.pvc_size(messages['INT000005']) == ('20Gi', 'example-nfs-ssd')
+    assert sizing.pvc_size(messages['INT000006']) == ('200Gi', 'example-nfs-hdd')
+
+
+def test_cached_inputs_not_stored(messages, monkeypatch):
+    monkeypatch.setattr(config, 'INPUT_CACHE_PVC', 'input-cache')
+    assert sizing.pvc_size(messages['INT000006']) == ('210Gi', 'example-nfs-hdd')  # 10Gi + 100Gi * 2.0
+
+
+@pytest.mark.parametrize('size, storage_class', [('1Gi', 'ssd'), ('100Gi', 'ssd'), ('101Gi', 'hdd'),
+                                                 ('1Ti', 'hdd'), ('2Ti', 'archive')])
+def test_storage_class(monkeypatch, size, storage_class):
+    monkeypatch.setattr(config, 'STORAGE_TIERS', '100Gi=ssd,1Ti=hdd,archive')
+    assert sizing.storage_class(parse_quantity(size)) == storage_class
+
+
+def test_cli(capsys, monkeypatch):
+    for name in ('PVC_HEADROOM', 'PVC_BASE_SIZE', 'PVC_MIN_SIZE', 'PVC_MAX_SIZE', 'STORAGE_TIERS'):
+        monkeypatch.setattr(config, name, getattr(config, name))  # restored after main() sets them
+    sizing.main([str(MESSAGES), '--storage_tiers', TIERS])
+    lines = [x.split('\t') for x in capsys.readouterr().out.splitlines()]
+    assert {run_id: (float(gib[:-len('Gi input')]), size, storage_class)
+            for run_id, gib, size, storage_class in lines} == EXPECTED
@@ -0,0 +1,131 @@
+import json
+
+import pytest
+from kafka.errors import KafkaTimeoutError
+
+from benchmarks.fakes import InMemoryKafka
+from jobsubmitter import status
+
+
+@pytest.fixture
+def kafka(monkeypatch) -> InMemoryKafka:
+    kafka = InMemoryKafka()
+    monkeypatch.setattr(status, 'KafkaProducer', kafka.producer)
+    return kafka
+
+
+def _message(state: str) -> dict:
+    return {'status': state, 'pipeline_id': 'INT000001', 'outdir': ""}
+
+
+def _published(kafka: InMemoryKafka) -> list[str]:
+    return [json.loads(value)['status'] for _, value in kafka.topics['pipeline-status']]
+
+
+def test_stale_running_after_completed(kafka):
+    """ A pod list taken before the job finished is published after the watcher saw it complete """
+    publisher = status.StatusPublisher([])
+    publisher.send('job-1', _message('STARTED'))
+    publisher.flush()
+
+    publisher.send('job-1', _message('COMPLETED'), finished_at=0)
+    publisher.send('job-1', _message('RUNNING'), source='monitor')
+    publisher.flush()
+    publisher.send('job-1', _message('RUNNING'), source='monitor')  # next pod list, still stale
+    publisher.flush()
+
+    assert _published(kafka) == ['STARTED', 'COMPLETED']
+
+
+def test_running_pending_when_completed(kafka):
+    publisher = status.StatusPublisher([])
+    publisher.send('job-1', _message('RUNNING'), source='monitor')
+    publisher.send('job-1', _message('FAILED'), finished_at=0)
+    publisher.flush()
+
+    assert _published(kafka) == ['FAILED']
+
+
+def test_pod_phase_doesnt_replace_job_state(kafka):
+    publisher = status.StatusPublisher([])
+    publisher.send('job-1', _message('STARTED'))
+    publisher.send('job-1', _message('QUEUED'), source='monitor')
+    publisher.send('job-1', _message('TRANSFERRING'), source='monitor')
+    publisher.send('job-2', _message('STARTED'))
+    publisher.flush()
+
+    assert _published(kafka) == ['STARTED', 'TRANSFERRING', 'STARTED']
+
+
+def test_messages_keyed_by_pipeline_id(kafka):
+    """ Every state of a job is sent with the same key, so it goes to one partition and stays in order """
+    publisher = status.StatusPublisher([])
+    publisher.send('job-1', _message('STARTED'))
+    publisher.send('job-2', {'status': 'STARTED', 'pipeline_id': 'INT000002', 'outdir': ""})
+    publisher.flush()
+    publisher.send('job-1', _message('RUNNING'), source='monitor')
+    publisher.flush()
+
+    assert kafka.keys['pipeline-status'] == [b'INT000001', b'INT000002', b'INT000001']
+
+
+def test_send_error_reported_unsent(kafka, monkeypatch):
+    """ A send that raises (e.g. metadata couldn't be fetched with the broker down) reports the rest of the batch """
+    publisher = status.StatusPublisher([])
+    for job in ('job-1', 'job-2', 'job-3'):
+        publisher.send(job, _message('STARTED'))
+
+    send = publisher.producer.send
+    sends = []
+
+    def failing_send(*args, **kwargs):
+        sends.append(args)
+        if len(sends) == 2:
+            raise KafkaTimeoutError("Failed to update metadata after 60.0 secs.")
+        return send(*args, **kwargs)
+
+    monkeypatch.setattr(publisher.producer, 'send', failing_send)
+    publisher.flush()
+
+    assert _published(kafka) == ['STARTED']
+    assert publisher.pop_unsent() == {'job-2', 'job-3'}
+    assert publisher.pop_unsent() == set()
+
+
+class _PendingFuture:
+    """ A send that hasn't been acknowledged yet """
+
+    def __init__(self):
+        self.callbacks, self.errbacks = [], []
+
+    def add_callback(self, fn, *args):
+        self.callbacks.append((fn, args))
+
+    def add_errback(self, fn, *args):
+        self.errbacks.append((fn, args))
+
+
+def test_unconfirmed_until_delivered(kafka, monkeypatch):
+    """ Jobs are unconfirmed while their message is queued or in flight, and after it fails until pop_unsent """
+    publisher = status.StatusPublisher([])
+    futures = []
+
+    def send(*args, **kwargs) -> _PendingFuture:
+        futures.append(_PendingFuture())
+        return futures[-1]
+
+    monkeypatch.setattr(publisher.producer, 'send', send)
+    publisher.send('job-1', _message('STARTED'))
+    publisher.send('job-2', _message('STARTED'))
+    assert publisher.unconfirmed() == {'job-1', 'job-2'}  # queued
+
+    publisher.flush()
+    assert publisher.unconfirmed() == {'job-1', 'job-2'}  # in flight
+    delivered, failed = futures
+    fn, args = delivered.callbacks[0]
+    fn(*args, None)
+    fn, args = failed.errbacks[0]
+    fn(*args, Exception("timed out"))
+    assert publisher.unconfirmed() == {'job-2'}
+    assert publisher.pop_unsent() == {'job-2'}
+    assert publisher.unconfirmed() == set()
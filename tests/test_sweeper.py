@@ -0,0 +1,81 @@
+import os
+import time
+
+from jobsubmitter import config
+from jobsubmitter.sweeper import OrphanSweeper
+
+OLD = '2020-01-01T00:00:00Z'  # created long before the grace period
+
+
+def _create(server, resource: str, name: str, labels: dict, old: bool = True, **fields) -> None:
+    server.create(resource, config.NAMESPACE, {'metadata': {'name': name, 'labels': labels}, **fields})
+    if old:
+        server.patch(resource, config.NAMESPACE, name, {'metadata': {'creationTimestamp': OLD}})
+
+
+def _job(server, name: str, configmaps: list[str], pvc: str, old: bool = True) -> None:
+    """ A Job that mounts its ConfigMaps and PVC, like one made by job.plan_job """
+    volumes = [{'name': f"vol-{i}", 'configMap': {'name': x}} for i, x in enumerate(configmaps)]
+    volumes.append({'name': 'data', 'persistentVolumeClaim': {'claimName': pvc}})
+    env = [{'name': 'NXF_WORK', 'valueFrom': {'configMapKeyRef': {'name': 'nxf-base', 'key': 'nxf_work'}}}]
+    spec = {'template': {'spec': {'containers': [{'name': 'nextflow', 'image': 'nextflow', 'env': env}],
+                                  'volumes': volumes, 'restartPolicy': 'Never'}}}
+    _create(server, 'jobs', name, {'app': 'nextflow', 'run-id': name}, old, spec=spec)
+
+
+def _names(server, resource: str) -> set[str]:
+    return set(server.objects(resource, config.NAMESPACE))
+
+
+def test_sweep_legacy_transfer_objects(api_server):
+    """ Transfer ConfigMaps and PVCs of older versions are only labelled app=transfer """
+    _create(api_server, 'configmaps', 'transfer-legacy', {'app': 'transfer'})
+    _create(api_server, 'persistentvolumeclaims', 'transfer-legacy', {'app': 'transfer'})
+    _create(api_server, 'persistentvolumeclaims', 'transfer-young', {'app': 'transfer'}, old=False)
+    _create(api_server, 'persistentvolumeclaims', 'transfer-pool-a', {'app': 'transfer', 'pool-state': 'available'})
+    _create(api_server, 'configmaps', 'nxf-base', {'app': 'nextflow'})
+    # still used by a Job that never adopted them
+    _create(api_server, 'configmaps', 'transfer-used', {'app': 'transfer'})
+    _create(api_server, 'persistentvolumeclaims', 'transfer-used', {'app': 'transfer'})
+    _job(api_server, 'pgsc-calc-used', ['transfer-used'], 'transfer-used')
+
+    assert OrphanSweeper(grace_period=600).sweep() == 2
+
+    assert _names(api_server, 'configmaps') == {'nxf-base', 'transfer-used'}
+    assert _names(api_server, 'persistentvolumeclaims') == {'transfer-young', 'transfer-pool-a', 'transfer-used'}
+    assert _names(api_server, 'jobs') == {'pgsc-calc-used'}
+
+
+def test_sweep_jobs_missing_their_objects(api_server):
+    """ A Job whose rollback failed to delete it can never start: its ConfigMaps or PVC were deleted """
+    _create(api_server, 'configmaps', 'nxf-vol-ok', {'app': 'nextflow', 'run-id': 'ok'})
+    _create(api_server, 'persistentvolumeclaims', 'transfer-ok', {'app': 'transfer', 'run-id': 'ok'})
+    _job(api_server, 'pgsc-calc-ok', ['nxf-vol-ok'], 'transfer-ok')
+    _job(api_server, 'pgsc-calc-rolled-back', ['nxf-vol-rolled-back'], 'transfer-rolled-back')
+    _job(api_server, 'pgsc-calc-young', ['nxf-vol-young'], 'transfer-young', old=False)
+    # objects that aren't labelled like the job submitter's are read, not assumed missing
+    _create(api_server, 'persistentvolumeclaims', 'unlabelled', {})
+    _create(api_server, 'configmaps', 'nxf-vol-unlabelled', {'app': 'nextflow', 'run-id': 'unlabelled'})
+    _job(api_server, 'pgsc-calc-unlabelled', ['nxf-vol-unlabelled'], 'unlabelled')
+
+    assert OrphanSweeper(grace_period=600).sweep() == 1
+
+    assert _names(api_server, 'jobs') == {'pgsc-calc-ok', 'pgsc-calc-young', 'pgsc-calc-unlabelled'}
+
+
+def test_remove_cache_links_of_finished_runs(api_server, tmp_path):
+    """ Links to cached files are removed once a run's Job finishes, so the files can be evicted to fit the budget """
+    _job(api_server, 'pgsc-calc-running', ['nxf-vol-running'], 'transfer-running', old=False)
+    _job(api_server, 'pgsc-calc-finished', ['nxf-vol-finished'], 'transfer-finished')
+    api_server.patch('jobs', config.NAMESPACE, 'pgsc-calc-finished', {'status': {'succeeded': 1}})
+    old = time.time() - 3600
+    for path in ('runs/pgsc-calc-running', 'runs/pgsc-calc-finished', 'runs/gone', 'runs/young', 'tmp/0123abcd.gone'):
+        (tmp_path / path / 'test').mkdir(parents=True)
+        (tmp_path / path / 'test' / 'a.psam').write_bytes(b'psam')
+        if path != 'runs/young':
+            os.utime(tmp_path / path, (old, old))
+
+    assert OrphanSweeper(grace_period=600, cache_dir=str(tmp_path)).sweep() == 2
+
+    assert {x.name for x in (tmp_path / 'runs').iterdir()} == {'pgsc-calc-running', 'young'}
+    assert not list((tmp_path / 'tmp').iterdir())
@@ -0,0 +1,118 @@
+import json
+import os
+import random
+
+import pytest
+
+from benchmarks.fakes import FakeGlobusCollection
+from jobsubmitter.transfer.globus import transfer
+
+KB = 2 ** 10
+
+
+@pytest.fixture
+def files() -> dict[str, bytes]:
+    return {'test/a.pgen': os.urandom(300 * KB), 'test/a.pvar': os.urandom(70 * KB), 'test/a.psam': os.urandom(KB)}
+
+
+@pytest.fixture
+def collection(files) -> FakeGlobusCollection:
+    collection = FakeGlobusCollection(files)
+    collection.start()
+    yield collection
+    collection.stop()
+
+
+def _transfer(collection: FakeGlobusCollection, dest, retries: int = 5, parallelism: int = 4,
+              **kwargs) -> transfer.Transfer:
+    dest.mkdir(exist_ok=True)
+    return transfer.Transfer(collection.url, collection.TOKEN, str(dest), parallelism=parallelism, chunk_size=64 * KB,
+                             retries=retries, backoff=0, collection_id='collection', **kwargs)
+
+
+def _log(dest) -> dict:
+    with open(os.path.join(dest, transfer.LOG_PATH)) as f:
+        return json.load(f)
+
+
+def _fetches(collection: FakeGlobusCollection) -> int:
+    """ Requests after the probe of each file """
+    return sum(collection.requests.values()) - len(collection.requests)
+
+
+def test_cut_off_responses_retried(collection, files, tmp_path):
+    """ Responses cut off part way (--fail_rate in bench_transfer.py) are retried from the last byte written """
+    random.seed(1)  # one request at a time, so the same responses are cut off every run
+    collection.fail_rate = 0.3
+    _transfer(collection, tmp_path, retries=20, parallelism=1).run(list(files), '')
+
+    for path, content in files.items():
+        assert (tmp_path / path).read_bytes() == content
+    log = _log(tmp_path)
+    assert log['status'] == 'complete'
+    assert all(x['status'] == 'complete' for x in log['files'].values())
+    chunks = sum(x['chunks'] for x in log['files'].values())
+    assert sum(x['attempts'] for x in log['files'].values()) == _fetches(collection) > chunks
+    assert not list(tmp_path.glob('**/*.part*'))
+
+
+def test_gives_up_after_retries(collection, tmp_path):
+    collection.fail_rate = 1
+    with pytest.raises(transfer.TransferError, match="connection closed"):
+        _transfer(collection, tmp_path, retries=2).run(['test/a.psam'], '')
+
+    log = _log(tmp_path)
+    assert log['status'] == 'failed'
+    assert log['files']['test/a.psam']['status'] == 'failed'
+    assert log['files']['test/a.psam']['attempts'] == _fetches(collection) == 3  # the first attempt and 2 retries
+    assert not (tmp_path / 'test' / 'a.psam').exists()
+
+
+def test_cache_miss_then_hit(collection, files, tmp_path):
+    cache = transfer.Cache(str(tmp_path / 'cache'))
+    _transfer(collection, tmp_path / 'run-1', cache=cache, run_id='run-1').run(list(files), '')
+    downloaded = _fetches(collection)
+    assert downloaded > 0
+    assert all(x['status'] == 'complete' for x in _log(tmp_path / 'run-1')['files'].values())
+
+    collection.requests.clear()
+    _transfer(collection, tmp_path / 'run-2', cache=cache, run_id='run-2').run(list(files), '')
+    assert _fetches(collection) == 0  # only probed
+    assert all(x['status'] == 'cached' for x in _log(tmp_path / 'run-2')['files'].values())
+    for path, content in files.items():
+        run_1, run_2 = (tmp_path / 'cache' / 'runs' / x / path for x in ('run-1', 'run-2'))
+        assert run_2.read_bytes() == content
+        assert os.path.samefile(run_1, run_2)  # hard links to one cached object
+
+
+def test_changed_file_is_a_cache_miss(collection, files, tmp_path):
+    """ Cache keys include the size (and ETag), so a file that changed on the collection is downloaded again """
+    cache = transfer.Cache(str(tmp_path / 'cache'))
+    _transfer(collection, tmp_path / 'run-1', cache=cache, run_id='run-1').run(['test/a.psam'], '')
+
+    files['test/a.psam'] = os.urandom(2 * KB)
+    collection.requests.clear()
+    _transfer(collection, tmp_path / 'run-2', cache=cache, run_id='run-2').run(['test/a.psam'], '')
+
+    assert _fetches(collection) == 1
+    assert _log(tmp_path / 'run-2')['files']['test/a.psam']['status'] == 'complete'
+    assert (tmp_path / 'cache' / 'runs' / 'run-2' / 'test' / 'a.psam').read_bytes() == files['test/a.psam']
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_same_name_in_different_directories(collection, files, tmp_path, cached):
+    """ Files keep their path relative to the collection directory, so same-named files don't collide """
+    files['other/a.psam'] = os.urandom(KB)
+    cache = transfer.Cache(str(tmp_path / 'cache')) if cached else None
+    _transfer(collection, tmp_path / 'run', cache=cache, run_id='run').run(['test/a.psam', 'other/a.psam'], '')
+
+    run_dir = tmp_path / 'cache' / 'runs' / 'run' if cached else tmp_path / 'run'
+    for path in ('test/a.psam', 'other/a.psam'):
+        assert (run_dir / path).read_bytes() == files[path]
+    assert set(_log(tmp_path / 'run')['files']) == {'test/a.psam', 'other/a.psam'}
+
+
+def test_paths_outside_the_collection_directory():
+    assert transfer.relative_path('/test//a.psam') == 'test/a.psam'
+    with pytest.raises(transfer.TransferError):
+        transfer.relative_path('../a.psam')
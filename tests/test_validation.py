@@ -0,0 +1,74 @@
+import json
+import pathlib
+
+import pytest
+from jsonschema.exceptions import ValidationError
+
+from benchmarks.bench_validation import make_message
+from jobsubmitter.validate.schema import FastValidator, create_validator
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures' / 'launch_messages.jsonl'
+MESSAGES = [json.loads(x) for x in FIXTURES.read_text().splitlines()] + [json.loads(make_message(3))]
+FILE_SETS = [('pgen', 'pvar', 'psam'), ('bed', 'bim', 'fam')]  # required together (dependentRequired)
+
+
+def _genome(message: dict) -> dict:
+    return message['pipeline_param']['target_genomes'][0]
+
+
+def _incomplete(i: int):
+    """ Drop the i-th file of a genome's pgen or bed file set. A VCF genome gets part of a pgen set """
+    def drop(message: dict) -> None:
+        genome = _genome(message)
+        files = next((x for x in FILE_SETS if x[0] in genome), None)
+        if files is None:
+            genome[FILE_SETS[0][i]] = 'extra'
+        else:
+            genome.pop(files[i])
+    return drop
+
+
+# each makes a valid message invalid
+INVALID = {'incomplete 0': _incomplete(0),
+           'incomplete 1': _incomplete(1),
+           'incomplete 2': _incomplete(2),
+           'missing sampleset': lambda x: _genome(x).pop('sampleset'),
+           'empty pgen': lambda x: _genome(x).update(pgen=''),
+           'numeric chrom': lambda x: _genome(x).update(chrom=1),
+           'missing globus_details': lambda x: x.pop('globus_details')}
+
+
+@pytest.fixture(scope='module')
+def validators() -> dict:
+    pytest.importorskip('fastjsonschema')
+    validators = {engine: create_validator(engine) for engine in ('jsonschema', 'fast')}
+    assert isinstance(validators['fast'], FastValidator)
+    return validators
+
+
+def _valid(validator, message: dict) -> bool:
+    try:
+        validator.validate(message)
+    except ValidationError:
+        return False
+    return True
+
+
+@pytest.mark.parametrize('message', MESSAGES, ids=lambda x: x['pipeline_param']['id'])
+def test_engines_accept_fixtures(validators, message):
+    assert all(_valid(x, message) for x in validators.values())
+
+
+@pytest.mark.parametrize('case', INVALID)
+@pytest.mark.parametrize('message', MESSAGES, ids=lambda x: x['pipeline_param']['id'])
+def test_engines_agree_on_invalid_messages(validators, message, case):
+    message = json.loads(json.dumps(message))
+    INVALID[case](message)
+    assert {engine: _valid(x, message) for engine, x in validators.items()} == {'jsonschema': False, 'fast': False}
+
+
+def test_formats_not_checked(validators):
+    """ Neither engine checks formats, e.g. the guest collection's uuid """
+    message = json.loads(make_message(1))
+    message['globus_details']['guest_collection_id'] = 'not-a-uuid'
+    assert all(_valid(x, message) for x in validators.values())
@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+
+import pytest
+
+from benchmarks.bench_validation import make_message
+from jobsubmitter import config, startup, submit_job, watch
+from jobsubmitter.apiclient import batch_api
+from jobsubmitter.dedupe import SubmissionIndex
+from jobsubmitter.job import job
+
+
+class _Stop(BaseException):
+    """ Ends a watch loop, which carries on after any Exception """
+
+
+class _Publisher:
+    """ A StatusPublisher that records what was sent """
+
+    def __init__(self):
+        self.sent: list[tuple[str, str]] = []
+
+    def send(self, run_id: str, message: dict, finished_at: float = None, source: str = 'watch') -> None:
+        self.sent.append((run_id, message['status']))
+
+    def pop_unsent(self) -> list[str]:
+        return []
+
+
+class _Admission:
+    """ An AdmissionController that doesn't count anything """
+
+    def release(self, run_id: str) -> None:
+        pass
+
+    def submitted(self, run_id: str) -> None:
+        pass
+
+
+def test_stream_relists_after_errors(api_server, monkeypatch):
+    """ An unexpected error listing or watching is logged, and the watcher relists instead of dying """
+    syncs = []
+    sync_jobs = watch._sync_jobs
+
+    def sync(*args):
+        syncs.append(args)
+        if len(syncs) == 1:
+            raise ValueError("list failed")
+        if len(syncs) == 3:
+            raise _Stop()
+        return sync_jobs(*args)
+
+    def watch_jobs(*args):
+        raise ConnectionError("watch failed")
+
+    monkeypatch.setattr(watch, '_sync_jobs', sync)
+    monkeypatch.setattr(watch, '_watch_jobs', watch_jobs)
+    monkeypatch.setattr(watch, 'MAX_BACKOFF', 0)
+
+    with pytest.raises(_Stop):
+        watch._stream_jobs(_Publisher(), batch_api(), watch.job_selector(), 10, 600, {}, None, None, None)
+    assert len(syncs) == 3
+    assert not watch.stalled()
+
+
+def test_dead_watcher_clears_ready(tmp_path):
+    ready_file = tmp_path / 'ready'
+    startup.set_ready(str(ready_file))
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+
+    with pytest.raises(RuntimeError, match="stopped"):
+        submit_job._check_watcher(thread, str(ready_file))
+    assert not ready_file.exists()
+
+
+def test_stalled_watcher_clears_ready(tmp_path, monkeypatch):
+    ready_file = tmp_path / 'ready'
+    startup.set_ready(str(ready_file))
+    monkeypatch.setattr(watch, '_last_progress', time.monotonic() - watch.STALL_TIMEOUT - 1)
+
+    with pytest.raises(RuntimeError, match="stalled"):
+        submit_job._check_watcher(threading.current_thread(), str(ready_file))
+    assert not ready_file.exists()
+
+
+def test_rolled_back_job_not_indexed(api_server, monkeypatch):
+    """ Watch events of a rolled back Job arrive after the submission failed, and mustn't make the redelivered
+    message a duplicate """
+    params = json.loads(make_message(1))
+    params['pipeline_param']['id'] = 'INT000001'
+    monkeypatch.setattr(job, 'name_suffix', lambda: 'rollback')
+    api_server.create('persistentvolumeclaims', config.NAMESPACE, {'metadata': {'name': 'transfer-rollback'}})
+
+    index = SubmissionIndex()
+    assert index.claim('INT000001')
+    with pytest.raises(Exception):
+        submit_job._submit_job(index, _Admission(), params, 'test')
+    assert api_server.objects('jobs', config.NAMESPACE) == {}
+
+    # the Job's ADDED and DELETED events are processed after the rollback
+    monkeypatch.setattr(watch, 'WATCH_TIMEOUT', 1)
+    watch._watch_jobs(_Publisher(), batch_api(), watch.job_selector(), '0', {}, index)
+    assert 'INT000001' not in index
+    assert index.claim('INT000001')
+
+    index.add('INT000001')  # once claimed again, the new Job is indexed
+    assert 'INT000001' in index